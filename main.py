@@ -1,9 +1,23 @@
 import os
 import time
 import json
+import orjson
+import msgpack
 import logging
 import re
-from datetime import datetime, timedelta
+import math
+import shlex
+import signal
+import heapq
+import hashlib
+import gzip
+import mmap
+import queue
+import atexit
+import shutil
+import threading
+from datetime import datetime, timedelta, date, timezone
+from collections import deque, OrderedDict
 from typing import Dict, List, Tuple, Optional, Any
 from supabase import create_client, Client
 from dotenv import load_dotenv
@@ -12,7 +26,8 @@ import asyncio
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
-from functools import wraps
+from aiogram.exceptions import TelegramBadRequest
+from functools import wraps, lru_cache
 from threading import Lock
 from pycoingecko import CoinGeckoAPI
 import numpy as np
@@ -47,6 +62,11 @@ TARIFF_SETTINGS_PATH = os.getenv("TARIFF_SETTINGS_PATH", "tariff_settings.json")
 # Telegram Bot настройки
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_ADMIN_ID = os.getenv("TELEGRAM_ADMIN_ID")
+# Числовой ID администратора: сравнивается с message.from_user.id без преобразования в строку
+try:
+    ADMIN_ID_INT = int(TELEGRAM_ADMIN_ID)
+except (TypeError, ValueError):
+    ADMIN_ID_INT = None
 
 # OpenRouter AI настройки
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
@@ -59,6 +79,9 @@ OPENROUTER_SITE_NAME = os.getenv("OPENROUTER_SITE_NAME", "Mining Farm Analytics"
 CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY")
 CEREBRAS_MODEL = os.getenv("CEREBRAS_MODEL", "qwen-3-235b-a22b-thinking-2507")
 
+# Задержка (в секундах) перед параллельным запросом к резервному AI-провайдеру
+AI_HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY", "1.5"))
+
 # Проверка переменных
 required_vars = [TUYA_ACCESS_ID, TUYA_ACCESS_SECRET, SUPABASE_URL, SUPABASE_KEY]
 if not all(required_vars):
@@ -71,7 +94,12 @@ if not OPENROUTER_API_KEY and not CEREBRAS_API_KEY:
     logger.warning(
         "Не заданы ключи для AI-сервисов (OPENROUTER_API_KEY или CEREBRAS_API_KEY), AI-функции будут отключены")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+@lru_cache(maxsize=1)
+def get_supabase_client() -> Client:
+    """Возвращает единственный на процесс клиент Supabase"""
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+supabase: Client = get_supabase_client()
 
 # Инициализация CoinGecko API
 cg = CoinGeckoAPI()
@@ -105,6 +133,7 @@ def add_device_to_database(device_id: str, name: str, location: str) -> bool:
         
         if response.data:
             logger.info(f"Устройство {name} ({device_id}) успешно добавлено в базу данных")
+            _merge_written_device_rows(response.data)
             return True
         else:
             logger.error(f"Не удалось добавить устройство {name} в базу данных")
@@ -132,6 +161,7 @@ def update_device_in_database(device_id: str, name: str = None, location: str =
         
         if response.data:
             logger.info(f"Устройство {device_id} успешно обновлено в базе данных")
+            _merge_written_device_rows(response.data)
             return True
         else:
             logger.error(f"Не удалось обновить устройство {device_id} в базе данных")
@@ -147,6 +177,7 @@ def delete_device_from_database(device_id: str) -> bool:
         
         if response.data:
             logger.info(f"Устройство {device_id} успешно деактивировано в базе данных")
+            _merge_written_device_rows(response.data)
             return True
         else:
             logger.error(f"Не удалось деактивировать устройство {device_id} в базе данных")
@@ -155,11 +186,50 @@ def delete_device_from_database(device_id: str) -> bool:
         logger.error(f"Ошибка при деактивации устройства {device_id}: {e}")
         return False
 
+def build_location_index(devices: List[Dict]) -> Dict[str, str]:
+    """Строит словарь локация -> device_id (первое устройство в локации)"""
+    location_index = {}
+    for device in devices:
+        location_index.setdefault(device["location"], device["device_id"])
+    return location_index
+
+def _build_device_indexes():
+    """Перестраивает индексы по текущему списку DEVICES"""
+    global LOCATION_TO_DEVICE_ID, DEVICE_BY_ID, DEVICE_NAME_BY_ID, LOCATIONS
+    LOCATION_TO_DEVICE_ID = build_location_index(DEVICES)
+    DEVICE_BY_ID = {device["device_id"]: device for device in DEVICES}
+    DEVICE_NAME_BY_ID = {device_id: device["name"] for device_id, device in DEVICE_BY_ID.items()}
+    LOCATIONS = {device["location"] for device in DEVICES}
+
+def _set_devices(devices: List[Dict]):
+    """Заменяет список активных устройств и сбрасывает зависящие от него индексы и кэши"""
+    global DEVICES
+    DEVICES = devices
+    _build_device_indexes()
+    # Кэшированные данные относятся к старому списку устройств
+    get_current_power_consumption.cache_clear()
+    get_today_spending.cache_clear()
+    devices_list_cache.clear()
+
+def merge_device_rows(rows: List[Dict]):
+    """Применяет к списку устройств строки, возвращенные запросом изменения, без перечитывания таблицы"""
+    changed = {row['device_id']: row for row in rows}
+    devices = [device for device in DEVICES if device['device_id'] not in changed]
+    devices.extend(row for row in changed.values() if row.get('is_active', True))
+    _set_devices(devices)
+    logger.info(f"Список устройств обновлен: {len(DEVICES)} активных устройств")
+
+def _merge_written_device_rows(rows: List[Dict]):
+    """Применяет строки после успешной записи; ошибка слияния не считается ошибкой записи"""
+    try:
+        merge_device_rows(rows)
+    except Exception as e:
+        logger.error(f"Ошибка обновления локального списка устройств: {e}")
+
 def refresh_devices_from_database():
     """Обновляет список устройств из базы данных"""
-    global DEVICES
     try:
-        DEVICES = load_devices_from_database()
+        _set_devices(load_devices_from_database())
         logger.info(f"Список устройств обновлен: {len(DEVICES)} активных устройств")
         return True
     except Exception as e:
@@ -174,15 +244,36 @@ except Exception as e:
     logger.error(f"Критическая ошибка загрузки конфигурации устройств: {e}")
     DEVICES = []  # Устанавливаем пустой список как fallback
 
+# Индексы для быстрого поиска устройства по локации и по device_id
+_build_device_indexes()
+
 # Загрузка тарифных настроек
 try:
-    with open(TARIFF_SETTINGS_PATH, "r", encoding="utf-8") as f:
-        TARIFF_SETTINGS = json.load(f)
+    with open(TARIFF_SETTINGS_PATH, "rb") as f:
+        TARIFF_SETTINGS = orjson.loads(f.read())
     logger.info(f"Загружены тарифные настройки для локаций: {list(TARIFF_SETTINGS.keys())}")
 except Exception as e:
     logger.error(f"Ошибка загрузки тарифных настроек: {e}")
     raise
 
+
+def _first_range_tariff(location_tariff: Dict) -> Tuple[str, float, float]:
+    """Возвращает (тип тарифа, дневной, ночной тариф) первого диапазона локации"""
+    first_range = location_tariff.get("ranges", [{}])[0] if location_tariff.get("ranges") else {}
+    return (
+        location_tariff.get("tariff_type", "single"),
+        first_range.get("day_rate", 4.82),
+        first_range.get("night_rate", 3.39)
+    )
+
+
+# Тарифы первого диапазона по локациям (TARIFF_SETTINGS загружаются один раз при старте)
+DEFAULT_FIRST_RANGE_TARIFF = _first_range_tariff({})
+TARIFF_BY_LOCATION = {
+    location: _first_range_tariff(location_tariff)
+    for location, location_tariff in TARIFF_SETTINGS.items()
+}
+
 # Подключение к Tuya Cloud
 try:
     tuya_cloud = tinytuya.Cloud(
@@ -230,172 +321,558 @@ exchange_rate_cache = {
 }
 
 # Глобальные переменные для мониторинга электричества
-ELECTRICITY_DATA_FILE = "electricity_data.json"
-ELECTRICITY_HISTORY_FILE = "electricity_history.json"
+ELECTRICITY_DATA_DIR = Path("electricity_data")
+ELECTRICITY_DATA_PATTERN = "????-??-??.jsonl"  # журналы текущих данных по дням
+# Общие журналы текущих данных до разбиения по дням, от старого формата к новому
+ELECTRICITY_LEGACY_DATA_FILES = ("electricity_data.json", "electricity_data.jsonl")
+ELECTRICITY_HISTORY_FILE = "electricity_history.msgpack"
+ELECTRICITY_SYNCING_FILE = "electricity_history.syncing.msgpack"
+ELECTRICITY_LAST_UPDATE_FILE = "last_update"
+ELECTRICITY_META_FILE = "_meta.json"  # счетчики записей в журналах
+ELECTRICITY_BLOBS_DIR = ELECTRICITY_DATA_DIR / "blobs"
+ELECTRICITY_HISTORY_ROTATE_BYTES = 16 * 1024 * 1024  # размер журнала синхронизации для ротации
+ELECTRICITY_HISTORY_SEGMENTS = "electricity_history.*.msgpack.gz"
+# Журналы синхронизации в прежних форматах (JSON с pending_records и JSONL), дочитываемые при выгрузке
+ELECTRICITY_LEGACY_HISTORY = ("electricity_history.json", "electricity_history.*.jsonl.gz",
+                              "electricity_history.jsonl", "electricity_history.syncing")
+ELECTRICITY_DATA_KEEP_DAYS = 7  # дней хранения журналов текущих данных
+ELECTRICITY_FSYNC_EVERY = 50  # записей между fsync
+ELECTRICITY_FSYNC_INTERVAL = 5.0  # секунд между fsync
+ELECTRICITY_BATCH_SIZE = 256  # записей в пакете
+ELECTRICITY_BATCH_INTERVAL = 5.0  # секунд накопления пакета
+ELECTRICITY_MAX_OPEN_LOGS = 16  # открытых журналов в кэше дескрипторов
 last_electricity_record = None
 last_supabase_sync = None
 
-def save_electricity_data(device_id: str, device_name: str, location: str, 
-                         power_w: float, energy_kwh: float, is_on: bool, 
-                         voltage: Optional[float] = None, current: Optional[float] = None):
-    """Сохраняет данные о потреблении электричества в JSON файл"""
+# Журналы электричества ведутся в формате JSONL только на дозапись:
+# одна строка на запись вместо перезаписи всего JSON файла
+_electricity_log_lock = Lock()
+_electricity_log_handles = OrderedDict()  # LRU открытых журналов
+_electricity_current_day = None
+_electricity_counts = None  # записей за текущий день и в журнале синхронизации
+_electricity_unsynced = 0
+_electricity_last_fsync = 0.0
+
+def _iter_jsonl(path: Path):
+    """Построчно читает JSONL журнал (в том числе сжатый .gz), пропуская оборванные строки"""
     try:
-        current_time = datetime.now()
-        
-        # Создаем директорию если её нет
-        data_dir = Path("electricity_data")
-        data_dir.mkdir(exist_ok=True)
-        
-        # Путь к файлу текущих данных
-        current_file = data_dir / ELECTRICITY_DATA_FILE
+        if path.suffix == '.gz':
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        yield orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue
+            return
         
-        # Загружаем существующие данные или создаем новые
-        if current_file.exists():
-            with open(current_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {
-                "last_update": current_time.isoformat(),
-                "records": [],
-                "total_records": 0
+        # Несжатый журнал отображаем в память и разбираем строки без копирования
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                pos = 0
+                while pos < size:
+                    end = mm.find(b"\n", pos)
+                    if end == -1:
+                        end = size
+                    try:
+                        record = orjson.loads(view[pos:end])
+                    except orjson.JSONDecodeError:
+                        record = None  # пустая или оборванная строка
+                    pos = end + 1
+                    if record is not None:
+                        yield record
+    except FileNotFoundError:
+        return
+
+def _iter_msgpack(path: Path):
+    """Потоково читает журнал msgpack (в том числе сжатый .gz), останавливаясь на оборванной записи"""
+    opener = gzip.open if path.suffix == '.gz' else open
+    try:
+        with opener(path, 'rb') as f:
+            try:
+                yield from msgpack.Unpacker(f, raw=False)
+            except (msgpack.FormatError, msgpack.StackError, ValueError):
+                return
+    except FileNotFoundError:
+        return
+
+def _iter_legacy_json(path: Path):
+    """Читает записи из JSON файла прежнего формата ({"records": [...]} или {"pending_records": [...]})"""
+    try:
+        data = orjson.loads(path.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return
+    yield from data.get("pending_records") or data.get("records") or []
+
+def _iter_log(path: Path):
+    """Читает журнал электричества в формате, определяемом по имени файла"""
+    if path.name.endswith(('.msgpack', '.msgpack.gz')):
+        return _iter_msgpack(path)
+    if path.suffix == '.json':
+        return _iter_legacy_json(path)
+    return _iter_jsonl(path)
+
+def _electricity_log(name: str):
+    """Возвращает открытый на дозапись журнал из LRU кэша (вызывается под блокировкой)"""
+    handle = _electricity_log_handles.get(name)
+    if handle is not None:
+        _electricity_log_handles.move_to_end(name)
+        return handle
+    
+    # Давно не использовавшийся журнал сбрасываем на диск и закрываем
+    while len(_electricity_log_handles) >= ELECTRICITY_MAX_OPEN_LOGS:
+        _close_electricity_log(next(iter(_electricity_log_handles)))
+    ELECTRICITY_DATA_DIR.mkdir(exist_ok=True)
+    handle = _electricity_log_handles[name] = open(ELECTRICITY_DATA_DIR / name, 'ab')
+    return handle
+
+def _close_electricity_log(name: str):
+    """Сбрасывает на диск и закрывает журнал (вызывается под блокировкой)"""
+    handle = _electricity_log_handles.pop(name, None)
+    if handle is not None:
+        handle.flush()
+        os.fsync(handle.fileno())
+        handle.close()
+
+def _close_electricity_logs():
+    """Сбрасывает на диск и закрывает все открытые журналы"""
+    with _electricity_log_lock:
+        for name in list(_electricity_log_handles):
+            _close_electricity_log(name)
+
+def _write_electricity_meta():
+    """Атомарно обновляет файл счетчиков записей (вызывается под блокировкой)"""
+    meta_file = ELECTRICITY_DATA_DIR / ELECTRICITY_META_FILE
+    temp_file = meta_file.with_suffix('.tmp')
+    temp_file.write_bytes(orjson.dumps(_electricity_counts))
+    os.replace(temp_file, meta_file)
+
+def electricity_log_stats() -> Dict:
+    """Возвращает счетчики записей в журналах без разбора самих журналов"""
+    try:
+        return orjson.loads((ELECTRICITY_DATA_DIR / ELECTRICITY_META_FILE).read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {"current_count": 0, "pending_count": 0}
+
+def _rotate_electricity_history():
+    """Переносит журнал синхронизации в сжатый сегмент (вызывается под блокировкой)"""
+    history_file = ELECTRICITY_DATA_DIR / ELECTRICITY_HISTORY_FILE
+    _close_electricity_log(ELECTRICITY_HISTORY_FILE)
+    
+    segment = ELECTRICITY_DATA_DIR / f"electricity_history.{datetime.now():%Y%m%d%H%M%S%f}.msgpack"
+    os.replace(history_file, segment)
+    
+    compressed = segment.with_name(segment.name + '.gz')
+    temp_file = compressed.with_suffix('.tmp')
+    with open(segment, 'rb') as src, gzip.open(temp_file, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(temp_file, compressed)
+    segment.unlink()
+    if _electricity_counts is not None:
+        _electricity_counts["pending_count"] = 0
+    logger.info(f"Журнал синхронизации электричества сжат в {compressed.name}")
+
+def _migrate_legacy_electricity_data():
+    """Однократно разносит записи общих журналов текущих данных по дневным журналам (вызывается под блокировкой)"""
+    legacy_files = [ELECTRICITY_DATA_DIR / name for name in ELECTRICITY_LEGACY_DATA_FILES]
+    payloads: Dict[str, List[bytes]] = {}
+    for legacy_file in legacy_files:
+        for record in _iter_log(legacy_file):
+            timestamp = record.get("ts") or record.get("timestamp")
+            if timestamp:
+                payloads.setdefault(timestamp[:10], []).append(orjson.dumps(record, default=str) + b"\n")
+    
+    # Записи старого журнала старше уже записанных в дневной журнал, поэтому идут в его начало
+    for day, lines in payloads.items():
+        name = f"{day}.jsonl"
+        _close_electricity_log(name)
+        day_file = ELECTRICITY_DATA_DIR / name
+        temp_file = day_file.with_suffix('.tmp')
+        with open(temp_file, 'wb') as f:
+            f.writelines(lines)
+            try:
+                with open(day_file, 'rb') as existing:
+                    shutil.copyfileobj(existing, f)
+            except FileNotFoundError:
+                pass
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, day_file)
+    
+    for legacy_file in legacy_files:
+        if legacy_file.exists():
+            legacy_file.unlink()
+            logger.info(f"Журнал {legacy_file.name} разнесен по дням: {len(payloads)} дн.")
+
+def _remove_stale_electricity_data(cutoff: date) -> int:
+    """Удаляет дневные журналы текущих данных старше cutoff (вызывается под блокировкой)"""
+    removed = 0
+    for path in ELECTRICITY_DATA_DIR.glob(ELECTRICITY_DATA_PATTERN):
+        try:
+            day = date.fromisoformat(path.stem)
+        except ValueError:
+            continue
+        if day < cutoff:
+            _close_electricity_log(path.name)
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+def cleanup_old_electricity_data(days_to_keep: int = ELECTRICITY_DATA_KEEP_DAYS) -> int:
+    """Удаляет журналы текущих данных за дни старше days_to_keep"""
+    with _electricity_log_lock:
+        return _remove_stale_electricity_data(date.today() - timedelta(days=days_to_keep))
+
+def _append_electricity_records(records: List[Dict]):
+    """Дописывает записи в журналы текущих данных (JSONL) и синхронизации (msgpack)"""
+    global _electricity_current_day, _electricity_counts, _electricity_unsynced, _electricity_last_fsync
+    # Текущие данные разбиты по дням: устаревший день удаляется целиком, без перезаписи
+    payloads: Dict[str, List[bytes]] = {}
+    for record in records:
+        payloads.setdefault(record["ts"][:10], []).append(orjson.dumps(record, default=str) + b"\n")
+    # Журнал синхронизации внутренний, поэтому хранится в компактном бинарном виде
+    history_payload = b"".join(msgpack.packb(record, use_bin_type=True, default=str) for record in records)
+    
+    with _electricity_log_lock:
+        if _electricity_counts is None:
+            _migrate_legacy_electricity_data()
+            # Журнал синхронизации пересчитываем один раз, дальше счетчики ведутся при записи
+            _electricity_counts = {
+                "current_count": 0,
+                "pending_count": sum(1 for _ in _iter_msgpack(ELECTRICITY_DATA_DIR / ELECTRICITY_HISTORY_FILE))
             }
         
-        # Создаем запись
-        record = {
-            "timestamp": current_time.isoformat(),
-            "device_id": device_id,
-            "device_name": device_name,
-            "location": location,
-            "power_w": power_w,
-            "energy_kwh": energy_kwh,
-            "is_on": is_on,
-            "voltage": voltage,
-            "current": current
-        }
+        handles = [_electricity_log(f"{day}.jsonl") for day in payloads]
+        for handle, lines in zip(handles, payloads.values()):
+            handle.write(b"".join(lines))
+            handle.flush()
+        history_handle = _electricity_log(ELECTRICITY_HISTORY_FILE)
+        history_handle.write(history_payload)
+        history_handle.flush()
+        handles.append(history_handle)
+        _electricity_counts["pending_count"] += len(records)
         
-        # Добавляем запись
-        data["records"].append(record)
-        data["last_update"] = current_time.isoformat()
-        data["total_records"] = len(data["records"])
+        # fsync объединяем: раз в ELECTRICITY_FSYNC_EVERY записей или ELECTRICITY_FSYNC_INTERVAL секунд
+        _electricity_unsynced += len(records)
+        now = time.monotonic()
+        if (_electricity_unsynced >= ELECTRICITY_FSYNC_EVERY
+                or now - _electricity_last_fsync >= ELECTRICITY_FSYNC_INTERVAL):
+            for handle in handles:
+                os.fsync(handle.fileno())
+            _electricity_unsynced = 0
+            _electricity_last_fsync = now
         
-        # Ограничиваем количество записей (храним последние 1000)
-        max_records = 1000
-        if len(data["records"]) > max_records:
-            data["records"] = data["records"][-max_records:]
-            data["total_records"] = len(data["records"])
+        # Журнал синхронизации растет, пока данные не выгружены; крупный журнал сжимаем
+        if history_handle.tell() > ELECTRICITY_HISTORY_ROTATE_BYTES:
+            _rotate_electricity_history()
         
-        # Сохраняем в файл
-        with open(current_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False, default=str)
-        
-        # Добавляем в исторические данные для синхронизации
-        history_file = data_dir / ELECTRICITY_HISTORY_FILE
-        if history_file.exists():
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
+        # При смене дня удаляем устаревшие журналы; прошедшие дни вытеснит LRU
+        latest_day = max(payloads)
+        if latest_day == _electricity_current_day:
+            _electricity_counts["current_count"] += len(payloads[latest_day])
         else:
-            history = {
-                "last_sync": current_time.isoformat(),
-                "pending_records": [],
-                "total_pending": 0
-            }
+            _electricity_current_day = latest_day
+            _electricity_counts["day"] = latest_day
+            _electricity_counts["current_count"] = sum(
+                1 for _ in _iter_jsonl(ELECTRICITY_DATA_DIR / f"{latest_day}.jsonl")
+            )
+            _remove_stale_electricity_data(
+                date.fromisoformat(latest_day) - timedelta(days=ELECTRICITY_DATA_KEEP_DAYS)
+            )
         
-        history["pending_records"].append(record)
-        history["total_pending"] = len(history["pending_records"])
+        # Время последнего обновления хранится рядом и заменяется атомарно
+        last_update_file = ELECTRICITY_DATA_DIR / ELECTRICITY_LAST_UPDATE_FILE
+        temp_file = last_update_file.with_suffix('.tmp')
+        temp_file.write_text(records[-1]["ts"], encoding='utf-8')
+        os.replace(temp_file, last_update_file)
+        _write_electricity_meta()
+
+# Записи копятся в очереди и сбрасываются на диск пакетами фоновым потоком
+_record_sink = queue.SimpleQueue()
+_record_sink_thread = None
+_record_sink_lock = Lock()
+
+def _record_sink_worker():
+    """Сбрасывает накопленные записи раз в ELECTRICITY_BATCH_INTERVAL или по заполнению пакета"""
+    while True:
+        batch = []
+        flush_events = []
+        item = _record_sink.get()
+        deadline = time.monotonic() + ELECTRICITY_BATCH_INTERVAL
+        while True:
+            if isinstance(item, threading.Event):
+                flush_events.append(item)
+                break
+            batch.append(item)
+            if len(batch) >= ELECTRICITY_BATCH_SIZE:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _record_sink.get(timeout=remaining)
+            except queue.Empty:
+                break
         
-        with open(history_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=2, ensure_ascii=False, default=str)
+        if batch:
+            try:
+                _append_electricity_records(batch)
+            except Exception as e:
+                logger.error(f"Ошибка записи пакета данных электричества: {e}")
+        for event in flush_events:
+            event.set()
+
+def _ensure_record_sink():
+    """Запускает фоновый поток записи при первом использовании"""
+    global _record_sink_thread
+    if _record_sink_thread is None:
+        with _record_sink_lock:
+            if _record_sink_thread is None:
+                _record_sink_thread = threading.Thread(
+                    target=_record_sink_worker, name="electricity-sink", daemon=True
+                )
+                _record_sink_thread.start()
+
+def flush_sink(timeout: Optional[float] = None) -> bool:
+    """Дожидается записи на диск всех поставленных в очередь записей"""
+    if _record_sink_thread is None:
+        return True
+    done = threading.Event()
+    _record_sink.put(done)
+    return done.wait(timeout)
+
+# atexit вызывает обработчики в обратном порядке: сначала очередь, затем закрытие журналов
+atexit.register(_close_electricity_logs)
+atexit.register(flush_sink, 10)
+
+# Описание устройства хранится один раз в blobs/ по sha256, а записи ссылаются на него
+_device_blob_cache: Dict[Tuple[str, str, str], str] = {}
+_device_blob_lookup: Dict[str, Dict] = {}
+
+def _device_blob_path(digest: str) -> Path:
+    return ELECTRICITY_BLOBS_DIR / digest[:2] / digest[2:4] / f"{digest}.json"
+
+def _device_blob_ref(device_id: str, device_name: str, location: str) -> str:
+    """Возвращает ссылку sha256 на описание устройства, при первом обращении записывая его"""
+    key = (device_id, device_name, location)
+    ref = _device_blob_cache.get(key)
+    if ref is None:
+        device = {"device_id": device_id, "device_name": device_name, "location": location}
+        blob = orjson.dumps(device, option=orjson.OPT_SORT_KEYS)
+        digest = hashlib.sha256(blob).hexdigest()
+        path = _device_blob_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = path.with_suffix('.tmp')
+            temp_file.write_bytes(blob)
+            os.replace(temp_file, path)
+        ref = f"sha256:{digest}"
+        _device_blob_lookup[ref] = device
+        _device_blob_cache[key] = ref
+    return ref
+
+def _device_for_ref(ref: str) -> Dict:
+    """Возвращает описание устройства по ссылке sha256"""
+    device = _device_blob_lookup.get(ref)
+    if device is None:
+        device = _device_blob_lookup[ref] = orjson.loads(
+            _device_blob_path(ref.split(":", 1)[1]).read_bytes()
+        )
+    return device
+
+def resolve_record(record: Dict) -> Dict:
+    """Разворачивает компактную запись журнала с ссылкой на устройство в полную форму"""
+    ref = record.get("dev")
+    if ref is None:
+        return record  # запись в старом формате
+    device = _device_for_ref(ref)
+    return {
+        "timestamp": record["ts"],
+        **device,
+        "power_w": record["p"],
+        "energy_kwh": record["e"],
+        "is_on": record["on"],
+        "voltage": record.get("v"),
+        "current": record.get("i")
+    }
+
+# Имена полей полной записи и их ключи в компактной записи журнала
+_RECORD_FIELD_KEYS = {
+    "timestamp": "ts",
+    "power_w": "p",
+    "energy_kwh": "e",
+    "is_on": "on",
+    "voltage": "v",
+    "current": "i"
+}
+
+def iter_records(path: Path, fields: Tuple[str, ...] = ("timestamp", "power_w", "energy_kwh")):
+    """Выдает из журнала только запрошенные поля записей"""
+    compact = [(name, _RECORD_FIELD_KEYS.get(name)) for name in fields]
+    needs_device = any(key is None for _, key in compact)
+    for record in _iter_log(path):
+        if needs_device or "dev" not in record:
+            record = resolve_record(record)
+            yield {name: record.get(name) for name in fields}
+        else:
+            yield {name: record.get(key) for name, key in compact}
+
+def load_numeric_columns(path: Path) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Загружает из журнала столбцы: устройства, индекс устройства, мощность и энергию записей"""
+    device_index: Dict[str, int] = {}
+    device_idx, power_w, energy_kwh = [], [], []
+    for record in _iter_log(path):
+        ref = record.get("dev")
+        if ref is None:  # запись в старом формате
+            ref, power, energy = record["device_id"], record.get("power_w"), record.get("energy_kwh")
+        else:
+            power, energy = record.get("p"), record.get("e")
+        device_idx.append(device_index.setdefault(ref, len(device_index)))
+        power_w.append(np.nan if power is None else power)
+        energy_kwh.append(np.nan if energy is None else energy)
+    
+    device_ids = [_device_for_ref(ref)["device_id"] if ref.startswith("sha256:") else ref
+                  for ref in device_index]
+    return (device_ids,
+            np.array(device_idx, dtype=np.intp),
+            np.array(power_w, dtype=np.float64),
+            np.array(energy_kwh, dtype=np.float64))
+
+def device_energy_totals(path: Path) -> Dict[str, float]:
+    """Суммирует энергию по устройствам одним векторным проходом np.bincount"""
+    device_ids, device_idx, _, energy_kwh = load_numeric_columns(path)
+    totals = np.bincount(device_idx, weights=np.nan_to_num(energy_kwh), minlength=len(device_ids))
+    
+    # Разные описания одного устройства (например, после переименования) складываем
+    result: Dict[str, float] = {}
+    for device_id, total in zip(device_ids, totals.tolist()):
+        result[device_id] = result.get(device_id, 0.0) + total
+    return result
+
+def save_electricity_data(device_id: str, device_name: str, location: str, 
+                         power_w: float, energy_kwh: float, is_on: bool, 
+                         voltage: Optional[float] = None, current: Optional[float] = None,
+                         timestamp: Optional[datetime] = None):
+    """Ставит данные о потреблении электричества в очередь на запись в JSONL журналы"""
+    try:
+        record = {
+            "ts": (timestamp or datetime.now()).isoformat(),
+            "dev": _device_blob_ref(device_id, device_name, location),
+            "p": power_w,
+            "e": energy_kwh,
+            "on": is_on,
+            "v": voltage,
+            "i": current
+        }
+        
+        _ensure_record_sink()
+        _record_sink.put(record)
         
-        logger.debug(f"Данные электричества сохранены для {device_name}")
+        logger.debug(f"Данные электричества поставлены в очередь для {device_name}")
         
     except Exception as e:
         logger.error(f"Ошибка сохранения данных электричества: {e}")
 
+def _claim_pending_electricity() -> List[Path]:
+    """Переносит журнал синхронизации в файл .syncing и возвращает его вместе со сжатыми сегментами"""
+    history_file = ELECTRICITY_DATA_DIR / ELECTRICITY_HISTORY_FILE
+    syncing_file = ELECTRICITY_DATA_DIR / ELECTRICITY_SYNCING_FILE
+    flush_sink()
+    with _electricity_log_lock:
+        _close_electricity_log(ELECTRICITY_HISTORY_FILE)
+        try:
+            if syncing_file.exists():
+                # Остаток после неудачной синхронизации дополняем новыми записями
+                with open(history_file, 'rb') as src, open(syncing_file, 'ab') as dst:
+                    dst.write(src.read())
+                history_file.unlink()
+            else:
+                os.replace(history_file, syncing_file)
+        except FileNotFoundError:
+            pass
+        else:
+            if _electricity_counts is not None:
+                _electricity_counts["pending_count"] = 0
+                _write_electricity_meta()
+        segments = sorted(ELECTRICITY_DATA_DIR.glob(ELECTRICITY_HISTORY_SEGMENTS))
+    legacy = [path for pattern in ELECTRICITY_LEGACY_HISTORY
+              for path in sorted(ELECTRICITY_DATA_DIR.glob(pattern))]
+    return legacy + segments + [syncing_file]
+
 def sync_electricity_to_supabase():
     """Синхронизирует данные электричества с Supabase"""
     try:
-        data_dir = Path("electricity_data")
-        history_file = data_dir / ELECTRICITY_HISTORY_FILE
+        pending_files = _claim_pending_electricity()
         
-        if not history_file.exists():
-            logger.info("Файл истории электричества не найден")
-            return
-        
-        with open(history_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        pending_records = history.get("pending_records", [])
+        # Записи читаем потоком и сразу сворачиваем в сессии по устройствам:
+        # память зависит от числа устройств, а не от объема истории
+        device_sessions = {}
+        pending_count = 0
+        for pending_file in pending_files:
+            # Для сессий нужны только устройство, время и энергия
+            for record in iter_records(pending_file, ("timestamp", "device_id", "energy_kwh")):
+                pending_count += 1
+                timestamp = record["timestamp"]
+                session = device_sessions.get(record["device_id"])
+                if session is None:
+                    device_sessions[record["device_id"]] = {
+                        "start": timestamp, "end": timestamp, "energy_kwh": record["energy_kwh"]
+                    }
+                else:
+                    session["start"] = min(session["start"], timestamp)
+                    session["end"] = max(session["end"], timestamp)
+                    session["energy_kwh"] += record["energy_kwh"]
         
-        if not pending_records:
+        if not pending_count:
             logger.info("Нет данных электричества для синхронизации")
             return
         
-        logger.info(f"Синхронизация {len(pending_records)} записей электричества с Supabase...")
-        
-        # Группируем записи по устройствам для создания сессий
-        device_sessions = {}
-        
-        for record in pending_records:
-            device_id = record["device_id"]
-            if device_id not in device_sessions:
-                device_sessions[device_id] = []
-            device_sessions[device_id].append(record)
+        logger.info(f"Синхронизация {pending_count} записей электричества с Supabase...")
         
         # Создаем сессии для каждого устройства
         synced_count = 0
-        for device_id, records in device_sessions.items():
+        for device_id, session in device_sessions.items():
             try:
-                # Сортируем записи по времени
-                sorted_records = sorted(records, key=lambda x: x["timestamp"])
-                
                 # Находим информацию об устройстве
-                device_info = next((d for d in DEVICES if d["device_id"] == device_id), None)
+                device_info = DEVICE_BY_ID.get(device_id)
                 if not device_info:
                     logger.warning(f"Информация об устройстве {device_id} не найдена")
                     continue
                 
                 location = device_info["location"]
                 
-                # Создаем сессии на основе временных интервалов
-                if sorted_records:
-                    first_record = sorted_records[0]
-                    last_record = sorted_records[-1]
-                    
-                    # Рассчитываем общую энергию
-                    total_energy = sum(r["energy_kwh"] for r in sorted_records)
-                    
-                    # Создаем сессию
-                    session_data = {
-                        "miner_device_id": device_id,
-                        "miner_location": location,
-                        "session_start_time": first_record["timestamp"],
-                        "session_end_time": last_record["timestamp"],
-                        "energy_kwh": total_energy,
-                        "cost_rub": 0.0,  # Будет рассчитано позже
-                        "tariff_type": "day_night",
-                        "day_energy_kwh": 0.0,  # Будет рассчитано позже
-                        "night_energy_kwh": 0.0  # Будет рассчитано позже
-                    }
-                    
-                    # Сохраняем сессию в Supabase
-                    response = supabase.table("miner_energy_sessions").insert(session_data).execute()
-                    if response.data:
-                        synced_count += 1
-                        logger.debug(f"Сессия электричества синхронизирована: {device_id}")
-                    else:
-                        logger.warning(f"Пустой ответ при сохранении сессии электричества: {device_id}")
+                # Создаем сессию
+                session_data = {
+                    "miner_device_id": device_id,
+                    "miner_location": location,
+                    "session_start_time": session["start"],
+                    "session_end_time": session["end"],
+                    "energy_kwh": session["energy_kwh"],
+                    "cost_rub": 0.0,  # Будет рассчитано позже
+                    "tariff_type": "day_night",
+                    "day_energy_kwh": 0.0,  # Будет рассчитано позже
+                    "night_energy_kwh": 0.0  # Будет рассчитано позже
+                }
                 
+                # Сохраняем сессию в Supabase
+                response = supabase.table("miner_energy_sessions").insert(session_data).execute()
+                if response.data:
+                    synced_count += 1
+                    logger.debug(f"Сессия электричества синхронизирована: {device_id}")
+                else:
+                    logger.warning(f"Пустой ответ при сохранении сессии электричества: {device_id}")
+            
             except Exception as e:
                 logger.error(f"Ошибка обработки сессий электричества для устройства {device_id}: {e}")
         
         # Очищаем синхронизированные записи
         if synced_count > 0:
-            history["pending_records"] = []
-            history["total_pending"] = 0
-            history["last_sync"] = datetime.now().isoformat()
-            
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, indent=2, ensure_ascii=False, default=str)
+            for pending_file in pending_files:
+                pending_file.unlink(missing_ok=True)
             
             logger.info(f"Успешно синхронизировано {synced_count} сессий электричества с Supabase")
         else:
@@ -465,14 +942,17 @@ class APIRateLimiter:
         self.request_timestamps = []
         self.lock = Lock()
 
+    def _reset_if_new_day(self):
+        """Сброс счетчика в начале нового дня (вызывается под self.lock)"""
+        if datetime.now().date() != self.last_reset:
+            self.requests_today = 0
+            self.last_reset = datetime.now().date()
+            self.request_timestamps = []
+
     def can_make_request(self):
         """Проверить, можно ли сделать запрос к API"""
         with self.lock:
-            # Сброс счетчика в начале нового дня
-            if datetime.now().date() != self.last_reset:
-                self.requests_today = 0
-                self.last_reset = datetime.now().date()
-                self.request_timestamps = []
+            self._reset_if_new_day()
 
             # Проверка дневного лимита
             if self.requests_today >= self.max_requests_per_day:
@@ -497,6 +977,7 @@ class APIRateLimiter:
     def get_status(self):
         """Получить текущий статус использования API"""
         with self.lock:
+            self._reset_if_new_day()
             now = time.time()
             recent_requests = len([ts for ts in self.request_timestamps if now - ts < 1.0])
             return {
@@ -511,6 +992,40 @@ class APIRateLimiter:
 api_limiter = APIRateLimiter()
 
 
+class TelegramSendLimiter:
+    """Ограничение частоты исходящих сообщений Telegram (token bucket)"""
+
+    def __init__(self, max_rate=25, time_period=1.0):
+        self.max_rate = max_rate
+        self.interval = time_period / max_rate
+        self.tokens = float(max_rate)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться свободного слота для отправки сообщения"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.updated) / self.interval)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.interval)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+# Общий лимитер отправки: Telegram допускает ~30 сообщений в секунду на бота
+send_limiter = TelegramSendLimiter(max_rate=25, time_period=1.0)
+
+
 # Кэширование данных
 class DataCache:
     """Класс для кэширования данных энергопотребления"""
@@ -544,6 +1059,10 @@ class DataCache:
 
 # Инициализация кэша
 data_cache = DataCache()
+# Кэш статистики энергопотребления из Tuya Cloud (отдельно, чтобы его можно было сбросить)
+energy_stats_cache = DataCache()
+# Кэш полного списка устройств для /list_devices (сбрасывается при изменениях)
+devices_list_cache = DataCache(cache_duration_hours=30 / 3600)
 
 
 def rate_limit(func):
@@ -560,6 +1079,31 @@ def rate_limit(func):
     return wrapper
 
 
+def ttl_cache(seconds: float):
+    """Декоратор для кратковременного кэширования результатов (повторные команды не опрашивают API заново)"""
+
+    def decorator(func):
+        cache = DataCache(cache_duration_hours=seconds / 3600)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            cached_data = cache.get(key)
+            if cached_data is not None:
+                logger.debug(f"Используется кэшированный результат {func.__name__}")
+                return cached_data
+            result = func(*args, **kwargs)
+            # Пустые результаты (ошибки, нет данных) не кэшируем
+            if result:
+                cache.set(key, result)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
 def get_device_status_cloud_enhanced(device_id: str) -> Tuple[bool, float, Optional[dict]]:
     """Расширенная функция получения статуса устройства с попыткой получить DPS 17"""
     logger.debug(f"Запрос статуса устройства {device_id}")
@@ -596,102 +1140,158 @@ def get_device_status_cloud_enhanced(device_id: str) -> Tuple[bool, float, Optio
 
     status = _make_request()
     if status and status.get('success'):
-        result = status.get('result', [])
-        is_on = False
-        counter = 0.0
-        cur_power = None
-        cur_voltage = None
-        cur_current = None
-        add_ele = 0.0  # DPS 17 - добавленное потребление энергии
-        device_data = {}
-
-        # Проверяем формат данных и обрабатываем правильно
-        for item in result:
-            # Проверяем, является ли элемент словарем
-            if isinstance(item, dict):
-                code = item.get('code')
-                value = item.get('value')
-            elif isinstance(item, str):
-                # Если элемент - строка, пропускаем его
-                continue
-            else:
-                # Неизвестный формат, пропускаем
-                continue
+        return _parse_device_status(device_id, status.get('result', []))
+    else:
+        logger.error(f"Ошибка получения статуса устройства {device_id}: {status}")
+        return False, 0.0, None
 
-            if code is None or value is None:
-                continue
 
-            device_data[code] = value
-
-            if code == 'switch':
-                is_on = value
-            elif code == 'add_ele':
-                counter = float(value)
-            elif code == '17':  # DPS 17 - добавленное потребление энергии
-                add_ele = float(value)
-                device_data['add_ele'] = add_ele
-            elif code == 'cur_power':
-                cur_power = value
-            elif code == 'cur_voltage':
-                cur_voltage = value
-            elif code == 'cur_current':
-                cur_current = value
-
-        # Если есть DPS 17, используем его как более точный счетчик
-        if add_ele > 0:
-            counter = add_ele
-
-        # Корректировка значений согласно информации из GitHub issues
-        if cur_power is not None:
-            try:
-                cur_power = float(cur_power)
-                if cur_power > 100:
-                    cur_power = cur_power / 10
-                device_data['cur_power'] = cur_power
-            except (ValueError, TypeError):
-                cur_power = None
-
-        if cur_voltage is not None:
-            try:
-                cur_voltage = float(cur_voltage)
-                if cur_voltage > 1000:
-                    cur_voltage = cur_voltage / 10
-                device_data['cur_voltage'] = cur_voltage
-            except (ValueError, TypeError):
-                cur_voltage = None
-
-        if cur_current is not None:
-            try:
-                cur_current = float(cur_current)
-                cur_current = cur_current / 1000
-                device_data['cur_current'] = cur_current
-            except (ValueError, TypeError):
-                cur_current = None
+def _parse_device_status(device_id: str, result: list,
+                         cache_key: Optional[str] = None) -> Tuple[bool, float, dict]:
+    """Разбирает список DPS устройства из ответа Tuya Cloud и сохраняет результат в кэш (по умолчанию device_status_<id>)"""
+    is_on = False
+    counter = 0.0
+    cur_power = None
+    cur_voltage = None
+    cur_current = None
+    add_ele = 0.0  # DPS 17 - добавленное потребление энергии
+    device_data = {}
+
+    # Проверяем формат данных и обрабатываем правильно
+    for item in result:
+        # Проверяем, является ли элемент словарем
+        if isinstance(item, dict):
+            code = item.get('code')
+            value = item.get('value')
+        elif isinstance(item, str):
+            # Если элемент - строка, пропускаем его
+            continue
+        else:
+            # Неизвестный формат, пропускаем
+            continue
+
+        if code is None or value is None:
+            continue
+
+        device_data[code] = value
+
+        if code == 'switch':
+            is_on = value
+        elif code == 'add_ele':
+            counter = float(value)
+        elif code == '17':  # DPS 17 - добавленное потребление энергии
+            add_ele = float(value)
+            device_data['add_ele'] = add_ele
+        elif code == 'cur_power':
+            cur_power = value
+        elif code == 'cur_voltage':
+            cur_voltage = value
+        elif code == 'cur_current':
+            cur_current = value
+
+    # Если есть DPS 17, используем его как более точный счетчик
+    if add_ele > 0:
+        counter = add_ele
+
+    # Корректировка значений согласно информации из GitHub issues
+    if cur_power is not None:
+        try:
+            cur_power = float(cur_power)
+            if cur_power > 100:
+                cur_power = cur_power / 10
+            device_data['cur_power'] = cur_power
+        except (ValueError, TypeError):
+            cur_power = None
+
+    if cur_voltage is not None:
+        try:
+            cur_voltage = float(cur_voltage)
+            if cur_voltage > 1000:
+                cur_voltage = cur_voltage / 10
+            device_data['cur_voltage'] = cur_voltage
+        except (ValueError, TypeError):
+            cur_voltage = None
+
+    if cur_current is not None:
+        try:
+            cur_current = float(cur_current)
+            cur_current = cur_current / 1000
+            device_data['cur_current'] = cur_current
+        except (ValueError, TypeError):
+            cur_current = None
 
-        # Дополнительная проверка: если есть мощность, устройство включено
-        if cur_power is not None and cur_power > 0:
-            is_on = True
+    # Дополнительная проверка: если есть мощность, устройство включено
+    if cur_power is not None and cur_power > 0:
+        is_on = True
 
-        result_data = (is_on, counter, device_data)
+    result_data = (is_on, counter, device_data)
 
-        # Сохраняем в кэш
-        data_cache.set(cache_key, result_data)
+    # Сохраняем в кэш
+    data_cache.set(cache_key or f"device_status_{device_id}", result_data)
 
-        logger.info(f"Устройство {device_id}: состояние={'ВКЛ' if is_on else 'ВЫКЛ'}, "
-                    f"счетчик={counter:.3f} кВт·ч, мощность={cur_power} Вт")
-        return result_data
-    else:
-        logger.error(f"Ошибка получения статуса устройства {device_id}: {status}")
-        return False, 0.0, None
+    logger.info(f"Устройство {device_id}: состояние={'ВКЛ' if is_on else 'ВЫКЛ'}, "
+                f"счетчик={counter:.3f} кВт·ч, мощность={cur_power} Вт")
+    return result_data
+
+
+@rate_limit
+def _request_device_statuses_batch(device_ids: List[str]) -> Optional[dict]:
+    """Запрашивает статусы нескольких устройств одним запросом к Tuya Cloud"""
+    try:
+        return tuya_cloud.cloudrequest(
+            '/v1.0/iot-03/devices/status',
+            query={'device_ids': ','.join(device_ids)}
+        )
+    except Exception as e:
+        logger.error(f"Ошибка пакетного запроса статуса устройств: {e}")
+        return None
 
 
-def get_device_energy_stats_cloud(device_id: str, start_time: datetime, end_time: datetime) -> Dict:
-    """Получает статистику энергопотребления устройства через Tuya Cloud API"""
+def get_device_statuses_batch(device_ids: List[str]) -> Dict[str, Tuple[bool, float, Optional[dict]]]:
+    """
+    Получает статусы нескольких устройств. Некэшированные устройства запрашиваются
+    одним пакетным запросом; для устройств, отсутствующих в ответе, выполняется
+    обычный запрос по одному устройству
+    """
+    statuses = {}
+    missing_ids = []
+    for device_id in device_ids:
+        # Полный статус (с DPS из getdps) подходит и здесь; результат пакетного запроса
+        # неполный, поэтому хранится под своим ключом и не подменяет полный статус
+        cached_data = (data_cache.get(f"device_status_{device_id}")
+                       or data_cache.get(f"device_status_batch_{device_id}"))
+        if cached_data:
+            statuses[device_id] = cached_data
+        else:
+            missing_ids.append(device_id)
+
+    if missing_ids:
+        response = _request_device_statuses_batch(missing_ids)
+        if response and response.get('success'):
+            for item in response.get('result', []):
+                device_id = item.get('id')
+                if device_id in missing_ids:
+                    statuses[device_id] = _parse_device_status(
+                        device_id, item.get('status', []), cache_key=f"device_status_batch_{device_id}"
+                    )
+        else:
+            logger.warning(f"Пакетный запрос статуса не удался, опрашиваем устройства по одному: {response}")
+
+        for device_id in missing_ids:
+            if device_id not in statuses:
+                statuses[device_id] = get_device_status_cloud_enhanced(device_id)
+
+    return statuses
+
+
+def get_device_energy_stats_cloud(device_id: str, start_time: datetime, end_time: datetime,
+                                  refresh: bool = False) -> Dict:
+    """Получает статистику энергопотребления устройства через Tuya Cloud API (refresh=True - в обход кэша)"""
     logger.debug(f"Запрос статистики энергопотребления для устройства {device_id}")
 
     # Проверяем кэш
     cache_key = f"energy_stats_{device_id}_{start_time.strftime('%Y%m%d')}_{end_time.strftime('%Y%m%d')}"
-    cached_data = data_cache.get(cache_key)
+    cached_data = None if refresh else energy_stats_cache.get(cache_key)
     if cached_data:
         logger.debug(f"Используются кэшированные данные статистики для устройства {device_id}")
         return cached_data
@@ -768,26 +1368,30 @@ def get_device_energy_stats_cloud(device_id: str, start_time: datetime, end_time
             }
 
             # Сохраняем в кэш
-            data_cache.set(cache_key, stats_data)
+            energy_stats_cache.set(cache_key, stats_data)
             return stats_data
         else:
             # Если основной метод не сработал, используем альтернативный
             logger.warning(
                 f"Основной метод получения статистики не сработал для устройства {device_id}, используем альтернативный")
-            return get_device_energy_stats_cloud_alternative(device_id, start_time, end_time)
+            return get_device_energy_stats_cloud_alternative(device_id, start_time, end_time, refresh)
     except Exception as e:
         logger.error(f"Ошибка при получении статистики устройства {device_id}: {e}")
         # В случае ошибки используем альтернативный метод
-        return get_device_energy_stats_cloud_alternative(device_id, start_time, end_time)
+        return get_device_energy_stats_cloud_alternative(device_id, start_time, end_time, refresh)
+
 
+get_device_energy_stats_cloud.cache_clear = energy_stats_cache.clear
 
-def get_device_energy_stats_cloud_alternative(device_id: str, start_time: datetime, end_time: datetime) -> Dict:
+
+def get_device_energy_stats_cloud_alternative(device_id: str, start_time: datetime, end_time: datetime,
+                                              refresh: bool = False) -> Dict:
     """Альтернативный метод получения статистики через базовые статусы"""
     logger.debug(f"Альтернативный запрос статистики для устройства {device_id}")
 
     # Проверяем кэш
     cache_key = f"energy_stats_alt_{device_id}_{start_time.strftime('%Y%m%d')}_{end_time.strftime('%Y%m%d')}"
-    cached_data = data_cache.get(cache_key)
+    cached_data = None if refresh else energy_stats_cache.get(cache_key)
     if cached_data:
         logger.debug(f"Используются кэшированные альтернативные данные для устройства {device_id}")
         return cached_data
@@ -816,7 +1420,7 @@ def get_device_energy_stats_cloud_alternative(device_id: str, start_time: dateti
         }
 
         # Сохраняем в кэш
-        data_cache.set(cache_key, stats_data)
+        energy_stats_cache.set(cache_key, stats_data)
         return stats_data
     except Exception as e:
         logger.error(f"Ошибка альтернативного запроса статистики устройства {device_id}: {e}")
@@ -1011,7 +1615,7 @@ def predict_consumption_based_on_sales(device_id: str, location: str, days: int
             return {}
 
         # Рассчитываем общий доход
-        total_income_usdt = sum(float(sale.get("total_received", 0)) for sale in sales_data)
+        total_income_usdt = math.fsum(float(sale.get("total_received", 0)) for sale in sales_data)
 
         # Получаем исторические данные о потреблении
         historical_pattern = get_historical_consumption_pattern(device_id, days)
@@ -1047,6 +1651,7 @@ def predict_consumption_based_on_sales(device_id: str, location: str, days: int
         return {}
 
 
+@ttl_cache(30)
 def get_current_power_consumption() -> Dict[str, Dict]:
     """Получает текущее потребление мощности всех устройств"""
     logger.info("Запрос текущего потребления мощности")
@@ -1184,13 +1789,14 @@ def get_72h_consumption_from_api(location: str) -> Dict[str, float]:
     }
 
 
-def estimate_profitability(current_power_w: float, location: str, device_id: str = None, days: int = 1) -> Dict[
-    str, float]:
+def estimate_profitability(current_power_w: float, location: str, device_id: str = None, days: int = 1,
+                           consumption_forecast: Dict = None) -> Dict[str, float]:
     """Рассчитывает прогнозную доходность на основе текущей мощности и исторических данных"""
     logger.debug(f"Расчет прогнозной доходности для {location}: {current_power_w} Вт за {days} дней")
 
-    # Получаем улучшенный прогноз потребления
-    consumption_forecast = enhanced_estimate_24h_consumption(current_power_w, location, device_id)
+    # Получаем улучшенный прогноз потребления (если он не был рассчитан заранее)
+    if consumption_forecast is None:
+        consumption_forecast = enhanced_estimate_24h_consumption(current_power_w, location, device_id)
 
     # Рассчитываем на указанное количество дней
     total_energy = consumption_forecast["estimated_kwh"] * days
@@ -1238,6 +1844,54 @@ def estimate_profitability(current_power_w: float, location: str, device_id: str
     return result
 
 
+# Поля прогноза, суммируемые по локациям
+FORECAST_SUM_FIELDS = ('estimated_energy_kwh', 'estimated_cost_rub', 'estimated_income_usdt',
+                       'estimated_profit_rub', 'day_energy', 'night_energy')
+
+
+def sum_forecasts(forecasts: Dict[str, Dict]) -> Dict[str, float]:
+    """Суммирует поля прогнозов по всем локациям за один проход и считает общую рентабельность"""
+    if forecasts:
+        values = np.array(
+            [[forecast[field] for field in FORECAST_SUM_FIELDS] for forecast in forecasts.values()],
+            dtype=np.float64
+        )
+        totals = dict(zip(FORECAST_SUM_FIELDS, values.sum(axis=0).tolist()))
+    else:
+        totals = {field: 0.0 for field in FORECAST_SUM_FIELDS}
+
+    total_cost = totals['estimated_cost_rub']
+    totals['profitability_percentage'] = (
+        (totals['estimated_profit_rub'] / total_cost) * 100 if total_cost > 0 else 0
+    )
+    return totals
+
+
+def build_combined_forecast(forecasts: Dict[str, Dict], period_days: int) -> Dict:
+    """Объединяет прогнозы доходности по локациям в общий прогноз за период"""
+    totals = sum_forecasts(forecasts)
+
+    # Определяем общий уровень достоверности
+    confidences = [f.get('confidence', 'medium') for f in forecasts.values()]
+    overall_confidence = 'high' if 'high' in confidences else 'medium'
+
+    # Тарифы берем из первой локации
+    first_forecast = next(iter(forecasts.values()))
+    return {
+        "period_days": period_days,
+        "estimated_energy_kwh": totals['estimated_energy_kwh'],
+        "estimated_cost_rub": totals['estimated_cost_rub'],
+        "estimated_income_usdt": totals['estimated_income_usdt'],
+        "estimated_profit_rub": totals['estimated_profit_rub'],
+        "profitability_percentage": totals['profitability_percentage'],
+        "day_energy": totals['day_energy'],
+        "night_energy": totals['night_energy'],
+        "day_rate": first_forecast['day_rate'],
+        "night_rate": first_forecast['night_rate'],
+        "confidence": overall_confidence
+    }
+
+
 def get_tariff_ranges(location: str, use_fallback: bool = False) -> List[Dict]:
     """Получает диапазоны тарифов для локации"""
     try:
@@ -1264,6 +1918,14 @@ def get_tariff_ranges(location: str, use_fallback: bool = False) -> List[Dict]:
         return []
 
 
+@lru_cache(maxsize=128)
+def resolve_tariff(location: str, use_fallback: bool = False) -> Tuple[List[Dict], str]:
+    """Диапазоны и тип тарифа локации; TARIFF_SETTINGS загружаются один раз при старте, поэтому результат кэшируется"""
+    ranges = get_tariff_ranges(location, use_fallback=use_fallback)
+    tariff_type = TARIFF_SETTINGS.get(location, {}).get("tariff_type", "single")
+    return ranges, tariff_type
+
+
 def split_session_by_zones(start_time: datetime, end_time: datetime) -> Tuple[float, float]:
     """Разделяет время сессии на дневные и ночные часы"""
     logger.debug(f"Разделение сессии на зоны: {start_time} - {end_time}")
@@ -1304,9 +1966,7 @@ def calculate_session_cost_with_ranges(
     logger.info(f"Расчет стоимости сессии: устройство={device_id}, энергия={energy_kwh:.3f} кВт·ч")
 
     # Получаем тарифные диапазоны
-    ranges = get_tariff_ranges(location, use_fallback=use_fallback_tariff)
-    location_tariff = TARIFF_SETTINGS.get(location, {})
-    tariff_type = location_tariff.get("tariff_type", "single")
+    ranges, tariff_type = resolve_tariff(location, use_fallback_tariff)
 
     # Разделяем сессию на дневные и ночные часы
     day_hours, night_hours = split_session_by_zones(start_time, end_time)
@@ -1396,8 +2056,8 @@ def calculate_session_cost(
 
     try:
         # Пробуем получить данные через API
-        location_devices = [d for d in DEVICES if d["location"] == location and d["device_id"] == device_id]
-        if location_devices:
+        device = DEVICE_BY_ID.get(device_id)
+        if device is not None and device["location"] == location:
             previous_monthly_kwh = 0
             # Получаем потребление за месяц до начала сессии
             monthly_data = get_monthly_energy_consumption(device_id, month_start.year, month_start.month)
@@ -1442,31 +2102,58 @@ def save_session(
     """Сохраняет сессию в базу данных"""
     logger.info(f"Сохранение сессии в базу данных")
 
+    session_data = build_session_row(device_id, location, start_time, end_time, energy_kwh, cost_rub,
+                                     tariff_type, day_energy, night_energy, cost_details)
+    saved = save_sessions([session_data])
+    if saved is None:
+        return None
+    logger.info(
+        f"Сессия успешно сохранена: {device_id}, энергия: {energy_kwh:.3f} кВт·ч, стоимость: {cost_rub:.2f} руб.")
+    return saved[0] if saved else None
+
+
+def build_session_row(
+        device_id: str,
+        location: str,
+        start_time: datetime,
+        end_time: datetime,
+        energy_kwh: float,
+        cost_rub: float,
+        tariff_type: str,
+        day_energy: float,
+        night_energy: float,
+        cost_details: Dict
+) -> Dict:
+    """Формирует строку таблицы miner_energy_sessions"""
+    session_data = {
+        "miner_device_id": device_id,
+        "miner_location": location,
+        "session_start_time": start_time.isoformat(),
+        "session_end_time": end_time.isoformat(),
+        "energy_kwh": energy_kwh,
+        "cost_rub": cost_rub,
+        "tariff_type": tariff_type,
+        "day_energy_kwh": day_energy,
+        "night_energy_kwh": night_energy
+    }
+
+    # Try to include cost_details if column exists
     try:
-        session_data = {
-            "miner_device_id": device_id,
-            "miner_location": location,
-            "session_start_time": start_time.isoformat(),
-            "session_end_time": end_time.isoformat(),
-            "energy_kwh": energy_kwh,
-            "cost_rub": cost_rub,
-            "tariff_type": tariff_type,
-            "day_energy_kwh": day_energy,
-            "night_energy_kwh": night_energy
-        }
+        session_data["cost_details"] = orjson.dumps(cost_details, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    except Exception as e:
+        logger.warning(f"Could not include cost_details: {e}")
+    return session_data
 
-        # Try to include cost_details if column exists
-        try:
-            session_data["cost_details"] = json.dumps(cost_details)
-        except Exception as e:
-            logger.warning(f"Could not include cost_details: {e}")
 
-        response = supabase.table("miner_energy_sessions").insert(session_data).execute()
-        logger.info(
-            f"Сессия успешно сохранена: {device_id}, энергия: {energy_kwh:.3f} кВт·ч, стоимость: {cost_rub:.2f} руб.")
-        return response.data[0] if response.data else None
+def save_sessions(rows: List[Dict]) -> Optional[List[Dict]]:
+    """Сохраняет несколько сессий одним запросом; возвращает сохраненные строки или None при ошибке"""
+    if not rows:
+        return []
+    try:
+        response = supabase.table("miner_energy_sessions").insert(rows).execute()
+        return response.data or []
     except Exception as e:
-        logger.error(f"Ошибка сохранения сессии: {e}", exc_info=True)
+        logger.error(f"Ошибка сохранения сессий ({len(rows)} шт.): {e}", exc_info=True)
         return None
 
 
@@ -1494,10 +2181,95 @@ def get_energy_data(start_date: datetime, end_date: datetime) -> List[Dict]:
         return []
 
 
+# Кэш результатов расчета доходности (обновляется каждые 10 минут)
+profitability_cache = DataCache(cache_duration_hours=10 / 60)
+
+
+def _profitability_cache_key(start_date: datetime, end_date: datetime, period_name: str) -> Tuple:
+    """Ключ кэша доходности: границы скользящих периодов округляются до часа,
+    чтобы повторные команды в течение часа попадали в один слот кэша"""
+    hour = {'minute': 0, 'second': 0, 'microsecond': 0}
+    return start_date.replace(**hour), end_date.replace(**hour), period_name
+
+
 def calculate_profitability_for_period(
         start_date: datetime,
         end_date: datetime,
         period_name: str
+) -> Dict:
+    """Рассчитывает доходность за указанный период с кэшированием результатов"""
+    cache_key = _profitability_cache_key(start_date, end_date, period_name)
+    cached_data = profitability_cache.get(cache_key)
+    if cached_data:
+        logger.debug(f"Используются кэшированные данные доходности за период {period_name}")
+        return cached_data
+
+    result = _calculate_profitability_for_period(start_date, end_date, period_name)
+    if result:
+        profitability_cache.set(cache_key, result)
+    return result
+
+
+def _parse_db_timestamp(value: str) -> datetime:
+    """Преобразует отметку времени из Supabase в наивный datetime (UTC)"""
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        return dt
+    # Отметку со смещением (например, +03:00) приводим к UTC, а не просто отбрасываем пояс
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def calculate_profitability_multi(end_date: datetime, periods: List[Tuple[int, str]]) -> List[Dict]:
+    """
+    Рассчитывает доходность сразу за несколько периодов, заканчивающихся в end_date.
+    Продажи и сессии потребления запрашиваются один раз за самый длинный период,
+    а более короткие периоды получаются фильтрацией уже загруженных записей.
+    periods - список пар (количество дней, название периода)
+    """
+    results = [None] * len(periods)
+    missing = []
+    for index, (days, period_name) in enumerate(periods):
+        start_date = end_date - timedelta(days=days)
+        cache_key = _profitability_cache_key(start_date, end_date, period_name)
+        cached_data = profitability_cache.get(cache_key)
+        if cached_data:
+            results[index] = cached_data
+        else:
+            missing.append((index, start_date, period_name, cache_key))
+
+    if missing:
+        widest_start = min(start_date for _, start_date, _, _ in missing)
+        all_sales = get_sales_data(widest_start, end_date)
+        all_energy = get_energy_data(widest_start, end_date)
+        try:
+            sales_times = [_parse_db_timestamp(sale["executed_at"]) for sale in all_sales]
+            energy_times = [_parse_db_timestamp(session["session_start_time"]) for session in all_energy]
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Не удалось разобрать даты записей, периоды будут запрошены по отдельности: {e}")
+            sales_times = energy_times = None
+
+        for index, start_date, period_name, cache_key in missing:
+            if sales_times is None:
+                result = _calculate_profitability_for_period(start_date, end_date, period_name)
+            else:
+                result = _calculate_profitability_for_period(
+                    start_date, end_date, period_name,
+                    sales_data=[sale for sale, ts in zip(all_sales, sales_times) if ts >= start_date],
+                    energy_data=[session for session, ts in zip(all_energy, energy_times) if ts >= start_date]
+                )
+            if result:
+                profitability_cache.set(cache_key, result)
+            results[index] = result
+
+    return results
+
+
+def _calculate_profitability_for_period(
+        start_date: datetime,
+        end_date: datetime,
+        period_name: str,
+        sales_data: List[Dict] = None,
+        energy_data: List[Dict] = None
 ) -> Dict:
     """Рассчитывает доходность за указанный период с учетом курса валют"""
     logger.info(f"Расчет доходности за период {period_name}: {start_date} - {end_date}")
@@ -1507,11 +2279,13 @@ def calculate_profitability_for_period(
         exchange_rate = ExchangeRateManager.get_usdt_rub_rate()
         rate_info = ExchangeRateManager.get_rate_info()
 
-        # Получаем данные о продажах за период
-        sales_data = get_sales_data(start_date, end_date)
+        # Получаем данные о продажах за период (если они не переданы заранее)
+        if sales_data is None:
+            sales_data = get_sales_data(start_date, end_date)
 
         # Получаем данные о потреблении электроэнергии за период
-        energy_data = get_energy_data(start_date, end_date)
+        if energy_data is None:
+            energy_data = get_energy_data(start_date, end_date)
 
         # Рассчитываем общий доход от продаж в RUB
         total_income_usdt = 0.0
@@ -1631,7 +2405,106 @@ def calculate_profitability_for_period(
         return {}
 
 
-def calculate_daily_profitability(date: datetime = None):
+def _daily_profit_row(profitability_data: Dict, date) -> Dict:
+    """Формирует запись для таблицы дневной доходности"""
+    return {
+        "calculation_date": date.isoformat(),
+        "total_income_rub": profitability_data["total_income_rub"],
+        "total_cost_rub": profitability_data["total_cost"],
+        "net_profit_rub": profitability_data["net_profit"],
+        "profitability_percentage": profitability_data["profitability_percentage"],
+        "sales_count": profitability_data["sales_count"],
+        "energy_sessions_count": profitability_data["energy_sessions_count"]
+    }
+
+
+def _period_profit_row(period_data: Dict, start_date: datetime, end_date: datetime) -> Dict:
+    """Формирует запись для таблиц доходности за период (3 дня, неделя, месяц)"""
+    return {
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "total_income_rub": period_data["total_income_rub"],
+        "total_cost_rub": period_data["total_cost"],
+        "net_profit_rub": period_data["net_profit"],
+        "profitability_percentage": period_data["profitability_percentage"],
+        "avg_daily_income": period_data["avg_daily_income"],
+        "avg_daily_cost": period_data["avg_daily_cost"],
+        "avg_daily_profit": period_data["avg_daily_profit"],
+        "sales_count": period_data["sales_count"],
+        "energy_sessions_count": period_data["energy_sessions_count"]
+    }
+
+
+def _save_daily_profitability(rows: List[Dict]):
+    """Сохраняет записи дневной доходности одним UPSERT"""
+    supabase.table("miner_daily_profitability").upsert(
+        rows,
+        on_conflict="calculation_date"
+    ).execute()
+
+
+def _save_weekly_profitability(rows: List[Dict]):
+    """Сохраняет записи недельной доходности"""
+    # Используем insert/update вместо upsert для избежания ошибки с ограничением
+    try:
+        # Сначала одним запросом проверяем, какие недели уже записаны
+        start_dates = [row["start_date"] for row in rows]
+        existing_records = supabase.table("miner_weekly_profitability").select("start_date").in_(
+            "start_date", start_dates).execute()
+        # База возвращает даты в своем формате (со смещением или без времени),
+        # поэтому сравниваем разобранные значения, а не строки
+        existing_dates = {_parse_db_timestamp(record["start_date"]) for record in existing_records.data or []}
+
+        new_rows = []
+        for row in rows:
+            if _parse_db_timestamp(row["start_date"]) in existing_dates:
+                # Если запись существует, обновляем ее
+                supabase.table("miner_weekly_profitability").update(
+                    row
+                ).eq("start_date", row["start_date"]).execute()
+            else:
+                new_rows.append(row)
+
+        if new_rows:
+            # Все новые записи вставляем одним запросом
+            supabase.table("miner_weekly_profitability").insert(
+                new_rows
+            ).execute()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения недельной доходности: {e}")
+
+
+def _save_monthly_profitability(rows: List[Dict]):
+    """Сохраняет записи месячной доходности одним UPSERT"""
+    supabase.table("miner_monthly_profitability").upsert(
+        rows,
+        on_conflict="start_date"
+    ).execute()
+
+
+def _save_3day_profitability(rows: List[Dict]):
+    """Сохраняет записи 3-дневной доходности одним UPSERT"""
+    # Пытаемся сохранить данные, но продолжаем работу даже если не получится
+    try:
+        response = supabase.table("miner_3day_profitability").upsert(
+            rows,
+            on_conflict="start_date"
+        ).execute()
+        if response.data:
+            logger.info(f"3-дневная доходность успешно сохранена ({len(rows)} записей)")
+        else:
+            logger.warning(f"Не удалось сохранить 3-дневную доходность: пустой ответ")
+    except Exception as e:
+        error_msg = str(e).lower()
+        if "404" in error_msg or "not found" in error_msg:
+            logger.warning(f"Таблица miner_3day_profitability не найдена. Пропуск сохранения в базу данных.")
+            logger.info("Для создания таблицы выполните SQL скрипт: create_3day_profitability_table.sql")
+        else:
+            logger.warning(f"Не удалось сохранить 3-дневную доходность в базу данных: {e}")
+        logger.info("Продолжаем работу без сохранения в базу данных")
+
+
+def calculate_daily_profitability(date: datetime = None, save: bool = True):
     """Рассчитывает дневную доходность майнинга на основе реальных продаж"""
     if date is None:
         date = datetime.now().date()
@@ -1647,19 +2520,8 @@ def calculate_daily_profitability(date: datetime = None):
 
         if profitability_data:
             # Сохраняем в таблицу дневной доходности с использованием UPSERT
-            daily_profit_data = {
-                "calculation_date": date.isoformat(),
-                "total_income_rub": profitability_data["total_income_rub"],
-                "total_cost_rub": profitability_data["total_cost"],
-                "net_profit_rub": profitability_data["net_profit"],
-                "profitability_percentage": profitability_data["profitability_percentage"],
-                "sales_count": profitability_data["sales_count"],
-                "energy_sessions_count": profitability_data["energy_sessions_count"]
-            }
-            supabase.table("miner_daily_profitability").upsert(
-                daily_profit_data,
-                on_conflict="calculation_date"
-            ).execute()
+            if save:
+                _save_daily_profitability([_daily_profit_row(profitability_data, date)])
 
             logger.info(f"Дневная доходность за {date}:")
             logger.info(
@@ -1669,11 +2531,12 @@ def calculate_daily_profitability(date: datetime = None):
             logger.info(f"  Затраты: {profitability_data['total_cost']:.2f} RUB")
             logger.info(f"  Прибыль: {profitability_data['net_profit']:.2f} RUB")
             logger.info(f"  Рентабельность: {profitability_data['profitability_percentage']:.2f}%")
+        return profitability_data
     except Exception as e:
         logger.error(f"Ошибка расчета дневной доходности: {e}", exc_info=True)
 
 
-def calculate_weekly_profitability(end_date: datetime = None):
+def calculate_weekly_profitability(end_date: datetime = None, save: bool = True):
     """Рассчитывает недельную доходность и среднесуточные показатели"""
     if end_date is None:
         end_date = datetime.now()
@@ -1700,38 +2563,9 @@ def calculate_weekly_profitability(end_date: datetime = None):
                 "exchange_rate_source": weekly_data["exchange_rate_source"]
             }
 
-            # Сохраняем в таблицу недельной доходности с использованием UPSERT
-            weekly_profit_data = {
-                "start_date": start_date.isoformat(),
-                "end_date": end_date.isoformat(),
-                "total_income_rub": weekly_data["total_income_rub"],
-                "total_cost_rub": weekly_data["total_cost"],
-                "net_profit_rub": weekly_data["net_profit"],
-                "profitability_percentage": weekly_data["profitability_percentage"],
-                "avg_daily_income": weekly_data["avg_daily_income"],
-                "avg_daily_cost": weekly_data["avg_daily_cost"],
-                "avg_daily_profit": weekly_data["avg_daily_profit"],
-                "sales_count": weekly_data["sales_count"],
-                "energy_sessions_count": weekly_data["energy_sessions_count"]
-            }
-
-            # Используем insert вместо upsert для избежания ошибки с ограничением
-            try:
-                # Сначала проверяем, существует ли уже запись за эту неделю
-                existing_record = supabase.table("miner_weekly_profitability").select("*").eq(
-                    "start_date", start_date.isoformat()).execute()
-                if existing_record.data:
-                    # Если запись существует, обновляем ее
-                    supabase.table("miner_weekly_profitability").update(
-                        weekly_profit_data
-                    ).eq("start_date", start_date.isoformat()).execute()
-                else:
-                    # Если записи нет, вставляем новую
-                    supabase.table("miner_weekly_profitability").insert(
-                        weekly_profit_data
-                    ).execute()
-            except Exception as e:
-                logger.error(f"Ошибка сохранения недельной доходности: {e}")
+            # Сохраняем в таблицу недельной доходности
+            if save:
+                _save_weekly_profitability([_period_profit_row(weekly_data, start_date, end_date)])
 
             logger.info(f"Недельная доходность:")
             logger.info(
@@ -1746,7 +2580,7 @@ def calculate_weekly_profitability(end_date: datetime = None):
         return None, None
 
 
-def calculate_monthly_profitability(end_date: datetime = None):
+def calculate_monthly_profitability(end_date: datetime = None, save: bool = True):
     """Рассчитывает месячную доходность"""
     if end_date is None:
         end_date = datetime.now()
@@ -1760,23 +2594,8 @@ def calculate_monthly_profitability(end_date: datetime = None):
 
         if monthly_data:
             # Сохраняем в таблицу месячной доходности с использованием UPSERT
-            monthly_profit_data = {
-                "start_date": start_date.isoformat(),
-                "end_date": end_date.isoformat(),
-                "total_income_rub": monthly_data["total_income_rub"],
-                "total_cost_rub": monthly_data["total_cost"],
-                "net_profit_rub": monthly_data["net_profit"],
-                "profitability_percentage": monthly_data["profitability_percentage"],
-                "avg_daily_income": monthly_data["avg_daily_income"],
-                "avg_daily_cost": monthly_data["avg_daily_cost"],
-                "avg_daily_profit": monthly_data["avg_daily_profit"],
-                "sales_count": monthly_data["sales_count"],
-                "energy_sessions_count": monthly_data["energy_sessions_count"]
-            }
-            supabase.table("miner_monthly_profitability").upsert(
-                monthly_profit_data,
-                on_conflict="start_date"
-            ).execute()
+            if save:
+                _save_monthly_profitability([_period_profit_row(monthly_data, start_date, end_date)])
 
             logger.info(f"Месячная доходность:")
             logger.info(
@@ -1791,7 +2610,7 @@ def calculate_monthly_profitability(end_date: datetime = None):
         return None
 
 
-def calculate_3day_profitability(end_date: datetime = None):
+def calculate_3day_profitability(end_date: datetime = None, save: bool = True):
     """Рассчитывает доходность за последние 3 дня"""
     if end_date is None:
         end_date = datetime.now()
@@ -1804,53 +2623,26 @@ def calculate_3day_profitability(end_date: datetime = None):
                                                      f"3 дня {start_date.strftime('%d.%m')} - {end_date.strftime('%d.%m.%Y')}")
 
         if data_3d:
-            # Рассчитываем среднесуточную доходность за 3 дня
+            # Среднесуточная доходность за 3 дня: средние значения уже посчитаны
+            # за один проход по данным, здесь они только приводятся к формату сообщения
             avg_daily_profitability = {
                 "period_name": "Среднесуточная за 3 дня",
                 "start_date": start_date.isoformat(),
                 "end_date": end_date.isoformat(),
-                "total_income": data_3d["avg_daily_income"],
+                "total_income_usdt": data_3d["total_income_usdt"] / data_3d["days_count"],
+                "total_income_rub": data_3d["avg_daily_income"],
                 "total_cost": data_3d["avg_daily_cost"],
                 "net_profit": data_3d["avg_daily_profit"],
                 "profitability_percentage": data_3d["profitability_percentage"],
-                "days_count": 3,
-                "exchange_rate": data_3d["exchange_rate"],
-                "exchange_rate_source": data_3d["exchange_rate_source"]
-            }
-
-            # Сохраняем в таблицу 3-дневной доходности
-            profit_data = {
-                "start_date": start_date.isoformat(),
-                "end_date": end_date.isoformat(),
-                "total_income_rub": data_3d["total_income_rub"],
-                "total_cost_rub": data_3d["total_cost"],
-                "net_profit_rub": data_3d["net_profit"],
-                "profitability_percentage": data_3d["profitability_percentage"],
-                "avg_daily_income": data_3d["avg_daily_income"],
-                "avg_daily_cost": data_3d["avg_daily_cost"],
-                "avg_daily_profit": data_3d["avg_daily_profit"],
-                "sales_count": data_3d["sales_count"],
-                "energy_sessions_count": data_3d["energy_sessions_count"]
+                "exchange_rate": data_3d["exchange_rate"],
+                "exchange_rate_source": data_3d["exchange_rate_source"],
+                "sales_count": max(1, data_3d["sales_count"] // data_3d["days_count"]),
+                "location_stats": data_3d["location_stats"]
             }
 
-            # Пытаемся сохранить данные, но продолжаем работу даже если не получится
-            try:
-                response = supabase.table("miner_3day_profitability").upsert(
-                    profit_data,
-                    on_conflict="start_date"
-                ).execute()
-                if response.data:
-                    logger.info(f"3-дневная доходность успешно сохранена")
-                else:
-                    logger.warning(f"Не удалось сохранить 3-дневную доходность: пустой ответ")
-            except Exception as e:
-                error_msg = str(e).lower()
-                if "404" in error_msg or "not found" in error_msg:
-                    logger.warning(f"Таблица miner_3day_profitability не найдена. Пропуск сохранения в базу данных.")
-                    logger.info("Для создания таблицы выполните SQL скрипт: create_3day_profitability_table.sql")
-                else:
-                    logger.warning(f"Не удалось сохранить 3-дневную доходность в базу данных: {e}")
-                logger.info("Продолжаем работу без сохранения в базу данных")
+            # Сохраняем в таблицу 3-дневной доходности
+            if save:
+                _save_3day_profitability([_period_profit_row(data_3d, start_date, end_date)])
 
             logger.info(f"3-дневная доходность:")
             logger.info(
@@ -1868,6 +2660,56 @@ def calculate_3day_profitability(end_date: datetime = None):
         return None, None
 
 
+def backfill_profitability(end_dates: List[datetime]) -> Dict[str, int]:
+    """
+    Пересчитывает доходность за несколько дат (дневную, 3-дневную, недельную и месячную)
+    и сохраняет результаты пакетно: по одному запросу на таблицу вместо запроса на каждый период.
+    Возвращает число пересчитанных записей по видам периодов
+    """
+    logger.info(f"Пересчет доходности за {len(end_dates)} дат")
+
+    daily_rows, rows_3d, weekly_rows, monthly_rows = [], [], [], []
+    for end_date in end_dates:
+        # Все периоды заканчиваются в end_date, поэтому день берем последний завершенный
+        day = end_date.date() - timedelta(days=1)
+        daily_data = calculate_daily_profitability(day, save=False)
+        if daily_data:
+            daily_rows.append(_daily_profit_row(daily_data, day))
+
+        data_3d, _ = calculate_3day_profitability(end_date, save=False)
+        if data_3d:
+            rows_3d.append(_period_profit_row(data_3d, end_date - timedelta(days=3), end_date))
+
+        weekly_data, _ = calculate_weekly_profitability(end_date, save=False) or (None, None)
+        if weekly_data:
+            weekly_rows.append(_period_profit_row(weekly_data, end_date - timedelta(days=7), end_date))
+
+        monthly_data = calculate_monthly_profitability(end_date, save=False)
+        if monthly_data:
+            monthly_rows.append(_period_profit_row(monthly_data, end_date - timedelta(days=30), end_date))
+
+    if daily_rows:
+        try:
+            _save_daily_profitability(daily_rows)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения дневной доходности: {e}")
+    if rows_3d:
+        _save_3day_profitability(rows_3d)
+    if weekly_rows:
+        _save_weekly_profitability(weekly_rows)
+    if monthly_rows:
+        try:
+            _save_monthly_profitability(monthly_rows)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения месячной доходности: {e}")
+
+    logger.info(f"Пересчет завершен: дней={len(daily_rows)}, 3 дня={len(rows_3d)}, "
+                f"недель={len(weekly_rows)}, месяцев={len(monthly_rows)}")
+    return {"daily": len(daily_rows), "3day": len(rows_3d),
+            "weekly": len(weekly_rows), "monthly": len(monthly_rows)}
+
+
+@ttl_cache(30)
 def get_today_spending() -> Dict[str, Dict]:
     """Получает статистику потребления за сегодня"""
     logger.info("Запрос статистики за сегодня")
@@ -1879,7 +2721,7 @@ def get_today_spending() -> Dict[str, Dict]:
     try:
         # Сначала пробуем получить данные через API
         api_stats = {}
-        for location in set(device["location"] for device in DEVICES):
+        for location in LOCATIONS:
             api_consumption = get_today_consumption_from_api(location)
             if api_consumption > 0:
                 api_stats[location] = {
@@ -1912,11 +2754,7 @@ def get_today_spending() -> Dict[str, Dict]:
             device_id = session["miner_device_id"]
 
             # Находим имя устройства
-            device_name = "Unknown"
-            for device in DEVICES:
-                if device["device_id"] == device_id:
-                    device_name = device["name"]
-                    break
+            device_name = DEVICE_NAME_BY_ID.get(device_id, "Unknown")
 
             if location not in location_stats:
                 location_stats[location] = {
@@ -1946,18 +2784,13 @@ def get_today_spending() -> Dict[str, Dict]:
         # Рассчитываем стоимость для данных из API
         for location, stats in location_stats.items():
             if stats.get("source") == "API" and stats["total_cost"] == 0:
-                # Получаем тарифы для расчета стоимости
-                location_tariff = TARIFF_SETTINGS.get(location, {})
-                tariff_type = location_tariff.get("tariff_type", "single")
-                ranges = location_tariff.get("ranges", [{}])[0] if location_tariff.get("ranges") else {}
+                # Получаем предрассчитанные тарифы для расчета стоимости
+                tariff_type, day_rate, night_rate = TARIFF_BY_LOCATION.get(location, DEFAULT_FIRST_RANGE_TARIFF)
 
                 if tariff_type == "day_night":
-                    stats["total_cost"] = (
-                            stats["day_energy"] * ranges.get("day_rate", 4.82) +
-                            stats["night_energy"] * ranges.get("night_rate", 3.39)
-                    )
+                    stats["total_cost"] = stats["day_energy"] * day_rate + stats["night_energy"] * night_rate
                 else:
-                    stats["total_cost"] = stats["total_energy"] * ranges.get("day_rate", 4.82)
+                    stats["total_cost"] = stats["total_energy"] * day_rate
 
         logger.info(f"Получена статистика за сегодня по {len(location_stats)} локациям")
         return location_stats
@@ -1982,43 +2815,54 @@ def format_profitability_message(profitability_data: Dict, show_details: bool =
     exchange_rate = profitability_data.get("exchange_rate")
     exchange_rate_source = profitability_data.get("exchange_rate_source", "CoinGecko")
 
-    message = f"📊 <b>{period_name}:</b>\n\n"
+    lines = [f"📊 <b>{period_name}:</b>", ""]
 
     # Информация о курсе
     if exchange_rate:
-        message += f"💱 <b>Курс валюты:</b> {exchange_rate_source}: {exchange_rate:.2f} руб/USDT\n\n"
+        lines += [f"💱 <b>Курс валюты:</b> {exchange_rate_source}: {exchange_rate:.2f} руб/USDT", ""]
 
     # Общая информация
     profit_emoji = "🟢" if net_profit >= 0 else "🔴"
-    message += f"{profit_emoji} <b>Общая доходность:</b>\n"
-    message += f"💰 Доход от продаж: {total_income_usdt:.2f} USDT ({total_income_rub:.2f} RUB)\n"
-    message += f"💸 Затраты на электричество: {total_cost:.2f} RUB\n"
-    message += f"📈 Чистая прибыль: {net_profit:.2f} RUB\n"
-    message += f"📊 Рентабельность: {profitability_percentage:.2f}%\n"
+    lines += [
+        f"{profit_emoji} <b>Общая доходность:</b>",
+        f"💰 Доход от продаж: {total_income_usdt:.2f} USDT ({total_income_rub:.2f} RUB)",
+        f"💸 Затраты на электричество: {total_cost:.2f} RUB",
+        f"📈 Чистая прибыль: {net_profit:.2f} RUB",
+        f"📊 Рентабельность: {profitability_percentage:.2f}%",
+    ]
 
     # Среднесуточные показатели
     if days_count > 1:
         avg_daily_income = profitability_data.get("avg_daily_income", 0)
         avg_daily_cost = profitability_data.get("avg_daily_cost", 0)
         avg_daily_profit = profitability_data.get("avg_daily_profit", 0)
-        message += f"\n<b>📈 Среднесуточные показатели:</b>\n"
-        message += f"💰 Средний доход: {avg_daily_income:.2f} RUB\n"
-        message += f"💸 Средние затраты: {avg_daily_cost:.2f} RUB\n"
-        message += f"📊 Средняя прибыль: {avg_daily_profit:.2f} RUB\n"
+        lines += [
+            "",
+            "<b>📈 Среднесуточные показатели:</b>",
+            f"💰 Средний доход: {avg_daily_income:.2f} RUB",
+            f"💸 Средние затраты: {avg_daily_cost:.2f} RUB",
+            f"📊 Средняя прибыль: {avg_daily_profit:.2f} RUB",
+        ]
 
-    message += f"\n🛒 <b>Продажи:</b> {sales_count} шт.\n"
+    lines += ["", f"🛒 <b>Продажи:</b> {sales_count} шт."]
 
     if show_details and profitability_data.get("sales_by_currency"):
-        message += "\n<b>💱 Детализация по валютам:</b>\n"
-        for currency, data in profitability_data["sales_by_currency"].items():
-            message += f"• {currency}: {data['total_amount']:.2f} ({data['total_amount_rub']:.2f} RUB, {data['sales_count']} сделок)\n"
+        lines += ["", "<b>💱 Детализация по валютам:</b>"]
+        lines.extend(
+            f"• {currency}: {data['total_amount']:.2f} ({data['total_amount_rub']:.2f} RUB, {data['sales_count']} сделок)"
+            for currency, data in profitability_data["sales_by_currency"].items()
+        )
 
     if show_details and profitability_data.get("location_stats"):
-        message += "\n<b>⚡ Потребление по локациям:</b>\n"
-        for location, stats in profitability_data["location_stats"].items():
-            message += f"• {location}: {stats['total_energy']:.3f} кВт·ч ({stats['total_cost']:.2f} RUB)\n"
+        lines += ["", "<b>⚡ Потребление по локациям:</b>"]
+        lines.extend(
+            f"• {location}: {stats['total_energy']:.3f} кВт·ч ({stats['total_cost']:.2f} RUB)"
+            for location, stats in profitability_data["location_stats"].items()
+        )
 
-    return message
+    # Сообщение заканчивается переводом строки
+    lines.append("")
+    return "\n".join(lines)
 
 
 def format_profitability_forecast_message(forecast_data: Dict) -> str:
@@ -2037,28 +2881,63 @@ def format_profitability_forecast_message(forecast_data: Dict) -> str:
     period_text = "24 часа" if period_days == 1 else f"{period_days} дней"
     confidence_emoji = "🟢" if confidence == "high" else "🟡" if confidence == "medium" else "🔴"
 
-    message = f"🔮 <b>Прогноз доходности на {period_text}:</b> {confidence_emoji}\n\n"
-
-    # Общая информация
-    profit_emoji = "🟢" if estimated_profit >= 0 else "🔴"
-    message += f"{profit_emoji} <b>Прогнозная доходность:</b>\n"
-    message += f"⚡ Прогноз потребления: {estimated_energy:.3f} кВт·ч\n"
-    message += f"💰 Прогноз дохода: {estimated_income:.2f} USDT\n"
-    message += f"💸 Прогноз затрат: {estimated_cost:.2f} RUB\n"
-    message += f"📈 Прогноз прибыли: {estimated_profit:.2f} RUB\n"
-    message += f"📊 Прогноз рентабельности: {profitability_percentage:.2f}%\n"
-
     # Детализация по тарифам
     day_energy = forecast_data.get("day_energy", 0)
     night_energy = forecast_data.get("night_energy", 0)
     day_rate = forecast_data.get("day_rate", 4.82)
     night_rate = forecast_data.get("night_rate", 3.39)
 
-    message += f"\n<b>💡 Детализация по тарифам:</b>\n"
-    message += f"☀️ День: {day_energy:.3f} кВт·ч ({day_rate} руб/кВт·ч)\n"
-    message += f"🌙 Ночь: {night_energy:.3f} кВт·ч ({night_rate} руб/кВт·ч)\n"
-
-    return message
+    profit_emoji = "🟢" if estimated_profit >= 0 else "🔴"
+    lines = [
+        f"🔮 <b>Прогноз доходности на {period_text}:</b> {confidence_emoji}",
+        "",
+        # Общая информация
+        f"{profit_emoji} <b>Прогнозная доходность:</b>",
+        f"⚡ Прогноз потребления: {estimated_energy:.3f} кВт·ч",
+        f"💰 Прогноз дохода: {estimated_income:.2f} USDT",
+        f"💸 Прогноз затрат: {estimated_cost:.2f} RUB",
+        f"📈 Прогноз прибыли: {estimated_profit:.2f} RUB",
+        f"📊 Прогноз рентабельности: {profitability_percentage:.2f}%",
+        "",
+        "<b>💡 Детализация по тарифам:</b>",
+        f"☀️ День: {day_energy:.3f} кВт·ч ({day_rate} руб/кВт·ч)",
+        f"🌙 Ночь: {night_energy:.3f} кВт·ч ({night_rate} руб/кВт·ч)",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+# Regular expressions for cleaning AI responses (compiled once at import)
+# Basic formatting tags that Telegram supports
+_ALLOWED_HTML_TAGS = frozenset(('b', 'i', 'u', 's', 'a', 'code', 'pre'))
+# Pattern to match HTML tags
+_TAG_RE = re.compile(r'</?([a-zA-Z0-9]+)(?:\s+[^>]*)?>')
+# Pattern to match opening HTML tags
+_OPEN_TAG_RE = re.compile(r'<([a-zA-Z0-9]+)(?:\s+[^>]*)?>')
+# Pattern to match HTML entities
+_ENTITY_RE = re.compile(r'&[a-zA-Z0-9#]+;')
+# Pattern to collapse blank lines
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+# Pattern to match any HTML-like tag, capturing its name when it has one
+_ANY_TAG_RE = re.compile(r'<(?:/?([a-zA-Z0-9]+))?[^>]*>')
+# Pattern to strip all tags when a message part is resent as plain text
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+# Single alternation removing reasoning sections from AI responses.
+# Closed forms come before their unclosed variants so that an unclosed tag
+# only swallows the rest of the text when no closing tag exists.
+_THINKING_RE = re.compile('|'.join((
+    # Cerebras and DeepSeek formats
+    r'<think>.*?</think>',
+    r'<thinking>.*?</thinking>',
+    r'<answer>.*?</answer>',
+    # OpenRouter and other formats
+    r'<details>.*?</details>',
+    r'<div[^>]*class=["\'][^"\']*thinking[^"\']*["\'][^>]*>.*?</div>',
+    # Handle incomplete/damaged tags
+    r'<thinking>.*?$',  # Unclosed thinking tag
+    r'<details>.*?$',  # Unclosed details tag
+    r'<div[^>]*class=["\'][^"\']*thinking[^"\']*["\'][^>]*>.*?$',  # Unclosed thinking div
+)), re.DOTALL)
 
 
 # Function to sanitize AI responses for Telegram
@@ -2070,21 +2949,20 @@ def sanitize_for_telegram_html(text):
     # First, clean reasoning tags
     text = parse_ai_thinking_tags(text)
 
+    # Fast path: nothing to sanitize without tags or entities
+    if '<' not in text and '&' not in text:
+        return text
+
     # Remove problematic HTML tags that might cause parsing issues
     # Keep only basic formatting tags that Telegram supports
-    allowed_tags = ['b', 'i', 'u', 's', 'a', 'code', 'pre']
-
-    # Pattern to match HTML tags
-    tag_pattern = re.compile(r'</?([a-zA-Z0-9]+)(?:\s+[^>]*)?>')
-
     def replace_tag(match):
         tag_name = match.group(1).lower()
-        if tag_name in allowed_tags:
+        if tag_name in _ALLOWED_HTML_TAGS:
             return match.group(0)  # Keep allowed tags
         return ""  # Remove disallowed tags
 
     # Replace disallowed tags
-    sanitized = tag_pattern.sub(replace_tag, text)
+    sanitized = _TAG_RE.sub(replace_tag, text)
 
     # Fix common HTML issues
     sanitized = sanitized.replace("&nbsp;", " ")  # Replace non-breaking spaces
@@ -2093,13 +2971,13 @@ def sanitize_for_telegram_html(text):
     sanitized = sanitized.replace("&gt;", ">")  # Fix greater than
 
     # Remove any remaining HTML entities that might cause issues
-    sanitized = re.sub(r'&[a-zA-Z0-9#]+;', '', sanitized)
+    sanitized = _ENTITY_RE.sub('', sanitized)
 
     # Final validation: ensure all opened tags are closed
     tag_stack = []
-    for match in re.finditer(r'<([a-zA-Z0-9]+)(?:\s+[^>]*)?>', sanitized):
+    for match in _OPEN_TAG_RE.finditer(sanitized):
         tag = match.group(1)
-        if tag in allowed_tags:
+        if tag in _ALLOWED_HTML_TAGS:
             tag_stack.append(tag)
 
     # Close any unclosed tags
@@ -2117,65 +2995,85 @@ def split_message_for_telegram(text, max_length=4096):
         return [text]
 
     parts = []
-    current_part = ""
+    # Current part is accumulated as a list of chunks and joined on flush
+    current_chunks = []
+    current_len = 0
+
+    def flush():
+        nonlocal current_len
+        parts.append("".join(current_chunks))
+        current_chunks.clear()
+        current_len = 0
+
+    def start(chunk):
+        nonlocal current_len
+        current_chunks.append(chunk)
+        current_len = len(chunk)
+
+    def extend(separator, chunk):
+        nonlocal current_len
+        if current_len:
+            current_chunks.append(separator)
+            current_len += len(separator)
+        current_chunks.append(chunk)
+        current_len += len(chunk)
 
     # Split by paragraphs first
     paragraphs = text.split('\n\n')
 
     for paragraph in paragraphs:
         # If adding this paragraph would exceed the limit, start a new part
-        if len(current_part) + len(paragraph) + 2 > max_length:
-            if current_part:  # Save current part if not empty
-                parts.append(current_part)
-                current_part = ""
+        if current_len + len(paragraph) + 2 > max_length:
+            if current_len:  # Save current part if not empty
+                flush()
 
             # If a single paragraph is too long, split it by lines
             if len(paragraph) > max_length:
                 lines = paragraph.split('\n')
                 for line in lines:
-                    if len(current_part) + len(line) + 1 > max_length:
-                        if current_part:
-                            parts.append(current_part)
-                            current_part = line
+                    if current_len + len(line) + 1 > max_length:
+                        if current_len:
+                            flush()
+                            start(line)
                         else:
                             # If a single line is too long, split it by words
                             words = line.split(' ')
                             for word in words:
-                                if len(current_part) + len(word) + 1 > max_length:
-                                    if current_part:
-                                        parts.append(current_part)
-                                        current_part = word
+                                if current_len + len(word) + 1 > max_length:
+                                    if current_len:
+                                        flush()
+                                        start(word)
                                     else:
                                         # If a single word is too long, split it
                                         while len(word) > max_length:
                                             parts.append(word[:max_length])
                                             word = word[max_length:]
-                                        current_part = word
+                                        start(word)
                                 else:
-                                    if current_part:
-                                        current_part += " " + word
-                                    else:
-                                        current_part = word
+                                    extend(" ", word)
                     else:
-                        if current_part:
-                            current_part += "\n" + line
-                        else:
-                            current_part = line
+                        extend("\n", line)
             else:
-                current_part = paragraph
+                start(paragraph)
         else:
-            if current_part:
-                current_part += "\n\n" + paragraph
-            else:
-                current_part = paragraph
+            extend("\n\n", paragraph)
 
     # Add the last part if not empty
-    if current_part:
-        parts.append(current_part)
+    if current_len:
+        flush()
 
     return parts
 
 
+# Удаляет теги, которые не поддерживает Telegram
+def _strip_disallowed_tag(match) -> str:
+    """Keep a matched tag only if it is allowed by Telegram (or has no name)"""
+    tag_name = match.group(1)
+    if tag_name and tag_name.lower() not in _ALLOWED_HTML_TAGS:
+        return ''
+    return match.group(0)
+
+
 # Function to parse AI thinking tags
 def parse_ai_thinking_tags(response_text: str) -> str:
     """
@@ -2185,115 +3083,232 @@ def parse_ai_thinking_tags(response_text: str) -> str:
     if not response_text:
         return ""
 
-    # Compile all patterns for optimization
-    patterns = [
-        # Cerebras and DeepSeek formats
-        (r'', re.DOTALL),
-        (r'<thinking>.*?</thinking>', re.DOTALL),
-        (r'<answer>.*?</answer>', re.DOTALL),
-        # OpenRouter and other formats
-        (r'<details>.*?</details>', re.DOTALL),
-        (r'<div[^>]*class=["\'][^"\']*thinking[^"\']*["\'][^>]*>.*?</div>', re.DOTALL),
-        # Handle incomplete/damaged tags
-        (r'<thinking>.*?$', re.DOTALL),  # Unclosed thinking tag
-        (r'<details>.*?$', re.DOTALL),  # Unclosed details tag
-        (r'<div[^>]*class=["\'][^"\']*thinking[^"\']*["\'][^>]*>.*?$', re.DOTALL),  # Unclosed thinking div
-        # Handle nested tags
-        (r'<thinking>.*?<thinking>.*?</thinking>.*?</thinking>', re.DOTALL),
-        (r'<details>.*?<details>.*?</details>.*?</details>', re.DOTALL),
-    ]
-
-    cleaned_text = response_text
-
-    # Apply each pattern to remove thinking sections
-    for pattern, flags in patterns:
-        try:
-            think_pattern = re.compile(pattern, flags)
-            cleaned_text = think_pattern.sub('', cleaned_text)
-        except Exception as e:
-            logger.warning(f"Error applying pattern {pattern}: {e}")
+    # Remove all thinking sections in a single pass; leftovers of nested
+    # tags are dropped by the tag validation below. Plain text has no tags to remove.
+    if '<' in response_text:
+        cleaned_text = _THINKING_RE.sub('', response_text)
+    else:
+        cleaned_text = response_text
 
     # Clean up extra whitespace and newlines
-    cleaned_text = re.sub(r'\n\s*\n', '\n\n', cleaned_text.strip())
+    cleaned_text = _BLANK_LINES_RE.sub('\n\n', cleaned_text.strip())
 
     # Remove any remaining HTML entities that might cause issues
-    cleaned_text = re.sub(r'&[a-zA-Z0-9#]+;', '', cleaned_text)
+    if '&' in cleaned_text:
+        cleaned_text = _ENTITY_RE.sub('', cleaned_text)
 
     # Final validation: ensure no broken HTML remains
     if '<' in cleaned_text and '>' in cleaned_text:
-        # Additional safety check for malformed HTML
-        html_tags = re.findall(r'<[^>]+>', cleaned_text)
-        allowed_tags = ['b', 'i', 'u', 's', 'a', 'code', 'pre']
-        for tag in html_tags:
-            tag_name = re.findall(r'^</?([a-zA-Z0-9]+)', tag)
-            if tag_name and tag_name[0].lower() not in allowed_tags:
-                # Remove disallowed tag
-                cleaned_text = cleaned_text.replace(tag, '')
+        # Additional safety check for malformed HTML: drop disallowed tags in one pass
+        cleaned_text = _ANY_TAG_RE.sub(_strip_disallowed_tag, cleaned_text)
 
     return cleaned_text.strip()
 
 
-# Function to execute AI requests with proper error handling
-async def make_ai_request(system_prompt, user_prompt, temperature=0.7, max_tokens=1500):
-    """Execute AI request with proper rate limiting handling and enhanced thinking tag parsing"""
-    # Try OpenRouter first
-    if openai_client:
-        try:
-            response = openai_client.chat.completions.create(
-                model=REASONING_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=temperature,
-                max_tokens=max_tokens,
-                extra_headers={
-                    "HTTP-Referer": OPENROUTER_SITE_URL,
-                    "X-Title": OPENROUTER_SITE_NAME,
-                },
-                timeout=10  # Add timeout to prevent hanging
-            )
-            # Enhanced parsing of thinking tags from the response
-            raw_response = response.choices[0].message.content
-            logger.debug(f"Raw AI response: {raw_response[:200]}...")
+# Synchronous provider calls, executed in worker threads by make_ai_request
+def _collect_stream(stream, cancel_event: Optional[threading.Event] = None):
+    """Join the content deltas of a streamed chat completion; stop early once cancel_event is set"""
+    chunks = []
+    try:
+        for chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+    finally:
+        # Closing the stream drops the HTTP connection, so a cancelled
+        # request stops generating (and billing) tokens
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    return "".join(chunks) if chunks else None
+
+
+def _openrouter_completion(system_prompt, user_prompt, temperature, max_tokens, cancel_event=None):
+    """Request a streamed completion from OpenRouter and return the raw response text"""
+    stream = openai_client.chat.completions.create(
+        model=REASONING_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        extra_headers={
+            "HTTP-Referer": OPENROUTER_SITE_URL,
+            "X-Title": OPENROUTER_SITE_NAME,
+        },
+        stream=True,
+        timeout=10  # Applies between streamed chunks, not to the whole answer
+    )
+    return _collect_stream(stream, cancel_event)
+
+
+def _cerebras_completion(system_prompt, user_prompt, temperature, max_tokens, cancel_event=None):
+    """Request a streamed completion from Cerebras and return the raw response text"""
+    stream = cerebras_client.chat.completions.create(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        model=CEREBRAS_MODEL,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        timeout=10  # Applies between streamed chunks, not to the whole answer
+    )
+    return _collect_stream(stream, cancel_event)
+
+
+# System prompts of the AI commands. Static instructions live here so that the
+# start of every request is byte-identical and providers can reuse their prompt
+# cache; user prompts carry only the current data.
+SYS_ANALYZE = """Ты - эксперт по анализу криптомайнинга. Отвечай подробно и структурированно на русском языке.
+Предоставь анализ на русском языке, включающий:
+1. Общую оценку текущей ситуации
+2. Эффективность работы фермы
+3. Потенциальные проблемы или риски
+4. Рекомендации по оптимизации
+5. Прогноз на ближайшие 24 часа
+Ответ структурируй по пунктам с использованием эмодзи."""
+
+SYS_FORECAST = """Ты - эксперт по прогнозированию энергопотребления. Отвечай точно и обоснованно на русском языке.
+Учитывай следующие факторы:
+- Текущие погодные условия (если известны)
+- Сезонные колебания
+- Исторические тренды
+- Эффективность устройств
+Предоставь прогноз на русском языке, включающий:
+1. Прогноз общего потребления на запрошенный период
+2. Ожидаемое распределение по часам
+3. Факторы, влияющие на прогноз
+4. Рекомендации по оптимизации потребления
+5. Уровень уверенности в прогнозе
+Ответ структурируй по пунктам с использованием эмодзи."""
+
+SYS_OPTIMIZE = """Ты - эксперт по оптимизации криптомайнинга. Отвечай практично и конкретно на русском языке.
+Предоставь план оптимизации на русском языке, включающий:
+1. Анализ текущей эффективности
+2. Конкретные рекомендации по:
+   - Оптимизации расписания работы устройств
+   - Использованию тарифных зон (день/ночь)
+   - Повышению эффективности майнинга
+   - Снижению затрат на электричество
+3. Оценку потенциального улучшения доходности
+4. Пошаговый план внедрения рекомендаций
+5. Сроки окупаемости предлагаемых мер
+Ответ структурируй по пунктам с использованием эмодзи."""
+
+SYS_HEALTH = """Ты - эксперт по диагностике майнингового оборудования. Отвечай внимательно и профессионально на русском языке.
+Проверь наличие аномалий и проблем:
+- Устройства с необычно высокой/низкой мощностью
+- Устройства с отклонениями напряжения
+- Резкие изменения в показаниях счетчиков
+- Неработающие устройства
+Предоставь анализ здоровья системы на русском языке, включающий:
+1. Общую оценку состояния системы
+2. Выявленные аномалии или проблемы
+3. Рекомендации по устранению проблем
+4. Профилактические меры
+5. Оценку критичности выявленных проблем
+Ответ структурируй по пунктам с использованием эмодзи."""
+
+SYS_SQL = "Ты - эксперт по разработке SQL. Преобразовывай вопросы на естественном языке в SQL-запросы."
+
+SYS_CHAT = "Ты - полезный помощник по майнинг-ферме. Предоставляй четкие, краткие ответы на основе предоставленных данных."
+
+
+# Short-lived caches of AI answers, one DataCache per TTL used by the handlers
+_ai_response_caches = {}
 
-            # Apply enhanced cleaning
-            cleaned_response = parse_ai_thinking_tags(raw_response)
-            logger.debug(f"Cleaned AI response: {cleaned_response[:200]}...")
 
-            return cleaned_response, "OpenRouter"
-        except Exception as e:
-            error_msg = str(e)
-            logger.warning(f"OpenRouter request failed: {error_msg}")
-            # Check for rate limiting errors
-            if "429" in error_msg or "rate limit" in error_msg.lower():
-                logger.info("Rate limit exceeded on OpenRouter, switching to Cerebras")
-            # Continue to Cerebras below
-    # Fallback to Cerebras
+# Function to execute AI requests with proper error handling
+async def make_ai_request(system_prompt, user_prompt, temperature=0.7, max_tokens=1500, cache_ttl=0):
+    """
+    Execute AI request, reusing an identical request's answer for cache_ttl seconds.
+    Repeated commands with unchanged input data then skip the LLM round-trip entirely.
+    """
+    if cache_ttl <= 0:
+        return await _hedged_ai_request(system_prompt, user_prompt, temperature, max_tokens)
+
+    cache = _ai_response_caches.get(cache_ttl)
+    if cache is None:
+        cache = _ai_response_caches[cache_ttl] = DataCache(cache_duration_hours=cache_ttl / 3600)
+    cache_key = hashlib.sha256(
+        f"{system_prompt}\x1f{user_prompt}\x1f{temperature}\x1f{max_tokens}".encode()
+    ).hexdigest()
+    cached_response = cache.get(cache_key)
+    if cached_response is not None:
+        logger.info("Using cached AI response")
+        return cached_response
+
+    response, provider = await _hedged_ai_request(system_prompt, user_prompt, temperature, max_tokens)
+    if response:
+        cache.set(cache_key, (response, provider))
+    return response, provider
+
+
+async def _hedged_ai_request(system_prompt, user_prompt, temperature, max_tokens):
+    """
+    Execute AI request hedged across providers with enhanced thinking tag parsing.
+    OpenRouter is tried first; if it has not answered within AI_HEDGE_DELAY seconds
+    (or has failed), Cerebras is started in parallel and the first successful answer wins.
+    """
+    providers = []
+    if openai_client:
+        providers.append(("OpenRouter", _openrouter_completion))
     if cerebras_client:
-        try:
-            response = cerebras_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                model=CEREBRAS_MODEL,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                timeout=10  # Add timeout
+        providers.append(("Cerebras", _cerebras_completion))
+
+    provider_names = {}
+    cancel_events = {}
+    pending = set()
+    while providers or pending:
+        timeout = None
+        if providers:
+            name, request_func = providers.pop(0)
+            cancel_event = threading.Event()
+            task = asyncio.create_task(
+                asyncio.to_thread(request_func, system_prompt, user_prompt, temperature, max_tokens, cancel_event)
             )
-            # Enhanced parsing of thinking tags from the response
-            raw_response = response.choices[0].message.content
-            logger.debug(f"Raw AI response: {raw_response[:200]}...")
-
-            # Apply enhanced cleaning
-            cleaned_response = parse_ai_thinking_tags(raw_response)
-            logger.debug(f"Cleaned AI response: {cleaned_response[:200]}...")
+            provider_names[task] = name
+            cancel_events[task] = cancel_event
+            pending.add(task)
+            # Give the current provider a head start before launching the hedge request
+            if providers:
+                timeout = AI_HEDGE_DELAY
+
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            provider = provider_names[task]
+            try:
+                # Enhanced parsing of thinking tags from the response
+                raw_response = task.result()
+                if raw_response is None:
+                    raise ValueError("empty response content")
+                # Lazy %-formatting: the text is only truncated and formatted when DEBUG is enabled
+                logger.debug("Raw AI response: %.200s...", raw_response)
+
+                # Apply enhanced cleaning
+                cleaned_response = parse_ai_thinking_tags(raw_response)
+                logger.debug("Cleaned AI response: %.200s...", cleaned_response)
+            except Exception as e:
+                error_msg = str(e)
+                logger.warning(f"{provider} request failed: {error_msg}")
+                # Check for rate limiting errors
+                if "429" in error_msg or "rate limit" in error_msg.lower():
+                    logger.info(f"Rate limit exceeded on {provider}, waiting for other providers")
+                continue
 
-            return cleaned_response, "Cerebras"
-        except Exception as e:
-            logger.warning(f"Cerebras request failed: {e}")
-    # Both providers failed
+            # Drop the slower request. Cancelling the task does not stop its worker
+            # thread, so the event makes the thread close its stream at the next chunk
+            for other_task in pending:
+                cancel_events[other_task].set()
+                other_task.cancel()
+            return cleaned_response, provider
+    # All providers failed
     return None, None
 
 
@@ -2302,33 +3317,39 @@ class ChatSession:
     """Manage chat sessions with history"""
 
     def __init__(self):
-        self.sessions = {}  # user_id: {'history': [], 'context': {}}
+        self.sessions = {}  # user_id: {'history': deque, 'context': {}}
         self.max_history = 10  # Maximum messages to keep in history
         self.auto_clear_after = 3600  # Auto-clear after 1 hour (in seconds)
+        self._activity_heap = []  # (last_activity, user_id), may contain outdated entries
 
     def get_session(self, user_id: int):
         """Get or create user session"""
         if user_id not in self.sessions:
+            now = datetime.now()
             self.sessions[user_id] = {
-                'history': [],
+                'history': deque(maxlen=self.max_history),
                 'context': {},
-                'last_activity': datetime.now()
+                'last_activity': now
             }
+            heapq.heappush(self._activity_heap, (now, user_id))
         return self.sessions[user_id]
 
     def add_message(self, user_id: int, role: str, content: str):
-        """Add message to session history"""
+        """Add message to session history (the deque keeps only recent messages)"""
         session = self.get_session(user_id)
-        session['history'].append({
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now()
-        })
-        session['last_activity'] = datetime.now()
-
-        # Keep only recent messages
-        if len(session['history']) > self.max_history:
-            session['history'] = session['history'][-self.max_history:]
+        history = session['history']
+        now = datetime.now()
+        if history and history[-1]['role'] == role and history[-1]['content'] == content:
+            # Repeated identical message: refresh it instead of filling the history with copies
+            history[-1]['timestamp'] = now
+        else:
+            history.append({
+                'role': role,
+                'content': content,
+                'timestamp': now
+            })
+        session['last_activity'] = now
+        heapq.heappush(self._activity_heap, (now, user_id))
 
     def clear_session(self, user_id: int):
         """Clear user session"""
@@ -2337,13 +3358,14 @@ class ChatSession:
 
     def auto_clear_inactive(self):
         """Clear inactive sessions"""
-        current_time = datetime.now()
-        inactive_users = [
-            user_id for user_id, session in self.sessions.items()
-            if (current_time - session['last_activity']).total_seconds() > self.auto_clear_after
-        ]
-        for user_id in inactive_users:
-            self.clear_session(user_id)
+        cutoff = datetime.now() - timedelta(seconds=self.auto_clear_after)
+        heap = self._activity_heap
+        # Pop only expired entries; an entry is current if it matches the session's last activity
+        while heap and heap[0][0] < cutoff:
+            last_activity, user_id = heapq.heappop(heap)
+            session = self.sessions.get(user_id)
+            if session is not None and session['last_activity'] == last_activity:
+                self.clear_session(user_id)
 
 
 # Global chat session manager
@@ -2351,6 +3373,33 @@ chat_sessions = ChatSession()
 
 
 # Natural Language to SQL converter
+# Only read-only statements produced by the AI may be executed
+_READ_ONLY_SQL_RE = re.compile(r'\s*(?:SELECT|WITH)\b', re.IGNORECASE)
+# Data-modifying keywords are rejected anywhere in the statement, which also
+# covers writable CTEs such as 'WITH d AS (DELETE ... RETURNING *) SELECT ...'
+_WRITE_SQL_RE = re.compile(
+    r'\b(?:INSERT|UPDATE|DELETE|MERGE|DROP|ALTER|TRUNCATE|CREATE|GRANT|COPY)\b', re.IGNORECASE
+)
+# SQL statement embedded in a non-JSON AI answer; the negated class cannot
+# backtrack the way a DOTALL '.*?' does on long responses without ';'
+_SQL_RE = re.compile(r'SELECT[^;]*', re.IGNORECASE)
+# Longer generated statements are rejected rather than truncated
+MAX_SQL_LENGTH = 8192
+
+
+def _is_read_only_sql(sql_query: str) -> bool:
+    """Check that a generated statement is a single read-only query"""
+    if not sql_query or not _READ_ONLY_SQL_RE.match(sql_query):
+        return False
+    statement = sql_query.strip()
+    # Only one trailing ';' is allowed, so statements cannot be chained
+    if statement.endswith(';'):
+        statement = statement[:-1]
+    if ';' in statement:
+        return False
+    return not _WRITE_SQL_RE.search(statement)
+
+
 class NaturalLanguageToSQL:
     """Convert natural language queries to SQL"""
 
@@ -2374,6 +3423,26 @@ class NaturalLanguageToSQL:
                 'description': 'Расчеты дневной доходности'
             }
         }
+        # Schema description is static, so it is built (and hashed) only once
+        self.schema_info = "\n".join([
+            f"Таблица: {table}\nКолонки: {', '.join(schema['columns'])}\nОписание: {schema['description']}"
+            for table, schema in self.table_schemas.items()
+        ])
+        self._schema_hash = hashlib.blake2b(self.schema_info.encode(), digest_size=16).hexdigest()
+        # Cache of parsed AI responses, so repeated questions skip the LLM round-trip
+        self.query_cache = DataCache(cache_duration_hours=1)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @staticmethod
+    def _normalize(text) -> str:
+        """Lowercase and collapse whitespace so trivially different questions share a cache key"""
+        return " ".join(str(text).lower().split())
+
+    def _cache_key(self, question: str, context: dict = None) -> str:
+        """Build the cache key for a question and its context"""
+        key_source = f"{self._normalize(question)}|{self._schema_hash}|{self._normalize(context or '')}"
+        return hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
 
     async def generate_sql_query(self, question: str, context: dict = None) -> dict:
         """
@@ -2384,18 +3453,18 @@ class NaturalLanguageToSQL:
         Returns:
             Dictionary with sql_query, explanation, and parameters
         """
-        # Create prompt for AI
-        schema_info = "\n".join([
-            f"Таблица: {table}\nКолонки: {', '.join(schema['columns'])}\nОписание: {schema['description']}"
-            for table, schema in self.table_schemas.items()
-        ])
+        cache_key = self._cache_key(question, context)
+        cached_result = self.query_cache.get(cache_key)
+        if cached_result is not None:
+            self.cache_hits += 1
+            return cached_result
+        self.cache_misses += 1
 
+        # Create prompt for AI
         prompt = f"""
         Преобразуй следующий вопрос на естественном языке в SQL-запрос на основе схемы базы данных:
         Схема базы данных:
-        {schema_info}
-        Вопрос: {question}
-        Контекст: {context or 'Нет'}
+        {self.schema_info}
         Правила:
         1. Используй правильный синтаксис SQL для PostgreSQL (Supabase)
         2. Всегда используй параметризованные запросы для предотвращения SQL-инъекций
@@ -2408,38 +3477,61 @@ class NaturalLanguageToSQL:
             "explanation": "Краткое объяснение того, что делает запрос",
             "parameters": []
         }}
+        Вопрос: {question}
+        Контекст: {context or 'Нет'}
         """
 
         # Get AI response
         ai_response, _ = await make_ai_request(
-            system_prompt="Ты - эксперт по разработке SQL. Преобразовывай вопросы на естественном языке в SQL-запросы.",
+            system_prompt=SYS_SQL,
             user_prompt=prompt,
             temperature=0.1,
             max_tokens=1000
         )
 
         if ai_response:
-            try:
-                # Parse JSON response
-                result = json.loads(ai_response)
-                return result
-            except json.JSONDecodeError:
-                # Fallback: try to extract SQL from text
-                sql_match = re.search(r'SELECT.*?(?=;|$)', ai_response, re.IGNORECASE | re.DOTALL)
-                if sql_match:
-                    return {
-                        'sql_query': sql_match.group(0),
-                        'explanation': 'Сгенерированный SQL-запрос',
-                        'parameters': []
-                    }
+            # Plain SQL answers are not JSON, so don't try to decode them
+            if not _SQL_RE.match(ai_response.lstrip()):
+                try:
+                    # Parse JSON response
+                    result = orjson.loads(ai_response)
+                except json.JSONDecodeError:  # orjson.JSONDecodeError is a subclass
+                    pass
+                else:
+                    if isinstance(result, dict) and len(str(result.get('sql_query', ''))) > MAX_SQL_LENGTH:
+                        return self._too_long_error()
+                    self.query_cache.set(cache_key, result)
+                    return result
+            # Fallback: try to extract SQL from text
+            sql_match = _SQL_RE.search(ai_response)
+            if sql_match:
+                if len(sql_match.group(0)) > MAX_SQL_LENGTH:
+                    return self._too_long_error()
+                return {
+                    'sql_query': sql_match.group(0),
+                    'explanation': 'Сгенерированный SQL-запрос',
+                    'parameters': []
+                }
         return None
 
+    @staticmethod
+    def _too_long_error() -> dict:
+        """Result for a generated statement over MAX_SQL_LENGTH"""
+        logger.warning(f"Отклонен SQL-запрос длиннее {MAX_SQL_LENGTH} символов")
+        return {'error': "❌ Сгенерированный запрос слишком длинный. Пожалуйста, уточните вопрос."}
+
     async def execute_query(self, sql_query: str, parameters: list = None) -> list:
         """Execute SQL query against Supabase"""
+        # Generated queries are only allowed to read data
+        if not _is_read_only_sql(sql_query):
+            logger.warning(f"Отклонен SQL-запрос, не являющийся SELECT: {sql_query!r:.200}")
+            return []
         try:
             # Note: This is a simplified implementation. In production, you should
-            # use proper SQL execution through Supabase's RPC or direct SQL
-            response = supabase.rpc('exec_sql', {'query': sql_query, 'params': parameters or []}).execute()
+            # use proper SQL execution through Supabase's RPC or direct SQL.
+            # The blocking HTTP call runs in a worker thread to keep the event loop free.
+            rpc = supabase.rpc('exec_sql', {'query': sql_query, 'params': parameters or []})
+            response = await asyncio.to_thread(rpc.execute)
             return response.data if response.data else []
         except Exception as e:
             logger.error(f"Ошибка выполнения SQL: {e}")
@@ -2451,30 +3543,78 @@ class NaturalLanguageToSQL:
 nl_to_sql = NaturalLanguageToSQL()
 
 
+# Number formatters for per-device report lines (format spec parsed once)
+_F1 = "{:.1f}".format
+_F2 = "{:.2f}".format
+_F3 = "{:.3f}".format
+
+
+# Header block of a device in the /devices report
+_DEVICE_STATUS_TEMPLATE = (
+    "{emoji} <b>{name}</b> ({location})\n"
+    "ID: {id}\n"
+    "Состояние: {state}\n"
+    "Счетчик: {counter:.3f} кВт·ч\n"
+)
+
+# Карточка устройства в /list_devices
+_DEVICE_CONFIG_TEMPLATE = (
+    "{emoji} <b>{name}</b>\n"
+    "ID: {id}\n"
+    "Локация: {location}\n"
+    "Статус: {status}\n"
+    "Создано: {created}\n"
+    "Обновлено: {updated}\n"
+)
+
+
+# Bot command menu, built once at import
+BOT_COMMANDS = (
+    types.BotCommand(command="start", description="Запустить бота"),
+    types.BotCommand(command="help", description="Показать справку"),
+    types.BotCommand(command="today", description="Статистика за сегодня и прогноз"),
+    types.BotCommand(command="last", description="Доходность за последние 3 дня"),
+    types.BotCommand(command="profit24h", description="24-часовая доходность"),
+    types.BotCommand(command="profit7d", description="Недельная доходность"),
+    types.BotCommand(command="profit30d", description="Месячная доходность"),
+    types.BotCommand(command="profitall", description="Доходность за все периоды"),
+    types.BotCommand(command="devices", description="Статус устройств"),
+    types.BotCommand(command="api_status", description="Статус API"),
+    types.BotCommand(command="ai_analyze", description="AI-анализ ситуации"),
+    types.BotCommand(command="ai_forecast", description="AI-прогноз потребления"),
+    types.BotCommand(command="ai_optimize", description="AI-оптимизация доходности"),
+    types.BotCommand(command="ai_health", description="AI-проверка системы"),
+    types.BotCommand(command="clear", description="Очистить историю чата"),
+    types.BotCommand(command="chat", description="Общение с AI-помощником"),
+    types.BotCommand(command="electricity_today", description="Реальное потребление электроэнергии за сегодня"),
+    types.BotCommand(command="electricity_72h", description="Реальное потребление электроэнергии за 72 часа"),
+)
+# Hash of the last command menu sent to Telegram, kept with the bot's local data
+BOT_COMMANDS_HASH_FILE = ELECTRICITY_DATA_DIR / ".commands_hash"
+
+
 # Setup bot commands
 async def setup_bot_commands():
-    """Setup bot command menu"""
-    commands = [
-        types.BotCommand(command="start", description="Запустить бота"),
-        types.BotCommand(command="help", description="Показать справку"),
-        types.BotCommand(command="today", description="Статистика за сегодня и прогноз"),
-        types.BotCommand(command="last", description="Доходность за последние 3 дня"),
-        types.BotCommand(command="profit24h", description="24-часовая доходность"),
-        types.BotCommand(command="profit7d", description="Недельная доходность"),
-        types.BotCommand(command="profit30d", description="Месячная доходность"),
-        types.BotCommand(command="profitall", description="Доходность за все периоды"),
-        types.BotCommand(command="devices", description="Статус устройств"),
-        types.BotCommand(command="api_status", description="Статус API"),
-        types.BotCommand(command="ai_analyze", description="AI-анализ ситуации"),
-        types.BotCommand(command="ai_forecast", description="AI-прогноз потребления"),
-        types.BotCommand(command="ai_optimize", description="AI-оптимизация доходности"),
-        types.BotCommand(command="ai_health", description="AI-проверка системы"),
-        types.BotCommand(command="clear", description="Очистить историю чата"),
-        types.BotCommand(command="chat", description="Общение с AI-помощником"),
-        types.BotCommand(command="electricity_today", description="Реальное потребление электроэнергии за сегодня"),
-        types.BotCommand(command="electricity_72h", description="Реальное потребление электроэнергии за 72 часа")
-    ]
-    await bot.set_my_commands(commands)
+    """Setup bot command menu (only when it changed since the last start)"""
+    commands_hash = hashlib.blake2b(
+        repr([(command.command, command.description) for command in BOT_COMMANDS]).encode(),
+        digest_size=16
+    ).hexdigest()
+    try:
+        with open(BOT_COMMANDS_HASH_FILE, "r", encoding="utf-8") as f:
+            if f.read().strip() == commands_hash:
+                logger.info("Меню команд не изменилось, обновление не требуется")
+                return
+    except FileNotFoundError:
+        pass
+
+    await bot.set_my_commands(list(BOT_COMMANDS))
+    try:
+        BOT_COMMANDS_HASH_FILE.parent.mkdir(exist_ok=True)
+        with open(BOT_COMMANDS_HASH_FILE, "w", encoding="utf-8") as f:
+            f.write(commands_hash)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить хэш меню команд: {e}")
 
 
 # Telegram Bot Handlers
@@ -2519,6 +3659,7 @@ async def cmd_help(message: types.Message):
 /add_device - Добавить новое устройство (только для админа)
 /update_device - Обновить устройство (только для админа)
 /delete_device - Удалить устройство (только для админа)
+/backfill [дней] - Пересчитать доходность за прошедшие дни (только для админа)
 /api_status - Показать статус использования Tuya AI
 /ai_analyze - AI-анализ текущей ситуации майнинга
 /ai_forecast [период] - AI-прогноз энергопотребления (24h, 7d, 30d)
@@ -2572,26 +3713,27 @@ async def cmd_api_status(message: types.Message):
     cache_size = len(data_cache.cache)
     rate_info = ExchangeRateManager.get_rate_info()
 
-    status_text = f"📊 <b>Статус Tuya AI:</b>\n\n"
-    status_text += f"📈 Запросов сегодня: {status['requests_today']}/{status['daily_limit']}\n"
-    status_text += f"⚡ Запросов в секунду: {status['requests_per_second']}/{status['second_limit']}\n"
-    status_text += f"💾 Кэшированных записей: {cache_size}\n\n"
+    parts = [f"📊 <b>Статус Tuya AI:</b>\n\n"]
+    parts.append(f"📈 Запросов сегодня: {status['requests_today']}/{status['daily_limit']}\n")
+    parts.append(f"⚡ Запросов в секунду: {status['requests_per_second']}/{status['second_limit']}\n")
+    parts.append(f"💾 Кэшированных записей: {cache_size}\n")
+    parts.append(f"🧠 Кэш SQL-запросов: {nl_to_sql.cache_hits} попаданий / {nl_to_sql.cache_misses} промахов\n\n")
 
-    status_text += f"💱 <b>Курс валюты:</b>\n"
+    parts.append(f"💱 <b>Курс валюты:</b>\n")
     if rate_info['rate']:
-        status_text += f"Источник: {rate_info['source']}\n"
-        status_text += f"Курс: 1 USDT = {rate_info['rate']:.2f} RUB\n"
+        parts.append(f"Источник: {rate_info['source']}\n")
+        parts.append(f"Курс: 1 USDT = {rate_info['rate']:.2f} RUB\n")
         if rate_info['timestamp']:
-            status_text += f"Обновлен: {rate_info['timestamp'].strftime('%H:%M:%S')}\n"
+            parts.append(f"Обновлен: {rate_info['timestamp'].strftime('%H:%M:%S')}\n")
     else:
-        status_text += "❌ Курс недоступен\n"
+        parts.append("❌ Курс недоступен\n")
 
     if status['requests_today'] > status['daily_limit'] * 0.8:
-        status_text += "\n⚠️ <b>Внимание!</b> Вы приближаетесь к дневному лимиту AI!\n"
+        parts.append("\n⚠️ <b>Внимание!</b> Вы приближаетесь к дневному лимиту AI!\n")
     if status['requests_per_second'] > status['second_limit'] * 0.8:
-        status_text += "⚠️ <b>Внимание!</b> Высокая нагрузка на AI!\n"
+        parts.append("⚠️ <b>Внимание!</b> Высокая нагрузка на AI!\n")
 
-    await message.reply(status_text, parse_mode=ParseMode.HTML)
+    await message.reply(''.join(parts), parse_mode=ParseMode.HTML)
 
 
 @dp.message(Command("last"))
@@ -2603,81 +3745,38 @@ async def cmd_last(message: types.Message):
     data_3d, avg_daily_data = calculate_3day_profitability()
 
     if data_3d and avg_daily_data:
-        response_text = format_profitability_message(data_3d, show_details=False)
-
-        # Fix for average daily data - use the actual values from data_3d
-        fixed_avg_daily_data = {
-            "period_name": "Среднесуточная за 3 дня",
-            "total_income_usdt": data_3d.get("total_income_usdt", 0) / 3,
-            "total_income_rub": data_3d.get("total_income_rub", 0) / 3,
-            "total_cost": data_3d.get("total_cost", 0) / 3,
-            "net_profit": data_3d.get("net_profit", 0) / 3,
-            "profitability_percentage": data_3d.get("profitability_percentage", 0),
-            "exchange_rate": data_3d.get("exchange_rate"),
-            "exchange_rate_source": data_3d.get("exchange_rate_source", "CoinGecko"),
-            "sales_count": max(1, data_3d.get("sales_count", 0) // 3),  # Avoid division by zero
-            "location_stats": data_3d.get("location_stats", {})
-        }
+        parts = [format_profitability_message(data_3d, show_details=False)]
 
-        response_text += f"\n\n{format_profitability_message(fixed_avg_daily_data, show_details=False)}"
+        parts.append(f"\n\n{format_profitability_message(avg_daily_data, show_details=False)}")
 
         # Добавляем прогноз на следующие 3 дня на основе текущей мощности
         current_consumption = get_current_power_consumption()
         total_current_power = sum(loc['total_power_w'] for loc in current_consumption.values())
 
         if total_current_power > 0:
-            # Получаем прогноз для каждой локации
-            forecasts = {}
+            # Получаем прогноз для каждой локации (параллельно)
+            forecast_args = []
             for location, data in current_consumption.items():
                 if data['total_power_w'] > 0:
-                    # Находим device_id для локации
-                    device_id = None
-                    for device in DEVICES:
-                        if device["location"] == location:
-                            device_id = device["device_id"]
-                            break
+                    device_id = LOCATION_TO_DEVICE_ID.get(location)
+                    forecast_args.append((data['total_power_w'], location, device_id))
 
-                    forecasts[location] = estimate_profitability(
-                        data['total_power_w'], location, device_id, days=3
-                    )
+            forecast_results = await asyncio.gather(*[
+                asyncio.to_thread(estimate_profitability, power, location, device_id, 3)
+                for power, location, device_id in forecast_args
+            ])
+            forecasts = {location: forecast
+                         for (_, location, _), forecast in zip(forecast_args, forecast_results)}
 
             # Суммируем прогнозы по всем локациям
             if forecasts:
-                total_forecast_energy = sum(f['estimated_energy_kwh'] for f in forecasts.values())
-                total_forecast_cost = sum(f['estimated_cost_rub'] for f in forecasts.values())
-                total_forecast_income = sum(f['estimated_income_usdt'] for f in forecasts.values())
-                total_forecast_profit = sum(f['estimated_profit_rub'] for f in forecasts.values())
-
-                # Рассчитываем среднюю рентабельность
-                if total_forecast_cost > 0:
-                    avg_profitability = (total_forecast_profit / total_forecast_cost) * 100
-                else:
-                    avg_profitability = 0
-
-                # Определяем общий уровень достоверности
-                confidences = [f.get('confidence', 'medium') for f in forecasts.values()]
-                overall_confidence = 'high' if 'high' in confidences else 'medium'
-
-                # Формируем общий прогноз
-                combined_forecast = {
-                    "period_days": 3,
-                    "estimated_energy_kwh": total_forecast_energy,
-                    "estimated_cost_rub": total_forecast_cost,
-                    "estimated_income_usdt": total_forecast_income,
-                    "estimated_profit_rub": total_forecast_profit,
-                    "profitability_percentage": avg_profitability,
-                    "day_energy": sum(f['day_energy'] for f in forecasts.values()),
-                    "night_energy": sum(f['night_energy'] for f in forecasts.values()),
-                    "day_rate": forecasts[list(forecasts.keys())[0]]['day_rate'],
-                    "night_rate": forecasts[list(forecasts.keys())[0]]['night_rate'],
-                    "confidence": overall_confidence
-                }
+                combined_forecast = build_combined_forecast(forecasts, 3)
 
-                response_text += f"\n\n{format_profitability_forecast_message(combined_forecast)}"
+                parts.append(f"\n\n{format_profitability_forecast_message(combined_forecast)}")
     else:
-        response_text = "❌ Не удалось рассчитать 3-дневную доходность"
+        parts = ["❌ Не удалось рассчитать 3-дневную доходность"]
 
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+    await message.reply(''.join(parts), parse_mode=ParseMode.HTML)
 
 
 @dp.message(Command("profit24h"))
@@ -2735,15 +3834,14 @@ async def cmd_profitall(message: types.Message):
 
     end_date = datetime.now()
 
-    # Рассчитываем доходность за разные периоды
-    data_24h = calculate_profitability_for_period(end_date - timedelta(days=1), end_date, "24 часа")
-    data_3d = calculate_profitability_for_period(end_date - timedelta(days=3), end_date, "3 дня")
-    data_7d = calculate_profitability_for_period(end_date - timedelta(days=7), end_date, "7 дней")
-    data_30d = calculate_profitability_for_period(end_date - timedelta(days=30), end_date, "30 дней")
+    # Рассчитываем доходность за разные периоды (данные загружаются одним запросом)
+    period_results = calculate_profitability_multi(
+        end_date, [(1, "24 часа"), (3, "3 дня"), (7, "7 дней"), (30, "30 дней")]
+    )
 
-    response_text = "📊 <b>Сводная доходность за все периоды:</b>\n\n"
+    parts = ["📊 <b>Сводная доходность за все периоды:</b>\n\n"]
 
-    for data in [data_24h, data_3d, data_7d, data_30d]:
+    for data in period_results:
         if data:
             period_name = data["period_name"]
             net_profit = data.get("net_profit", 0)
@@ -2751,12 +3849,12 @@ async def cmd_profitall(message: types.Message):
             avg_daily_profit = data.get("avg_daily_profit", net_profit)
 
             profit_emoji = "🟢" if net_profit >= 0 else "🔴"
-            response_text += f"{profit_emoji} <b>{period_name}:</b>\n"
-            response_text += f"   💰 Прибыль: {net_profit:.2f} RUB\n"
-            response_text += f"   📊 Рентабельность: {profitability_percentage:.2f}%\n"
-            response_text += f"   📈 Среднесуточно: {avg_daily_profit:.2f} RUB\n\n"
+            parts.append(f"{profit_emoji} <b>{period_name}:</b>\n")
+            parts.append(f"   💰 Прибыль: {net_profit:.2f} RUB\n")
+            parts.append(f"   📊 Рентабельность: {profitability_percentage:.2f}%\n")
+            parts.append(f"   📈 Среднесуточно: {avg_daily_profit:.2f} RUB\n\n")
 
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+    await message.reply(''.join(parts), parse_mode=ParseMode.HTML)
 
 
 @dp.message(Command("today"))
@@ -2771,7 +3869,8 @@ async def cmd_today(message: types.Message):
     current_consumption = get_current_power_consumption()
 
     # Рассчитываем реальную доходность за сегодня
-    today = datetime.now().date()
+    now = datetime.now()
+    today = now.date()
     start_date = datetime.combine(today, datetime.min.time())
     end_date = start_date + timedelta(days=1)
     profitability_data = calculate_profitability_for_period(start_date, end_date,
@@ -2781,7 +3880,18 @@ async def cmd_today(message: types.Message):
         await message.reply("📊 За сегодня еще нет данных о потреблении и устройства выключены.")
         return
 
-    response_text = f"📊 <b>Статистика за сегодня ({datetime.now().strftime('%d.%m.%Y')}):</b>\n\n"
+    # Прогноз потребления на 24 часа для каждой работающей локации считается один раз
+    # и используется и для прогноза доходности, и для блока локации. Оценка не линейна
+    # по мощности (историческая коррекция, тарифы локации), поэтому она считается по
+    # локациям, а не масштабированием общего прогноза
+    consumption_forecasts = {
+        location: enhanced_estimate_24h_consumption(data['total_power_w'], location,
+                                                    LOCATION_TO_DEVICE_ID.get(location))
+        for location, data in current_consumption.items()
+        if data['total_power_w'] > 0
+    }
+
+    parts = [f"📊 <b>Статистика за сегодня ({today.strftime('%d.%m.%Y')}):</b>\n\n"]
 
     # Добавляем информацию о реальной доходности
     if profitability_data:
@@ -2795,14 +3905,14 @@ async def cmd_today(message: types.Message):
         exchange_rate_source = profitability_data.get("exchange_rate_source", "CoinGecko")
 
         profit_emoji = "🟢" if net_profit >= 0 else "🔴"
-        response_text += f"{profit_emoji} <b>Реальная доходность:</b>\n"
-        response_text += f"💰 Доход от продаж: {total_income_usdt:.2f} USDT ({total_income_rub:.2f} RUB)\n"
+        parts.append(f"{profit_emoji} <b>Реальная доходность:</b>\n")
+        parts.append(f"💰 Доход от продаж: {total_income_usdt:.2f} USDT ({total_income_rub:.2f} RUB)\n")
         if exchange_rate:
-            response_text += f"💱 Курс: {exchange_rate_source}: {exchange_rate:.2f} руб\n"
-        response_text += f"💸 Затраты на электричество: {total_cost:.2f} RUB\n"
-        response_text += f"📈 Чистая прибыль: {net_profit:.2f} RUB\n"
-        response_text += f"📊 Рентабельность: {profitability_percentage:.2f}%\n"
-        response_text += f"🛒 Продажи: {sales_count} шт.\n\n"
+            parts.append(f"💱 Курс: {exchange_rate_source}: {exchange_rate:.2f} руб\n")
+        parts.append(f"💸 Затраты на электричество: {total_cost:.2f} RUB\n")
+        parts.append(f"📈 Чистая прибыль: {net_profit:.2f} RUB\n")
+        parts.append(f"📊 Рентабельность: {profitability_percentage:.2f}%\n")
+        parts.append(f"🛒 Продажи: {sales_count} шт.\n\n")
 
     # Если продаж сегодня не было, добавляем прогноз
     if not profitability_data or profitability_data.get("sales_count", 0) == 0:
@@ -2814,111 +3924,71 @@ async def cmd_today(message: types.Message):
             forecasts = {}
             for location, data in current_consumption.items():
                 if data['total_power_w'] > 0:
-                    # Находим device_id для локации
-                    device_id = None
-                    for device in DEVICES:
-                        if device["location"] == location:
-                            device_id = device["device_id"]
-                            break
+                    device_id = LOCATION_TO_DEVICE_ID.get(location)
 
                     forecasts[location] = estimate_profitability(
-                        data['total_power_w'], location, device_id
+                        data['total_power_w'], location, device_id,
+                        consumption_forecast=consumption_forecasts[location]
                     )
 
             # Суммируем прогнозы по всем локациям
             if forecasts:
-                total_forecast_energy = sum(f['estimated_energy_kwh'] for f in forecasts.values())
-                total_forecast_cost = sum(f['estimated_cost_rub'] for f in forecasts.values())
-                total_forecast_income = sum(f['estimated_income_usdt'] for f in forecasts.values())
-                total_forecast_profit = sum(f['estimated_profit_rub'] for f in forecasts.values())
-
-                # Рассчитываем среднюю рентабельность
-                if total_forecast_cost > 0:
-                    avg_profitability = (total_forecast_profit / total_forecast_cost) * 100
-                else:
-                    avg_profitability = 0
-
-                # Определяем общий уровень достоверности
-                confidences = [f.get('confidence', 'medium') for f in forecasts.values()]
-                overall_confidence = 'high' if 'high' in confidences else 'medium'
-
-                # Формируем общий прогноз
-                combined_forecast = {
-                    "period_days": 1,
-                    "estimated_energy_kwh": total_forecast_energy,
-                    "estimated_cost_rub": total_forecast_cost,
-                    "estimated_income_usdt": total_forecast_income,
-                    "estimated_profit_rub": total_forecast_profit,
-                    "profitability_percentage": avg_profitability,
-                    "day_energy": sum(f['day_energy'] for f in forecasts.values()),
-                    "night_energy": sum(f['night_energy'] for f in forecasts.values()),
-                    "day_rate": forecasts[list(forecasts.keys())[0]]['day_rate'],
-                    "night_rate": forecasts[list(forecasts.keys())[0]]['night_rate'],
-                    "confidence": overall_confidence
-                }
+                combined_forecast = build_combined_forecast(forecasts, 1)
 
-                response_text += f"🔮 <b>Прогноз доходности на сегодня:</b>\n"
-                response_text += f"⚡ Прогноз потребления: {total_forecast_energy:.3f} кВт·ч\n"
-                response_text += f"💰 Прогноз дохода: {total_forecast_income:.2f} USDT\n"
-                response_text += f"💸 Прогноз затрат: {total_forecast_cost:.2f} RUB\n"
-                response_text += f"📈 Прогноз прибыли: {total_forecast_profit:.2f} RUB\n"
-                response_text += f"📊 Прогноз рентабельности: {avg_profitability:.2f}%\n\n"
+                parts.append(f"🔮 <b>Прогноз доходности на сегодня:</b>\n")
+                parts.append(f"⚡ Прогноз потребления: {combined_forecast['estimated_energy_kwh']:.3f} кВт·ч\n")
+                parts.append(f"💰 Прогноз дохода: {combined_forecast['estimated_income_usdt']:.2f} USDT\n")
+                parts.append(f"💸 Прогноз затрат: {combined_forecast['estimated_cost_rub']:.2f} RUB\n")
+                parts.append(f"📈 Прогноз прибыли: {combined_forecast['estimated_profit_rub']:.2f} RUB\n")
+                parts.append(f"📊 Прогноз рентабельности: {combined_forecast['profitability_percentage']:.2f}%\n\n")
 
     # Обрабатываем все локации
-    all_locations = set(stats.keys()).union(current_consumption.keys())
+    all_locations = stats.keys() | current_consumption.keys()
 
     for location in all_locations:
-        response_text += f"📍 <b>{location}</b>\n"
+        parts.append(f"📍 <b>{location}</b>\n")
 
         # Фактическое потребление за сегодня
         if location in stats:
             data = stats[location]
             source = data.get("source", "Database")
-            response_text += f"<b>📈 Фактическое за сегодня ({source}):</b>\n"
-            response_text += f"⚡ Потребление: {data['total_energy']:.3f} кВт·ч\n"
-            response_text += f"💰 Стоимость: {data['total_cost']:.2f} руб.\n"
-            response_text += f"☀️ День: {data['day_energy']:.3f} кВт·ч\n"
-            response_text += f"🌙 Ночь: {data['night_energy']:.3f} кВт·ч\n\n"
+            parts.append(f"<b>📈 Фактическое за сегодня ({source}):</b>\n")
+            parts.append(f"⚡ Потребление: {data['total_energy']:.3f} кВт·ч\n")
+            parts.append(f"💰 Стоимость: {data['total_cost']:.2f} руб.\n")
+            parts.append(f"☀️ День: {data['day_energy']:.3f} кВт·ч\n")
+            parts.append(f"🌙 Ночь: {data['night_energy']:.3f} кВт·ч\n\n")
 
             # Детализация по устройствам
             if data["devices"]:
-                response_text += "<b>🔌 Устройства (факт):</b>\n"
+                parts.append("<b>🔌 Устройства (факт):</b>\n")
                 for device_id, device_data in data["devices"].items():
-                    response_text += f"• {device_data['name']}: {device_data['energy']:.3f} кВт·ч ({device_data['cost']:.2f} руб.)\n"
-                response_text += "\n"
+                    parts.append(f"• {device_data['name']}: {_F3(device_data['energy'])} кВт·ч ({_F2(device_data['cost'])} руб.)\n")
+                parts.append("\n")
 
         # Текущее потребление и прогноз
         if location in current_consumption:
             current_data = current_consumption[location]
             current_power = current_data['total_power_w']
-            response_text += f"<b>⚡ Текущая мощность:</b> {current_power:.1f} Вт\n"
+            parts.append(f"<b>⚡ Текущая мощность:</b> {current_power:.1f} Вт\n")
 
             if current_power > 0:
-                # Находим device_id для локации
-                device_id = None
-                for device in DEVICES:
-                    if device["location"] == location:
-                        device_id = device["device_id"]
-                        break
-
-                # Рассчитываем прогноз
-                forecast = enhanced_estimate_24h_consumption(current_power, location, device_id)
-                response_text += f"<b>🔮 Прогноз на 24 часа:</b>\n"
-                response_text += f"⚡ Потребление: {forecast['estimated_kwh']:.3f} кВт·ч\n"
-                response_text += f"💰 Стоимость: {forecast['estimated_cost']:.2f} руб.\n"
-                response_text += f"☀️ День: {forecast['day_energy']:.3f} кВт·ч ({forecast['day_rate']} руб/кВт·ч)\n"
-                response_text += f"🌙 Ночь: {forecast['night_energy']:.3f} кВт·ч ({forecast['night_rate']} руб/кВт·ч)\n\n"
+                forecast = consumption_forecasts[location]
+                parts.append(f"<b>🔮 Прогноз на 24 часа:</b>\n")
+                parts.append(f"⚡ Потребление: {forecast['estimated_kwh']:.3f} кВт·ч\n")
+                parts.append(f"💰 Стоимость: {forecast['estimated_cost']:.2f} руб.\n")
+                parts.append(f"☀️ День: {forecast['day_energy']:.3f} кВт·ч ({forecast['day_rate']} руб/кВт·ч)\n")
+                parts.append(f"🌙 Ночь: {forecast['night_energy']:.3f} кВт·ч ({forecast['night_rate']} руб/кВт·ч)\n\n")
 
                 # Детализация по устройствам
-                response_text += "<b>🔌 Устройства (текущее):</b>\n"
+                parts.append("<b>🔌 Устройства (текущее):</b>\n")
                 for device in current_data['devices']:
                     status_emoji = "🟢" if device['is_on'] else "🔴"
-                    response_text += f"{status_emoji} {device['name']}: {device['power_w']:.1f} Вт\n"
+                    parts.append(f"{status_emoji} {device['name']}: {_F1(device['power_w'])} Вт\n")
             else:
-                response_text += "\n<b>🔮 Прогноз на 24 часа:</b>\n"
-                response_text += "Все устройства выключены\n"
+                parts.append("\n<b>🔮 Прогноз на 24 часа:</b>\n")
+                parts.append("Все устройства выключены\n")
 
-        response_text += "\n" + "-" * 30 + "\n\n"
+        parts.append("\n" + "-" * 30 + "\n\n")
 
     # Добавляем общую сводку
     total_today_energy = sum(data['total_energy'] for data in stats.values())
@@ -2927,19 +3997,18 @@ async def cmd_today(message: types.Message):
 
     if total_current_power > 0:
         total_forecast = enhanced_estimate_24h_consumption(total_current_power, "Общее")
-        response_text += f"<b>📊 ОБЩАЯ СВОДКА:</b>\n"
-        response_text += f"Факт за сегодня: {total_today_energy:.3f} кВт·ч ({total_today_cost:.2f} руб.)\n"
-        response_text += f"Текущая мощность: {total_current_power:.1f} Вт\n"
-        response_text += f"Прогноз на 24ч: {total_forecast['estimated_kwh']:.3f} кВт·ч ({total_forecast['estimated_cost']:.2f} руб.)\n"
+        parts.append(f"<b>📊 ОБЩАЯ СВОДКА:</b>\n")
+        parts.append(f"Факт за сегодня: {total_today_energy:.3f} кВт·ч ({total_today_cost:.2f} руб.)\n")
+        parts.append(f"Текущая мощность: {total_current_power:.1f} Вт\n")
+        parts.append(f"Прогноз на 24ч: {total_forecast['estimated_kwh']:.3f} кВт·ч ({total_forecast['estimated_cost']:.2f} руб.)\n")
 
         # Рассчитываем экономию/перерасход
         if total_today_energy > 0:
-            hours_passed = (datetime.now() - datetime.now().replace(hour=0, minute=0, second=0,
-                                                                    microsecond=0)).total_seconds() / 3600
+            hours_passed = (now - start_date).total_seconds() / 3600
             avg_power = (total_today_energy / hours_passed) * 1000 if hours_passed > 0 else 0
-            response_text += f"Средняя мощность: {avg_power:.0f} Вт\n"
+            parts.append(f"Средняя мощность: {avg_power:.0f} Вт\n")
 
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+    await message.reply(''.join(parts), parse_mode=ParseMode.HTML)
 
 
 @dp.message(Command("devices"))
@@ -2947,48 +4016,73 @@ async def cmd_devices(message: types.Message):
     """Обработчик команды /devices"""
     logger.info(f"Пользователь {message.from_user.id} запросил статус устройств")
 
-    response_text = "🔌 <b>Текущий статус устройств:</b>\n\n"
-    total_power = 0
-    active_devices = 0
+    parts = ["🔌 <b>Текущий статус устройств:</b>\n\n"]
 
-    for device in DEVICES:
+    # Опрашиваем все устройства одним пакетным запросом
+    devices = list(DEVICES)
+    statuses_by_id = await asyncio.to_thread(
+        get_device_statuses_batch, [device["device_id"] for device in devices]
+    )
+    statuses = [statuses_by_id[device["device_id"]] for device in devices]
+
+    # Мощность и признак активности устройств в виде массивов для сводки
+    powers = np.array([float(data['cur_power']) if data and 'cur_power' in data else 0.0
+                       for _, _, data in statuses], dtype=np.float64)
+    active_mask = np.array([bool(is_on) and bool(data) and 'cur_power' in data
+                            for is_on, _, data in statuses], dtype=bool)
+    total_power = float(powers[active_mask].sum())
+    active_devices = int(active_mask.sum())
+
+    for device, (is_on, counter, device_data) in zip(devices, statuses):
         device_id = device["device_id"]
         device_name = device["name"]
         location = device["location"]
 
-        is_on, counter, device_data = get_device_status_cloud_enhanced(device_id)
-
-        status_emoji = "🟢" if is_on else "🔴"
-        response_text += f"{status_emoji} <b>{device_name}</b> ({location})\n"
-        response_text += f"ID: {device_id}\n"
-        response_text += f"Состояние: {'ВКЛ' if is_on else 'ВЫКЛ'}\n"
-        response_text += f"Счетчик: {counter:.3f} кВт·ч\n"
+        parts.append(_DEVICE_STATUS_TEMPLATE.format_map({
+            "emoji": "🟢" if is_on else "🔴",
+            "name": device_name,
+            "location": location,
+            "id": device_id,
+            "state": "ВКЛ" if is_on else "ВЫКЛ",
+            "counter": counter
+        }))
 
         if device_data:
             if 'cur_power' in device_data:
                 power = device_data['cur_power']
-                response_text += f"Мощность: {power:.1f} Вт\n"
-                if is_on:
-                    total_power += power
-                    active_devices += 1
+                parts.append(f"Мощность: {_F1(power)} Вт\n")
             if 'cur_voltage' in device_data:
-                response_text += f"Напряжение: {device_data['cur_voltage']:.1f} В\n"
+                parts.append(f"Напряжение: {_F1(device_data['cur_voltage'])} В\n")
             if 'cur_current' in device_data:
-                response_text += f"Ток: {device_data['cur_current']:.2f} А\n"
+                parts.append(f"Ток: {_F2(device_data['cur_current'])} А\n")
 
-        response_text += "\n"
+        parts.append("\n")
 
     # Добавляем сводку
-    response_text += f"<b>📊 СВОДКА:</b>\n"
-    response_text += f"Всего устройств: {len(DEVICES)}\n"
-    response_text += f"Активных: {active_devices}\n"
-    response_text += f"Общая мощность: {total_power:.1f} Вт ({total_power / 1000:.2f} кВт)\n"
+    parts.append(f"<b>📊 СВОДКА:</b>\n")
+    parts.append(f"Всего устройств: {len(DEVICES)}\n")
+    parts.append(f"Активных: {active_devices}\n")
+    parts.append(f"Общая мощность: {total_power:.1f} Вт ({total_power / 1000:.2f} кВт)\n")
 
     if total_power > 0:
         daily_cost = (total_power / 1000) * 24 * 5.5  # Примерный расчет
-        response_text += f"Примерная стоимость за сутки: {daily_cost:.2f} руб."
+        parts.append(f"Примерная стоимость за сутки: {daily_cost:.2f} руб.")
+
+    await message.reply(''.join(parts), parse_mode=ParseMode.HTML)
+
+
+def parse_command_args(text: str) -> List[str]:
+    """Разбирает аргументы команды за один проход с поддержкой названий в кавычках"""
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        # Незакрытая кавычка - разбираем по пробелам
+        tokens = text.split()
+    return tokens[1:]
 
-    await message.reply(response_text, parse_mode=ParseMode.HTML)
+
+# Значения флага active для /update_device; остальные значения не меняют флаг
+_ACTIVE_FLAGS = {"true": True, "false": False}
 
 
 @dp.message(Command("add_device"))
@@ -2997,12 +4091,12 @@ async def cmd_add_device(message: types.Message):
     logger.info(f"Пользователь {message.from_user.id} запросил добавление устройства")
     
     # Проверяем права администратора
-    if str(message.from_user.id) != TELEGRAM_ADMIN_ID:
+    if message.from_user.id != ADMIN_ID_INT:
         await message.reply("❌ У вас нет прав для выполнения этой команды.")
         return
     
     # Парсим аргументы команды: /add_device device_id name location
-    args = message.text.split()[1:]
+    args = parse_command_args(message.text)
     if len(args) < 3:
         await message.reply(
             "❌ Неправильный формат команды.\n"
@@ -3017,8 +4111,6 @@ async def cmd_add_device(message: types.Message):
     
     # Добавляем устройство в базу данных
     if add_device_to_database(device_id, name, location):
-        # Обновляем список устройств
-        refresh_devices_from_database()
         await message.reply(
             f"✅ Устройство успешно добавлено!\n"
             f"ID: {device_id}\n"
@@ -3035,12 +4127,12 @@ async def cmd_update_device(message: types.Message):
     logger.info(f"Пользователь {message.from_user.id} запросил обновление устройства")
     
     # Проверяем права администратора
-    if str(message.from_user.id) != TELEGRAM_ADMIN_ID:
+    if message.from_user.id != ADMIN_ID_INT:
         await message.reply("❌ У вас нет прав для выполнения этой команды.")
         return
     
     # Парсим аргументы команды: /update_device device_id [name] [location] [active]
-    args = message.text.split()[1:]
+    args = parse_command_args(message.text)
     if len(args) < 2:
         await message.reply(
             "❌ Неправильный формат команды.\n"
@@ -3049,15 +4141,14 @@ async def cmd_update_device(message: types.Message):
         )
         return
     
-    device_id = args[0]
-    name = args[1] if len(args) > 1 and args[1] != "null" else None
-    location = args[2] if len(args) > 2 and args[2] != "null" else None
-    is_active = args[3].lower() == "true" if len(args) > 3 else None
+    # Недостающие аргументы дополняются "null" - поле не обновляется
+    device_id, name, location, active_flag = (args + ["null"] * 3)[:4]
+    name = None if name == "null" else name
+    location = None if location == "null" else location
+    is_active = _ACTIVE_FLAGS.get(active_flag.lower())
     
     # Обновляем устройство в базе данных
     if update_device_in_database(device_id, name, location, is_active):
-        # Обновляем список устройств
-        refresh_devices_from_database()
         await message.reply(
             f"✅ Устройство {device_id} успешно обновлено!\n"
             f"Обновленные поля: {[k for k, v in [('name', name), ('location', location), ('is_active', is_active)] if v is not None]}"
@@ -3072,12 +4163,12 @@ async def cmd_delete_device(message: types.Message):
     logger.info(f"Пользователь {message.from_user.id} запросил удаление устройства")
     
     # Проверяем права администратора
-    if str(message.from_user.id) != TELEGRAM_ADMIN_ID:
+    if message.from_user.id != ADMIN_ID_INT:
         await message.reply("❌ У вас нет прав для выполнения этой команды.")
         return
     
     # Парсим аргументы команды: /delete_device device_id
-    args = message.text.split()[1:]
+    args = parse_command_args(message.text)
     if len(args) < 1:
         await message.reply(
             "❌ Неправильный формат команды.\n"
@@ -3090,13 +4181,54 @@ async def cmd_delete_device(message: types.Message):
     
     # Удаляем устройство из базы данных (деактивируем)
     if delete_device_from_database(device_id):
-        # Обновляем список устройств
-        refresh_devices_from_database()
         await message.reply(f"✅ Устройство {device_id} успешно деактивировано!")
     else:
         await message.reply("❌ Ошибка при удалении устройства. Проверьте логи.")
 
 
+BACKFILL_MAX_DAYS = 90  # максимальная глубина пересчета доходности
+
+
+@dp.message(Command("backfill"))
+async def cmd_backfill(message: types.Message):
+    """Обработчик команды /backfill для пересчета доходности за прошедшие дни"""
+    logger.info(f"Пользователь {message.from_user.id} запросил пересчет доходности")
+    
+    # Проверяем права администратора
+    if message.from_user.id != ADMIN_ID_INT:
+        await message.reply("❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    # Парсим аргументы команды: /backfill [дней]
+    args = parse_command_args(message.text)
+    try:
+        days = int(args[0]) if args else 7
+    except ValueError:
+        days = 0
+    if not 1 <= days <= BACKFILL_MAX_DAYS:
+        await message.reply(
+            "❌ Неправильный формат команды.\n"
+            f"Используйте: /backfill [дней от 1 до {BACKFILL_MAX_DAYS}]\n"
+            "Пример: /backfill 7"
+        )
+        return
+    
+    # Периоды заканчиваются в полночь после каждого из прошедших дней, последний - сегодня в 00:00
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    end_dates = [today - timedelta(days=offset) for offset in range(days - 1, -1, -1)]
+    
+    await message.reply(f"⏳ Пересчет доходности за {days} дн. ...")
+    # Расчет выполняет блокирующие запросы к базе, поэтому уходит в отдельный поток
+    counts = await asyncio.to_thread(backfill_profitability, end_dates)
+    await message.reply(
+        f"✅ Доходность пересчитана!\n"
+        f"Дневных записей: {counts['daily']}\n"
+        f"3-дневных: {counts['3day']}\n"
+        f"Недельных: {counts['weekly']}\n"
+        f"Месячных: {counts['monthly']}"
+    )
+
+
 @dp.message(Command("list_devices"))
 async def cmd_list_devices(message: types.Message):
     """Обработчик команды /list_devices для просмотра всех устройств"""
@@ -3104,31 +4236,61 @@ async def cmd_list_devices(message: types.Message):
     
     try:
         # Получаем все устройства из базы данных (включая неактивные)
-        response = supabase.table('miner_devices_config').select('*').execute()
+        devices = devices_list_cache.get('all')
+        if devices is None:
+            response = supabase.table('miner_devices_config').select('*').execute()
+            devices = response.data
+            if devices:
+                devices_list_cache.set('all', devices)
         
-        if not response.data:
+        if not devices:
             await message.reply("📋 Устройства не найдены в базе данных.")
             return
         
-        devices = response.data
-        response_text = "📋 <b>Список всех устройств:</b>\n\n"
-        
+        parts = ["📋 <b>Список всех устройств:</b>\n"]
         for device in devices:
-            status_emoji = "🟢" if device.get('is_active', True) else "🔴"
-            response_text += f"{status_emoji} <b>{device['name']}</b>\n"
-            response_text += f"ID: {device['device_id']}\n"
-            response_text += f"Локация: {device['location']}\n"
-            response_text += f"Статус: {'Активно' if device.get('is_active', True) else 'Неактивно'}\n"
-            response_text += f"Создано: {device.get('created_at', 'N/A')}\n"
-            response_text += f"Обновлено: {device.get('updated_at', 'N/A')}\n\n"
+            is_active = device.get('is_active', True)
+            parts.append(_DEVICE_CONFIG_TEMPLATE.format_map({
+                "emoji": "🟢" if is_active else "🔴",
+                "name": device['name'],
+                "id": device['device_id'],
+                "location": device['location'],
+                "status": "Активно" if is_active else "Неактивно",
+                "created": device.get('created_at', 'N/A'),
+                "updated": device.get('updated_at', 'N/A')
+            }))
         
-        await message.reply(response_text, parse_mode=ParseMode.HTML)
+        await message.reply("\n".join(parts), parse_mode=ParseMode.HTML)
         
     except Exception as e:
         logger.error(f"Ошибка при получении списка устройств: {e}")
         await message.reply("❌ Ошибка при получении списка устройств. Проверьте логи.")
 
 
+async def safe_reply(message: types.Message, text: str, **kwargs):
+    """Ответ на сообщение с учетом общего лимита отправки"""
+    async with send_limiter:
+        return await message.reply(text, **kwargs)
+
+
+async def reply_long(message: types.Message, text: str):
+    """Отправляет длинный HTML-ответ частями; при ошибке разметки часть уходит простым текстом"""
+    message_parts = split_message_for_telegram(text)
+    multi_part = len(message_parts) > 1
+    for i, part in enumerate(message_parts):
+        # Add continuation indicator for multi-part messages
+        if multi_part:
+            part = f"📄 Часть {i + 1}/{len(message_parts)}\n\n{part}"
+        try:
+            await safe_reply(message, part, parse_mode=ParseMode.HTML)
+        except TelegramBadRequest as e:
+            if "parse" not in str(e).lower():
+                raise
+            logger.error(f"HTML parsing error in part {i + 1}: {e}")
+            # Fallback to plain text if HTML fails
+            await safe_reply(message, _HTML_TAG_RE.sub('', part))
+
+
 # AI-команды
 @dp.message(Command("ai_analyze"))
 async def cmd_ai_analyze(message: types.Message):
@@ -3137,53 +4299,50 @@ async def cmd_ai_analyze(message: types.Message):
 
     # Проверяем, доступен ли хотя бы один AI-провайдер
     if not openai_client and not cerebras_client:
-        await message.reply("❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
+        await safe_reply(message, "❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
         return
 
     try:
         # Получаем текущие данные
         current_consumption = get_current_power_consumption()
-        total_power = sum(loc['total_power_w'] for loc in current_consumption.values())
+
+        # Строки по локациям и общая мощность собираются за один проход
+        total_power = 0
+        location_lines = []
+        for location, data in current_consumption.items():
+            total_power += data['total_power_w']
+            location_lines.append(f"\n{location}: {data['total_power_w']} Вт, устройств: {len(data['devices'])}")
+            for device in data['devices']:
+                location_lines.append(f"\n  - {device['name']}: {device['power_w']} Вт ({'ВКЛ' if device['is_on'] else 'ВЫКЛ'})")
 
         # Получаем данные о продажах за последние 24 часа
         end_date = datetime.now()
         start_date = end_date - timedelta(days=1)
         sales_data = get_sales_data(start_date, end_date)
-        total_income_usdt = sum(float(sale.get("total_received", 0)) for sale in sales_data)
+        total_income_usdt = math.fsum(float(sale.get("total_received", 0)) for sale in sales_data)
 
         # Получаем курс валюты
         exchange_rate = ExchangeRateManager.get_usdt_rub_rate()
 
         # Формируем промпт для AI
-        prompt = f"""
+        prompt_parts = [f"""
         Проанализируй текущую ситуацию майнинг-фермы на основе следующих данных:
         Текущая мощность: {total_power} Вт
         Доход за последние 24 часа: {total_income_usdt} USDT
         Курс USDT/RUB: {exchange_rate} руб
         Локации и устройства:
-        """
+        """]
+        prompt_parts.extend(location_lines)
 
-        for location, data in current_consumption.items():
-            prompt += f"\n{location}: {data['total_power_w']} Вт, устройств: {len(data['devices'])}"
-            for device in data['devices']:
-                prompt += f"\n  - {device['name']}: {device['power_w']} Вт ({'ВКЛ' if device['is_on'] else 'ВЫКЛ'})"
-
-        prompt += """
-        Предоставь анализ на русском языке, включающий:
-        1. Общую оценку текущей ситуации
-        2. Эффективность работы фермы
-        3. Потенциальные проблемы или риски
-        4. Рекомендации по оптимизации
-        5. Прогноз на ближайшие 24 часа
-        Ответ структурируй по пунктам с использованием эмодзи.
-        """
+        prompt = "".join(prompt_parts)
 
         # Запрос к AI с использованием резервных провайдеров
         ai_analysis, provider = await make_ai_request(
-            system_prompt="Ты - эксперт по анализу криптомайнинга. Отвечай подробно и структурированно на русском языке.",
+            system_prompt=SYS_ANALYZE,
             user_prompt=prompt,
             temperature=0.7,
-            max_tokens=1500
+            max_tokens=1500,
+            cache_ttl=120
         )
 
         if ai_analysis:
@@ -3193,27 +4352,12 @@ async def cmd_ai_analyze(message: types.Message):
             # Format the response
             response_text = f"🤖 <b>AI-Анализ Текущей Ситуации</b> (через {provider})\n\n{sanitized_analysis}"
 
-            # Split the message if it's too long
-            message_parts = split_message_for_telegram(response_text)
-
-            # Send each part
-            for i, part in enumerate(message_parts):
-                try:
-                    # Add continuation indicator for multi-part messages
-                    if len(message_parts) > 1:
-                        part = f"📄 Часть {i + 1}/{len(message_parts)}\n\n{part}"
-                    # Try sending with HTML formatting
-                    await message.reply(part, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error(f"HTML parsing error in part {i + 1}: {e}")
-                    # Fallback to plain text if HTML fails
-                    clean_text = re.sub(r'<[^>]*>', '', part)
-                    await message.reply(clean_text)
+            await reply_long(message, response_text)
         else:
-            await message.reply("❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
+            await safe_reply(message, "❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
     except Exception as e:
         logger.error(f"Ошибка в AI-анализе: {e}")
-        await message.reply("❌ Произошла ошибка при выполнении AI-анализа")
+        await safe_reply(message, "❌ Произошла ошибка при выполнении AI-анализа")
 
 
 @dp.message(Command("ai_forecast"))
@@ -3223,7 +4367,7 @@ async def cmd_ai_forecast(message: types.Message):
 
     # Проверяем, доступен ли хотя бы один AI-провайдер
     if not openai_client and not cerebras_client:
-        await message.reply("❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
+        await safe_reply(message, "❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
         return
 
     # Парсим период из команды
@@ -3237,48 +4381,40 @@ async def cmd_ai_forecast(message: types.Message):
         current_consumption = get_current_power_consumption()
         total_power = sum(loc['total_power_w'] for loc in current_consumption.values())
 
-        # Получаем исторические данные
-        historical_data = {}
-        for device in DEVICES:
-            device_id = device["device_id"]
-            pattern = get_historical_consumption_pattern(device_id, 7)
-            historical_data[device_id] = pattern
+        # Получаем исторические данные (параллельно, не более 8 одновременных запросов к Tuya)
+        semaphore = asyncio.Semaphore(8)
+
+        async def fetch_pattern(device_id):
+            async with semaphore:
+                return await asyncio.to_thread(get_historical_consumption_pattern, device_id, 7)
+
+        device_ids = [device["device_id"] for device in DEVICES]
+        patterns = await asyncio.gather(*[fetch_pattern(device_id) for device_id in device_ids])
+        historical_data = dict(zip(device_ids, patterns))
 
         # Формируем промпт для AI
-        prompt = f"""
+        prompt_parts = [f"""
         Сделай прогноз энергопотребления майнинг-фермы на период {period} на основе следующих данных:
         Текущая общая мощность: {total_power} Вт
-        Исторические паттерны потребления (за последние 7 дней):
-        """
+        Исторические паттерны потребления за последние 7 дней, CSV с разделителем ";"
+        (устройство; среднесуточное потребление, кВт·ч; эффективность; пиковые часы через пробел):
+        устройство;kwh;eff;peak"""]
 
+        # Компактная таблица вместо абзаца на каждое устройство сокращает число токенов в запросе
         for device_id, pattern in historical_data.items():
-            device_name = next((d["name"] for d in DEVICES if d["device_id"] == device_id), device_id)
-            prompt += f"\n{device_name}:"
-            prompt += f"\n  - Среднесуточное потребление: {pattern['daily_total']:.3f} кВт·ч"
-            prompt += f"\n  - Пиковые часы: {pattern['peak_hours']}"
-            prompt += f"\n  - Эффективность: {pattern['efficiency']:.2f}"
-
-        prompt += f"""
-        Учитывай следующие факторы:
-        - Текущие погодные условия (если известны)
-        - Сезонные колебания
-        - Исторические тренды
-        - Эффективность устройств
-        Предоставь прогноз на русском языке, включающий:
-        1. Прогноз общего потребления на период {period}
-        2. Ожидаемое распределение по часам
-        3. Факторы, влияющие на прогноз
-        4. Рекомендации по оптимизации потребления
-        5. Уровень уверенности в прогнозе
-        Ответ структурируй по пунктам с использованием эмодзи.
-        """
+            device_name = DEVICE_NAME_BY_ID.get(device_id, device_id)
+            peak_hours = " ".join(map(str, pattern['peak_hours']))
+            prompt_parts.append(f"\n{device_name};{pattern['daily_total']:.3f};{pattern['efficiency']:.2f};{peak_hours}")
+
+        prompt = "".join(prompt_parts)
 
         # Запрос к AI с использованием резервных провайдеров
         ai_forecast, provider = await make_ai_request(
-            system_prompt="Ты - эксперт по прогнозированию энергопотребления. Отвечай точно и обоснованно на русском языке.",
+            system_prompt=SYS_FORECAST,
             user_prompt=prompt,
             temperature=0.5,
-            max_tokens=1500
+            max_tokens=1500,
+            cache_ttl=900
         )
 
         if ai_forecast:
@@ -3294,27 +4430,12 @@ async def cmd_ai_forecast(message: types.Message):
 
             response_text = f"🔮 <b>AI-Прогноз на {period_text}</b> (через {provider})\n\n{sanitized_forecast}"
 
-            # Split the message if it's too long
-            message_parts = split_message_for_telegram(response_text)
-
-            # Send each part
-            for i, part in enumerate(message_parts):
-                try:
-                    # Add continuation indicator for multi-part messages
-                    if len(message_parts) > 1:
-                        part = f"📄 Часть {i + 1}/{len(message_parts)}\n\n{part}"
-                    # Try sending with HTML formatting
-                    await message.reply(part, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error(f"HTML parsing error in part {i + 1}: {e}")
-                    # Fallback to plain text if HTML fails
-                    clean_text = re.sub(r'<[^>]*>', '', part)
-                    await message.reply(clean_text)
+            await reply_long(message, response_text)
         else:
-            await message.reply("❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
+            await safe_reply(message, "❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
     except Exception as e:
         logger.error(f"Ошибка в AI-прогнозе: {e}")
-        await message.reply("❌ Произошла ошибка при выполнении AI-прогноза")
+        await safe_reply(message, "❌ Произошла ошибка при выполнении AI-прогноза")
 
 
 @dp.message(Command("ai_optimize"))
@@ -3324,7 +4445,7 @@ async def cmd_ai_optimize(message: types.Message):
 
     # Проверяем, доступен ли хотя бы один AI-провайдер
     if not openai_client and not cerebras_client:
-        await message.reply("❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
+        await safe_reply(message, "❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
         return
 
     try:
@@ -3339,11 +4460,11 @@ async def cmd_ai_optimize(message: types.Message):
 
         # Получаем тарифные данные
         tariff_info = {}
-        for location in set(device["location"] for device in DEVICES):
+        for location in LOCATIONS:
             tariff_info[location] = TARIFF_SETTINGS.get(location, {})
 
         # Формируем промпт для AI
-        prompt = f"""
+        prompt_parts = [f"""
         Проанализируй и предложи план оптимизации доходности майнинг-фермы на основе следующих данных:
         Текущая мощность: {total_power} Вт
         Доходность за последние 7 дней:
@@ -3352,40 +4473,29 @@ async def cmd_ai_optimize(message: types.Message):
         - Чистая прибыль: {profitability_data.get('net_profit', 0):.2f} RUB
         - Рентабельность: {profitability_data.get('profitability_percentage', 0):.2f}%
         Тарифы по локациям:
-        """
+        """]
 
         for location, tariff in tariff_info.items():
-            prompt += f"\n{location}:"
+            prompt_parts.append(f"\n{location}:")
             if tariff.get("tariff_type") == "day_night":
                 ranges = tariff.get("ranges", [])
                 if ranges:
-                    prompt += f"\n  - Дневной тариф: {ranges[0].get('day_rate', 0)} руб/кВт·ч"
-                    prompt += f"\n  - Ночной тариф: {ranges[0].get('night_rate', 0)} руб/кВт·ч"
+                    prompt_parts.append(f"\n  - Дневной тариф: {ranges[0].get('day_rate', 0)} руб/кВт·ч")
+                    prompt_parts.append(f"\n  - Ночной тариф: {ranges[0].get('night_rate', 0)} руб/кВт·ч")
             else:
                 ranges = tariff.get("ranges", [])
                 if ranges:
-                    prompt += f"\n  - Единый тариф: {ranges[0].get('day_rate', 0)} руб/кВт·ч"
-
-        prompt += """
-        Предоставь план оптимизации на русском языке, включающий:
-        1. Анализ текущей эффективности
-        2. Конкретные рекомендации по:
-           - Оптимизации расписания работы устройств
-           - Использованию тарифных зон (день/ночь)
-           - Повышению эффективности майнинга
-           - Снижению затрат на электричество
-        3. Оценку потенциального улучшения доходности
-        4. Пошаговый план внедрения рекомендаций
-        5. Сроки окупаемости предлагаемых мер
-        Ответ структурируй по пунктам с использованием эмодзи.
-        """
+                    prompt_parts.append(f"\n  - Единый тариф: {ranges[0].get('day_rate', 0)} руб/кВт·ч")
+
+        prompt = "".join(prompt_parts)
 
         # Запрос к AI с использованием резервных провайдеров
         ai_optimization, provider = await make_ai_request(
-            system_prompt="Ты - эксперт по оптимизации криптомайнинга. Отвечай практично и конкретно на русском языке.",
+            system_prompt=SYS_OPTIMIZE,
             user_prompt=prompt,
             temperature=0.7,
-            max_tokens=1500
+            max_tokens=1500,
+            cache_ttl=300
         )
 
         if ai_optimization:
@@ -3395,27 +4505,12 @@ async def cmd_ai_optimize(message: types.Message):
             # Format the response
             response_text = f"⚡ <b>AI-Оптимизация Доходности</b> (через {provider})\n\n{sanitized_optimization}"
 
-            # Split the message if it's too long
-            message_parts = split_message_for_telegram(response_text)
-
-            # Send each part
-            for i, part in enumerate(message_parts):
-                try:
-                    # Add continuation indicator for multi-part messages
-                    if len(message_parts) > 1:
-                        part = f"📄 Часть {i + 1}/{len(message_parts)}\n\n{part}"
-                    # Try sending with HTML formatting
-                    await message.reply(part, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error(f"HTML parsing error in part {i + 1}: {e}")
-                    # Fallback to plain text if HTML fails
-                    clean_text = re.sub(r'<[^>]*>', '', part)
-                    await message.reply(clean_text)
+            await reply_long(message, response_text)
         else:
-            await message.reply("❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
+            await safe_reply(message, "❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
     except Exception as e:
         logger.error(f"Ошибка в AI-оптимизации: {e}")
-        await message.reply("❌ Произошла ошибка при выполнении AI-оптимизации")
+        await safe_reply(message, "❌ Произошла ошибка при выполнении AI-оптимизации")
 
 
 @dp.message(Command("ai_health"))
@@ -3425,18 +4520,22 @@ async def cmd_ai_health(message: types.Message):
 
     # Проверяем, доступен ли хотя бы один AI-провайдер
     if not openai_client and not cerebras_client:
-        await message.reply("❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
+        await safe_reply(message, "❌ AI-сервисы недоступны. Проверьте настройки API ключей.")
         return
 
     try:
-        # Получаем текущие данные по устройствам
+        # Получаем текущие данные по устройствам (одним пакетным запросом)
+        devices = list(DEVICES)
+        statuses_by_id = await asyncio.to_thread(
+            get_device_statuses_batch, [device["device_id"] for device in devices]
+        )
         device_status = []
-        for device in DEVICES:
+        for device in devices:
             device_id = device["device_id"]
             device_name = device["name"]
             location = device["location"]
 
-            is_on, counter, device_data = get_device_status_cloud_enhanced(device_id)
+            is_on, counter, device_data = statuses_by_id[device_id]
 
             status_info = {
                 "name": device_name,
@@ -3450,39 +4549,27 @@ async def cmd_ai_health(message: types.Message):
             device_status.append(status_info)
 
         # Формируем промпт для AI
-        prompt = """
+        prompt_parts = ["""
         Проанализируй здоровье майнинг-фермы на основе статусов устройств:
-        """
+        """]
 
         for device in device_status:
             status_emoji = "🟢" if device["is_on"] else "🔴"
-            prompt += f"\n{status_emoji} {device['name']} ({device['location']}):"
-            prompt += f"\n  - Состояние: {'ВКЛ' if device['is_on'] else 'ВЫКЛ'}"
-            prompt += f"\n  - Мощность: {device['power']} Вт"
-            prompt += f"\n  - Напряжение: {device['temperature']} В"
-            prompt += f"\n  - Счетчик: {device['counter']:.3f} кВт·ч"
-
-        prompt += """
-        Проверь наличие аномалий и проблем:
-        - Устройства с необычно высокой/низкой мощностью
-        - Устройства с отклонениями напряжения
-        - Резкие изменения в показаниях счетчиков
-        - Неработающие устройства
-        Предоставь анализ здоровья системы на русском языке, включающий:
-        1. Общую оценку состояния системы
-        2. Выявленные аномалии или проблемы
-        3. Рекомендации по устранению проблем
-        4. Профилактические меры
-        5. Оценку критичности выявленных проблем
-        Ответ структурируй по пунктам с использованием эмодзи.
-        """
+            prompt_parts.append(f"\n{status_emoji} {device['name']} ({device['location']}):")
+            prompt_parts.append(f"\n  - Состояние: {'ВКЛ' if device['is_on'] else 'ВЫКЛ'}")
+            prompt_parts.append(f"\n  - Мощность: {device['power']} Вт")
+            prompt_parts.append(f"\n  - Напряжение: {device['temperature']} В")
+            prompt_parts.append(f"\n  - Счетчик: {device['counter']:.3f} кВт·ч")
+
+        prompt = "".join(prompt_parts)
 
         # Запрос к AI с использованием резервных провайдеров
         ai_health, provider = await make_ai_request(
-            system_prompt="Ты - эксперт по диагностике майнингового оборудования. Отвечай внимательно и профессионально на русском языке.",
+            system_prompt=SYS_HEALTH,
             user_prompt=prompt,
             temperature=0.5,
-            max_tokens=1500
+            max_tokens=1500,
+            cache_ttl=120
         )
 
         if ai_health:
@@ -3492,27 +4579,12 @@ async def cmd_ai_health(message: types.Message):
             # Format the response
             response_text = f"🏥 <b>AI-Проверка Здоровья Системы</b> (через {provider})\n\n{sanitized_health}"
 
-            # Split the message if it's too long
-            message_parts = split_message_for_telegram(response_text)
-
-            # Send each part
-            for i, part in enumerate(message_parts):
-                try:
-                    # Add continuation indicator for multi-part messages
-                    if len(message_parts) > 1:
-                        part = f"📄 Часть {i + 1}/{len(message_parts)}\n\n{part}"
-                    # Try sending with HTML formatting
-                    await message.reply(part, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error(f"HTML parsing error in part {i + 1}: {e}")
-                    # Fallback to plain text if HTML fails
-                    clean_text = re.sub(r'<[^>]*>', '', part)
-                    await message.reply(clean_text)
+            await reply_long(message, response_text)
         else:
-            await message.reply("❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
+            await safe_reply(message, "❌ Не удалось получить ответ от AI-сервисов. Попробуйте позже.")
     except Exception as e:
         logger.error(f"Ошибка в AI-проверке здоровья: {e}")
-        await message.reply("❌ Произошла ошибка при выполнении AI-проверки здоровья")
+        await safe_reply(message, "❌ Произошла ошибка при выполнении AI-проверки здоровья")
 
 
 # Chat commands
@@ -3520,7 +4592,7 @@ async def cmd_ai_health(message: types.Message):
 async def cmd_chat(message: types.Message):
     """Start a chat session with AI assistant"""
     chat_sessions.clear_session(message.from_user.id)
-    await message.reply(
+    await safe_reply(message,
         "🤖 <b>Режим AI-помощника</b>\n\n"
         "Теперь вы можете задавать мне вопросы о вашей майнинг-ферме на естественном русском языке. "
         "Я могу помочь вам со следующей информацией:\n"
@@ -3537,7 +4609,7 @@ async def cmd_chat(message: types.Message):
 async def cmd_clear(message: types.Message):
     """Clear chat history"""
     chat_sessions.clear_session(message.from_user.id)
-    await message.reply("🗑️ История чата очищена. Начните диалог с ваших вопросов!")
+    await safe_reply(message, "🗑️ История чата очищена. Начните диалог с ваших вопросов!")
 
 
 @dp.message(Command("electricity_today"))
@@ -3550,7 +4622,7 @@ async def cmd_electricity_today(message: types.Message):
         today_stats = get_today_spending()
         
         if not today_stats:
-            await message.reply("📊 За сегодня еще нет данных о потреблении электроэнергии.")
+            await safe_reply(message, "📊 За сегодня еще нет данных о потреблении электроэнергии.")
             return
         
         response_text = f"⚡ <b>Реальное потребление электроэнергии за сегодня ({datetime.now().strftime('%d.%m.%Y')}):</b>\n\n"
@@ -3595,11 +4667,11 @@ async def cmd_electricity_today(message: types.Message):
             avg_cost_per_kwh = total_cost / total_energy
             response_text += f"   💸 Средняя стоимость: {avg_cost_per_kwh:.2f} RUB/кВт·ч\n"
         
-        await message.reply(response_text, parse_mode=ParseMode.HTML)
+        await safe_reply(message, response_text, parse_mode=ParseMode.HTML)
         
     except Exception as e:
         logger.error(f"Ошибка получения данных о потреблении за сегодня: {e}")
-        await message.reply("❌ Произошла ошибка при получении данных о потреблении электроэнергии.")
+        await safe_reply(message, "❌ Произошла ошибка при получении данных о потреблении электроэнергии.")
 
 
 @dp.message(Command("electricity_72h"))
@@ -3614,7 +4686,7 @@ async def cmd_electricity_72h(message: types.Message):
         
         # Сначала пробуем получить данные через API
         api_stats = {}
-        for location in set(device["location"] for device in DEVICES):
+        for location in LOCATIONS:
             api_consumption = get_72h_consumption_from_api(location)
             if api_consumption['total_energy'] > 0:
                 api_stats[location] = api_consumption
@@ -3623,7 +4695,7 @@ async def cmd_electricity_72h(message: types.Message):
         if not api_stats:
             energy_data = get_energy_data(start_date, end_date)
             if not energy_data:
-                await message.reply("📊 За последние 72 часа нет данных о потреблении электроэнергии.")
+                await safe_reply(message, "📊 За последние 72 часа нет данных о потреблении электроэнергии.")
                 return
         else:
             energy_data = []
@@ -3742,11 +4814,11 @@ async def cmd_electricity_72h(message: types.Message):
             response_text += f"   💸 Средняя стоимость: {avg_cost_per_kwh:.2f} RUB/кВт·ч\n"
             response_text += f"   📅 Среднее за день: {avg_daily_energy:.3f} кВт·ч ({avg_daily_cost:.2f} RUB)\n"
         
-        await message.reply(response_text, parse_mode=ParseMode.HTML)
+        await safe_reply(message, response_text, parse_mode=ParseMode.HTML)
         
     except Exception as e:
         logger.error(f"Ошибка получения данных о потреблении за 72 часа: {e}")
-        await message.reply("❌ Произошла ошибка при получении данных о потреблении электроэнергии.")
+        await safe_reply(message, "❌ Произошла ошибка при получении данных о потреблении электроэнергии.")
 
 
 @dp.message()
@@ -3769,23 +4841,28 @@ async def handle_natural_chat(message: types.Message):
     # Generate SQL query (now with await)
     sql_result = await nl_to_sql.generate_sql_query(question, context)
 
-    if sql_result:
+    if sql_result and sql_result.get('error'):
+        await safe_reply(message, sql_result['error'])
+    elif sql_result:
         # Execute query
         query_result = await nl_to_sql.execute_query(sql_result['sql_query'], sql_result['parameters'])
+        query_result_json = orjson.dumps(
+            query_result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str
+        ).decode()
 
         # Create response prompt for AI
         response_prompt = f"""
         Пользователь спросил: {question}
         Выполненный SQL-запрос: {sql_result['sql_query']}
         Объяснение запроса: {sql_result['explanation']}
-        Результаты запроса: {json.dumps(query_result, indent=2, default=str, ensure_ascii=False)}
+        Результаты запроса: {query_result_json}
         Пожалуйста, предоставь ответ пользователю на естественном русском языке на основе этих результатов.
         Будь полезен, лаконичен и включай релевантные цифры и инсайты.
         """
 
         # Get AI response
         ai_response, provider = await make_ai_request(
-            system_prompt="Ты - полезный помощник по майнинг-ферме. Предоставляй четкие, краткие ответы на основе предоставленных данных.",
+            system_prompt=SYS_CHAT,
             user_prompt=response_prompt,
             temperature=0.5,
             max_tokens=1000
@@ -3797,27 +4874,12 @@ async def handle_natural_chat(message: types.Message):
 
             # Send response (handle long messages)
             response_text = f"🤖 <b>AI-помощник</b> (via {provider})\n\n{ai_response}"
-            message_parts = split_message_for_telegram(response_text)
-
-            # Send each part
-            for i, part in enumerate(message_parts):
-                try:
-                    # Add continuation indicator for multi-part messages
-                    if len(message_parts) > 1:
-                        part_with_indicator = f"📄 Часть {i + 1}/{len(message_parts)}\n\n{part}"
-                    else:
-                        part_with_indicator = part
-                    # Try sending with HTML formatting
-                    await message.reply(part_with_indicator, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error(f"Error sending message part: {e}")
-                    clean_text = re.sub(r'<[^>]*>', '', part)
-                    await message.reply(clean_text)
+            await reply_long(message, response_text)
         else:
-            await message.reply(
+            await safe_reply(message,
                 "❌ Извините, я не смог обработать ваш вопрос. Пожалуйста, попробуйте переформулировать.")
     else:
-        await message.reply("❌ Я не понял ваш вопрос. Пожалуйста, попробуйте задать его по-другому.")
+        await safe_reply(message, "❌ Я не понял ваш вопрос. Пожалуйста, попробуйте задать его по-другому.")
 
 
 async def send_admin_notification(text: str):
@@ -3833,43 +4895,21 @@ async def send_admin_notification(text: str):
 async def process_notifications():
     """Обрабатывает очередь уведомлений"""
     while True:
+        # Ожидаем следующее уведомление без периодического опроса очереди
+        text = await notification_queue.get()
         try:
-            if not notification_queue.empty():
-                text = await notification_queue.get()
-                await send_admin_notification(text)
-            await asyncio.sleep(0.5)
+            await send_admin_notification(text)
         except Exception as e:
             logger.error(f"Ошибка обработки уведомлений: {e}")
             await asyncio.sleep(5)
+        finally:
+            notification_queue.task_done()
 
 
 def queue_notification(text: str):
-    """Добавляет уведомление в очередь с обработкой ошибки отсутствия event loop"""
+    """Добавляет уведомление в очередь; вызывается из корутин в цикле событий бота (мониторинг)"""
     if bot and TELEGRAM_ADMIN_ID:
-        try:
-            # Проверяем, есть ли event loop
-            try:
-                loop = asyncio.get_running_loop()
-                # Если event loop запущен, используем call_soon_threadsafe
-                loop.call_soon_threadsafe(notification_queue.put_nowait, text)
-            except RuntimeError:
-                # Если нет event loop в текущем потоке, пробуем создать задачу
-                try:
-                    # Проверяем, запущен ли event loop в основном потоке
-                    if asyncio.get_event_loop().is_running():
-                        # Если запущен, используем call_soon_threadsafe
-                        asyncio.get_event_loop().call_soon_threadsafe(notification_queue.put_nowait, text)
-                    else:
-                        # Если не запущен, создаем задачу
-                        asyncio.create_task(notification_queue.put(text))
-                except:
-                    # Если и это не сработало, просто логируем без эмодзи
-                    clean_text = text.encode('ascii', 'ignore').decode('ascii')
-                    logger.warning(f"Не удалось отправить уведомление (нет event loop): {clean_text}")
-        except Exception as e:
-            # В случае ошибки, логируем без эмодзи
-            clean_text = text.encode('ascii', 'ignore').decode('ascii')
-            logger.error(f"Ошибка добавления уведомления в очередь: {e}")
+        notification_queue.put_nowait(text)
 
 
 def safe_log(message: str, level: str = "info"):
@@ -3896,26 +4936,42 @@ def safe_log(message: str, level: str = "info"):
             logger.debug(clean_message)
 
 
-def monitor_devices():
-    """Основная функция мониторинга устройств"""
+def _next_run(after: datetime, minute: int, hour: Optional[int] = None) -> datetime:
+    """Следующий момент запуска задачи после after: каждый час в minute минут или каждый день в hour:minute"""
+    run = after.replace(minute=minute, second=0, microsecond=0)
+    if hour is not None:
+        run = run.replace(hour=hour)
+    step = timedelta(hours=1) if hour is None else timedelta(days=1)
+    while run <= after:
+        run += step
+    return run
+
+
+async def monitor_devices():
+    """Основная корутина мониторинга устройств; блокирующие вызовы Tuya и Supabase выполняются в потоках"""
     global device_states, last_counters, monitoring_active
     safe_log("Запуск мониторинга устройств (облачный режим)...")
 
-    # Инициализация состояний
-    for device in DEVICES:
+    # Инициализация состояний: запросы к облаку выполняются параллельно
+    devices = list(DEVICES)
+    initial_data = await asyncio.gather(
+        *[asyncio.to_thread(safe_get_device_data, device["device_id"]) for device in devices]
+    )
+    now = datetime.now()
+
+    for device, (is_on, counter, device_data) in zip(devices, initial_data):
         device_id = device["device_id"]
         device_name = device["name"]
         location = device["location"]
 
         safe_log(f"Инициализация устройства: {device_name} ({device_id})")
-        is_on, counter, device_data = safe_get_device_data(device_id)
 
         device_states[device_id] = {
             "name": device_name,
             "location": location,
             "last_state": is_on,
             "last_counter": counter,
-            "session_start": datetime.now() if is_on else None
+            "session_start": now if is_on else None
         }
         last_counters[device_id] = counter
 
@@ -3925,6 +4981,14 @@ def monitor_devices():
     # Отправляем уведомление о запуске
     queue_notification("Мониторинг устройств запущен")
 
+    # Время следующего запуска расчетов доходности
+    next_daily_run = _next_run(now, minute=0)
+    next_weekly_run = _next_run(now, minute=1, hour=0)
+    next_monthly_run = _next_run(now, minute=2, hour=0)
+
+    monitored_devices = None
+    device_view = []
+
     # Основной цикл мониторинга
     while monitoring_active:
         try:
@@ -3938,143 +5002,176 @@ def monitor_devices():
                 queue_notification(
                     f"Внимание! Достигнут 90% лимит API запросов: {api_status['requests_today']}/{api_status['daily_limit']}")
 
-            for device in DEVICES:
-                device_id = device["device_id"]
-                device_name = device["name"]
-                location = device["location"]
-
-                is_on, counter, device_data = safe_get_device_data(device_id)
-
-                if device_id not in device_states:
-                    logger.warning(f"Устройство {device_id} не найдено в состояниях, инициализация...")
-                    device_states[device_id] = {
-                        "name": device_name,
-                        "location": location,
-                        "last_state": is_on,
-                        "last_counter": counter,
-                        "session_start": datetime.now() if is_on else None
-                    }
-                    last_counters[device_id] = counter
-                    continue
-
-                state = device_states[device_id]
-
-                # Проверка изменения состояния (включение/выключение)
-                if is_on != state["last_state"]:
-                    if is_on:
-                        # Устройство включилось
-                        state["session_start"] = datetime.now()
-                        state["last_state"] = True
-                        safe_log(f"{device_name} включился в {state['session_start']}")
-                        queue_notification(f"{device_name} включился")
+            # Дневной лимит исчерпан: опрос все равно не пройдет, но расчеты по расписанию
+            # и синхронизация с Supabase квоты Tuya не требуют и выполняются как обычно
+            quota_exhausted = api_status['requests_today'] >= api_status['daily_limit']
+            if quota_exhausted:
+                current_time = datetime.now()
+            else:
+                # Кортежи (device_id, name, location) пересобираются только при замене списка DEVICES
+                if DEVICES is not monitored_devices:
+                    monitored_devices = DEVICES
+                    device_view = [(device["device_id"], device["name"], device["location"]) for device in DEVICES]
+
+                # Опрашиваем все устройства параллельно, затем применяем изменения состояний по порядку
+                poll_results = await asyncio.gather(
+                    *[asyncio.to_thread(safe_get_device_data, device_id) for device_id, _, _ in device_view]
+                )
+                # Одно время опроса на весь цикл
+                current_time = datetime.now()
+
+                # Завершенные сессии цикла сохраняются одним запросом после обхода устройств;
+                # хранятся пары (строка сессии, уведомление о ней)
+                pending_sessions = []
+
+                for (device_id, device_name, location), (is_on, counter, device_data) in zip(device_view, poll_results):
+                    state = device_states.get(device_id)
+                    if state is None:
+                        logger.warning(f"Устройство {device_id} не найдено в состояниях, инициализация...")
+                        device_states[device_id] = {
+                            "name": device_name,
+                            "location": location,
+                            "last_state": is_on,
+                            "last_counter": counter,
+                            "session_start": current_time if is_on else None
+                        }
+                        last_counters[device_id] = counter
+                        continue
+
+                    # Проверка изменения состояния (включение/выключение)
+                    if is_on != state["last_state"]:
+                        if is_on:
+                            # Устройство включилось
+                            state["session_start"] = current_time
+                            state["last_state"] = True
+                            safe_log(f"{device_name} включился в {state['session_start']}")
+                            queue_notification(f"{device_name} включился")
+                        else:
+                            # Устройство выключилось
+                            if state["session_start"]:
+                                end_time = current_time
+                                energy_kwh = counter - state["last_counter"]
+
+                                safe_log(f"{device_name} выключился в {end_time}")
+                                safe_log(f"Сессия: энергия={energy_kwh:.3f} кВт·ч, "
+                                         f"длительность={end_time - state['session_start']}")
+
+                                if energy_kwh > 0:
+                                    try:
+                                        cost, day_energy, night_energy, cost_details = await asyncio.to_thread(
+                                            calculate_session_cost,
+                                            device_id, location, state["session_start"], end_time, energy_kwh
+                                        )
+
+                                        session_row = build_session_row(
+                                            device_id,
+                                            location,
+                                            state["session_start"],
+                                            end_time,
+                                            energy_kwh,
+                                            cost,
+                                            cost_details["tariff_type"],
+                                            day_energy,
+                                            night_energy,
+                                            cost_details
+                                        )
+
+                                        # Уведомление о сессии отправляется после сохранения
+                                        pending_sessions.append((
+                                            session_row,
+                                            f"{device_name} выключился\n"
+                                            f"Энергия: {energy_kwh:.3f} кВт·ч\n"
+                                            f"Стоимость: {cost:.2f} руб.\n"
+                                            f"Длительность: {end_time - state['session_start']}"
+                                        ))
+                                    except Exception as e:
+                                        logger.error(f"Ошибка при обработке сессии устройства {device_name}: {e}")
+                                else:
+                                    logger.warning(f"{device_name}: нулевое потребление за сессии")
+
+                            state["last_state"] = False
+                            state["session_start"] = None
+
+                    # Обновляем счетчик, если он изменился (после инициализации устройство всегда есть в last_counters)
+                    previous_counter = last_counters[device_id]
+                    counter_delta = counter - previous_counter
+                    if counter_delta > 0.001 or counter_delta < -0.001:  # Небольшая дельта для избежания проблем с плавающей запятой
+                        logger.debug("Счетчик устройства %s обновлен: %s -> %s", device_name, previous_counter, counter)
+                        last_counters[device_id] = counter
+
+                if pending_sessions:
+                    saved = await asyncio.to_thread(save_sessions, [row for row, _ in pending_sessions])
+                    if saved is not None:
+                        saved_sessions = pending_sessions
                     else:
-                        # Устройство выключилось
-                        if state["session_start"]:
-                            end_time = datetime.now()
-                            energy_kwh = counter - state["last_counter"]
-
-                            safe_log(f"{device_name} выключился в {end_time}")
-                            safe_log(f"Сессия: энергия={energy_kwh:.3f} кВт·ч, "
-                                     f"длительность={end_time - state['session_start']}")
-
-                            if energy_kwh > 0:
-                                try:
-                                    cost, day_energy, night_energy, cost_details = calculate_session_cost(
-                                        device_id, location, state["session_start"], end_time, energy_kwh
-                                    )
-
-                                    save_session(
-                                        device_id,
-                                        location,
-                                        state["session_start"],
-                                        end_time,
-                                        energy_kwh,
-                                        cost,
-                                        cost_details["tariff_type"],
-                                        day_energy,
-                                        night_energy,
-                                        cost_details
-                                    )
-
-                                    # Отправляем уведомление о сессии
-                                    notification = (
-                                        f"{device_name} выключился\n"
-                                        f"Энергия: {energy_kwh:.3f} кВт·ч\n"
-                                        f"Стоимость: {cost:.2f} руб.\n"
-                                        f"Длительность: {end_time - state['session_start']}"
-                                    )
-                                    queue_notification(notification)
-                                except Exception as e:
-                                    logger.error(f"Ошибка при обработке сессии устройства {device_name}: {e}")
-                            else:
-                                logger.warning(f"{device_name}: нулевое потребление за сессии")
-
-                        state["last_state"] = False
-                        state["session_start"] = None
-
-                            # Обновляем счетчик, если он изменился
-            if abs(counter - last_counters.get(device_id,
-                                               0)) > 0.001:  # Добавляем небольшую дельту для избежания проблем с плавающей запятой
-                logger.debug(
-                    f"Счетчик устройства {device_name} обновлен: {last_counters.get(device_id, 0)} -> {counter}")
-                last_counters[device_id] = counter
-            
-            # Записываем данные электричества каждые 5 минут
-            global last_electricity_record
-            current_time = datetime.now()
+                        # Пакет отклонен: сохраняем сессии по одной, чтобы ошибочная строка
+                        # не лишила сохранения остальные
+                        saved_sessions = []
+                        for row, notification in pending_sessions:
+                            if await asyncio.to_thread(save_sessions, [row]) is not None:
+                                saved_sessions.append((row, notification))
+                    logger.info(f"Сохранено сессий за цикл: {len(saved_sessions)} из {len(pending_sessions)}")
+                    # Уведомляем только о действительно сохраненных сессиях
+                    for _, notification in saved_sessions:
+                        queue_notification(notification)
+
+                # Записываем данные электричества каждые 5 минут
+                global last_electricity_record
             
-            # Проверяем, прошло ли 5 минут с последней записи
-            if (last_electricity_record is None or 
-                (current_time - last_electricity_record).total_seconds() >= 300):  # 5 минут = 300 секунд
+                # Проверяем, прошло ли 5 минут с последней записи
+                if (last_electricity_record is None or 
+                    (current_time - last_electricity_record).total_seconds() >= 300):  # 5 минут = 300 секунд
                 
-                # Получаем данные о мощности и напряжении
-                power_w = device_data.get('cur_power', 0.0) if device_data else 0.0
-                voltage = device_data.get('cur_voltage') if device_data else None
-                current_amp = device_data.get('cur_current') if device_data else None
+                    # Получаем данные о мощности и напряжении
+                    power_w = device_data.get('cur_power', 0.0) if device_data else 0.0
+                    voltage = device_data.get('cur_voltage') if device_data else None
+                    current_amp = device_data.get('cur_current') if device_data else None
                 
-                # Рассчитываем потребление энергии с момента последнего измерения
-                energy_kwh = 0.0
-                if device_id in last_counters:
-                    energy_kwh = counter - last_counters[device_id]
-                    energy_kwh = max(0.0, energy_kwh)  # Только положительные значения
+                    # Рассчитываем потребление энергии с момента последнего измерения
+                    energy_kwh = 0.0
+                    if device_id in last_counters:
+                        energy_kwh = counter - last_counters[device_id]
+                        energy_kwh = max(0.0, energy_kwh)  # Только положительные значения
                 
-                # Сохраняем данные электричества
-                save_electricity_data(
-                    device_id=device_id,
-                    device_name=device_name,
-                    location=location,
-                    power_w=power_w,
-                    energy_kwh=energy_kwh,
-                    is_on=is_on,
-                    voltage=voltage,
-                    current=current_amp
-                )
+                    # Сохраняем данные электричества
+                    save_electricity_data(
+                        device_id=device_id,
+                        device_name=device_name,
+                        location=location,
+                        power_w=power_w,
+                        energy_kwh=energy_kwh,
+                        is_on=is_on,
+                        voltage=voltage,
+                        current=current_amp
+                    )
                 
-                last_electricity_record = current_time
-                logger.info(f"Данные электричества записаны для {device_name} (мощность: {power_w}Вт, энергия: {energy_kwh:.3f}кВт·ч)")
+                    last_electricity_record = current_time
+                    logger.info(f"Данные электричества записаны для {device_name} (мощность: {power_w}Вт, энергия: {energy_kwh:.3f}кВт·ч)")
 
-            # Расчет дневной доходности (каждый час в начале минуты)
-            current_time = datetime.now()
-            if current_time.minute == 0 and current_time.second < 30:
+            # Расчет дневной доходности (каждый час в начале часа)
+            if current_time >= next_daily_run:
+                next_daily_run = _next_run(current_time, minute=0)
                 logger.info("Запуск расчета дневной доходности...")
                 try:
-                    calculate_daily_profitability(current_time.date())
+                    await asyncio.to_thread(calculate_daily_profitability, current_time.date())
                 except Exception as e:
                     logger.error(f"Ошибка расчета дневной доходности: {e}")
 
             # Расчет недельной доходности (каждый день в 00:01)
-            if current_time.hour == 0 and current_time.minute == 1 and current_time.second < 30:
+            if current_time >= next_weekly_run:
+                next_weekly_run = _next_run(current_time, minute=1, hour=0)
                 logger.info("Запуск расчета недельной доходности...")
                 try:
-                    calculate_weekly_profitability()
+                    await asyncio.to_thread(calculate_weekly_profitability)
                 except Exception as e:
                     logger.error(f"Ошибка расчета недельной доходности: {e}")
 
             # Расчет месячной доходности (каждый день в 00:02)
-            if current_time.hour == 0 and current_time.minute == 2 and current_time.second < 30:
+            if current_time >= next_monthly_run:
+                next_monthly_run = _next_run(current_time, minute=2, hour=0)
                 logger.info("Запуск расчета месячной доходности...")
                 try:
-                    calculate_monthly_profitability()
+                    await asyncio.to_thread(calculate_monthly_profitability)
                 except Exception as e:
                     logger.error(f"Ошибка расчета месячной доходности: {e}")
             
@@ -4087,7 +5184,7 @@ def monitor_devices():
                 if current_time.hour == 6 and current_time.minute < 5:
                     logger.info("Запуск утренней синхронизации электричества с Supabase...")
                     try:
-                        sync_electricity_to_supabase()
+                        await asyncio.to_thread(sync_electricity_to_supabase)
                         last_supabase_sync = current_time
                     except Exception as e:
                         logger.error(f"Ошибка утренней синхронизации электричества: {e}")
@@ -4096,20 +5193,26 @@ def monitor_devices():
                 elif current_time.hour == 18 and current_time.minute < 5:
                     logger.info("Запуск вечерней синхронизации электричества с Supabase...")
                     try:
-                        sync_electricity_to_supabase()
+                        await asyncio.to_thread(sync_electricity_to_supabase)
                         last_supabase_sync = current_time
                     except Exception as e:
                         logger.error(f"Ошибка вечерней синхронизации электричества: {e}")
 
-            time.sleep(30)  # Проверяем каждые 30 секунд
-        except KeyboardInterrupt:
-            logger.info("Мониторинг остановлен пользователем")
+            if quota_exhausted:
+                # Ждем ближе к сбросу счетчика в полночь, но не дольше окна синхронизации в 6:00/18:00
+                seconds_to_midnight = (datetime.combine(current_time.date() + timedelta(days=1),
+                                                        datetime.min.time()) - current_time).total_seconds()
+                await asyncio.sleep(min(seconds_to_midnight, 240))
+            else:
+                await asyncio.sleep(30)  # Проверяем каждые 30 секунд
+        except asyncio.CancelledError:
+            logger.info("Мониторинг остановлен")
             monitoring_active = False
             queue_notification("Мониторинг остановлен")
-            break
+            raise
         except Exception as e:
             logger.error(f"Ошибка в цикле мониторинга: {e}", exc_info=True)
-            time.sleep(60)  # Ждем минуту перед повторной попыткой
+            await asyncio.sleep(60)  # Ждем минуту перед повторной попыткой
 
 
 
@@ -4124,22 +5227,32 @@ async def session_cleanup_task():
             await asyncio.sleep(60)
 
 
+def _log_task_failure(task: asyncio.Task):
+    """Логирует исключение завершившейся фоновой задачи, иначе оно не будет получено"""
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"Фоновая задача {task.get_name()} завершилась с ошибкой: {exc}", exc_info=exc)
+
+
 async def main():
     """Основная асинхронная функция"""
     # Setup bot commands
     await setup_bot_commands()
 
     # Start background tasks
-    cleanup_task = asyncio.create_task(session_cleanup_task())
+    cleanup_task = asyncio.create_task(session_cleanup_task(), name="session_cleanup")
 
     # Запускаем обработчик уведомлений
-    notification_task = asyncio.create_task(process_notifications())
+    notification_task = asyncio.create_task(process_notifications(), name="notifications")
 
-    # Запускаем мониторинг в отдельном потоке
-    import threading
-    monitor_thread = threading.Thread(target=monitor_devices)
-    monitor_thread.daemon = True
-    monitor_thread.start()
+    # Запускаем мониторинг устройств в том же цикле событий
+    monitor_task = asyncio.create_task(monitor_devices(), name="monitor_devices")
+
+    # Ошибки фоновых задач попадают в лог сразу, а не теряются до завершения программы
+    for task in (cleanup_task, notification_task, monitor_task):
+        task.add_done_callback(_log_task_failure)
 
     # Запускаем бота
     if bot:
@@ -4147,11 +5260,28 @@ async def main():
         await dp.start_polling(bot)
     else:
         logger.info("Telegram бот не настроен, ожидание...")
-        while True:
-            await asyncio.sleep(60)
+        # Ждем сигнала остановки без периодических пробуждений
+        shutdown_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, shutdown_event.set)
+            except NotImplementedError:
+                # Windows: обработчики сигналов в цикле событий недоступны, остается KeyboardInterrupt
+                pass
+        await shutdown_event.wait()
+        logger.info("Получен сигнал остановки")
 
 
 if __name__ == "__main__":
+    # uvloop ускоряет цикл событий; на Windows он недоступен, там остается стандартный asyncio
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("Используется uvloop")
+    except ImportError:
+        pass
+
     try:
         asyncio.run(main())
     except Exception as e:
@@ -7,21 +7,44 @@
 import os
 import sys
 import signal
+import select
 import time
 import json
 from pathlib import Path
-from datetime import datetime
+
+try:
+    # Потоковый разбор JSON: позволяет прочитать несколько полей, не загружая все записи в память
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # Быстрый разбор JSON целиком, когда ijson недоступен
+    import orjson
+except ImportError:
+    orjson = None
+
+# Сжатые сегменты истории электричества старше этого срока удаляются при очистке
+HISTORY_SEGMENT_MAX_AGE_DAYS = 30
+
+# Типы событий ijson для скалярных значений
+SCALAR_EVENTS = {"string", "number", "boolean", "null"}
+
+# Частота тиков ядра для времени из /proc/<pid>/stat (обычно 100, но не везде)
+try:
+    CLK_TCK = os.sysconf("SC_CLK_TCK")
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = 100
 
 def get_pid_from_file():
     """Получает PID из файла"""
     pid_file = "monitor_daemon.pid"
-    if os.path.exists(pid_file):
-        try:
-            with open(pid_file, 'r') as f:
-                return int(f.read().strip())
-        except (ValueError, IOError):
-            return None
-    return None
+    try:
+        with open(pid_file, 'r') as f:
+            return int(f.read().strip())
+    except (ValueError, IOError):
+        # Нет файла или он поврежден
+        return None
 
 def is_process_running(pid):
     """Проверяет, работает ли процесс с указанным PID"""
@@ -54,7 +77,7 @@ def get_process_info(pid):
                         uptime = float(f.read().split()[0])
                     
                     # Рассчитываем время работы процесса
-                    process_uptime = uptime - (start_time / 100)  # 100 тиков в секунду
+                    process_uptime = uptime - (start_time / CLK_TCK)
                     return {
                         "pid": pid,
                         "uptime_seconds": process_uptime,
@@ -65,6 +88,18 @@ def get_process_info(pid):
     
     return {"pid": pid, "uptime_seconds": None, "uptime_hours": None}
 
+# Интервалы проверки запуска демона, в сумме ~3 секунды
+START_CHECK_DELAYS = (0.05, 0.1, 0.2, 0.4, 0.8, 1.5)
+
+def wait_for_daemon_start():
+    """Ждет, пока демон запишет PID файл и процесс будет работать; возвращает PID или None"""
+    for delay in START_CHECK_DELAYS:
+        time.sleep(delay)
+        pid = get_pid_from_file()
+        if pid and is_process_running(pid):
+            return pid
+    return None
+
 def start_daemon():
     """Запускает демон"""
     pid = get_pid_from_file()
@@ -95,12 +130,9 @@ def start_daemon():
                 start_new_session=True
             )
         
-        # Ждем немного для запуска
-        time.sleep(2)
-        
-        # Проверяем, запустился ли
-        new_pid = get_pid_from_file()
-        if new_pid and is_process_running(new_pid):
+        # Ждем появления PID файла с нарастающими интервалами (до ~3 секунд)
+        new_pid = wait_for_daemon_start()
+        if new_pid:
             print(f"✅ Демон успешно запущен (PID: {new_pid})")
             print(f"   Логи: monitor_daemon.log")
             print(f"   Вывод: nohup.out")
@@ -114,6 +146,29 @@ def start_daemon():
         print(f"❌ Ошибка запуска: {e}")
         return False
 
+def wait_for_exit(pid, timeout):
+    """Ждет завершения процесса не дольше timeout секунд; возвращает True, если процесс завершился"""
+    try:
+        # Linux 5.3+: дескриптор процесса становится готовым к чтению в момент его завершения
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    
+    if pidfd is not None:
+        try:
+            ready, _, _ = select.select([pidfd], [], [], timeout)
+        finally:
+            os.close(pidfd)
+        return bool(ready)
+    
+    # Запасной вариант: периодическая проверка
+    deadline = time.monotonic() + timeout
+    while is_process_running(pid):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
 def stop_daemon():
     """Останавливает демон"""
     pid = get_pid_from_file()
@@ -129,18 +184,15 @@ def stop_daemon():
         os.kill(pid, signal.SIGTERM)
         
         # Ждем завершения
-        for i in range(10):
-            if not is_process_running(pid):
-                print("✅ Демон успешно остановлен")
-                return True
-            time.sleep(1)
+        if wait_for_exit(pid, 10):
+            print("✅ Демон успешно остановлен")
+            return True
         
         # Если не завершился, принудительно завершаем
         print("⚠️  Принудительное завершение...")
         os.kill(pid, signal.SIGKILL)
-        time.sleep(1)
         
-        if not is_process_running(pid):
+        if wait_for_exit(pid, 1):
             print("✅ Демон принудительно остановлен")
             return True
         else:
@@ -167,6 +219,33 @@ def restart_daemon():
         print("❌ Не удалось остановить демон для перезапуска")
         return False
 
+def read_json_fields(path, fields):
+    """Читает скалярные поля верхнего уровня fields из JSON файла"""
+    fields = set(fields)
+    if ijson is None:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        return {key: data[key] for key in fields if key in data}
+    
+    result = {}
+    with open(path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix in fields and event in SCALAR_EVENTS:
+                result[prefix] = value
+                if len(result) == len(fields):
+                    break
+    return result
+
+def stat_files(directory, names):
+    """Возвращает {имя: os.stat_result} для существующих файлов из names за один проход по каталогу"""
+    names = set(names)
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name: entry.stat() for entry in entries if entry.name in names}
+    except FileNotFoundError:
+        return {}
+
 def show_status():
     """Показывает статус демона"""
     print("=" * 60)
@@ -187,15 +266,15 @@ def show_status():
         # Проверяем файлы данных
         print("\n📁 Файлы данных:")
         data_dir = Path("electricity_data")
-        if data_dir.exists():
+        if data_dir.is_dir():
             current_file = data_dir / "current_electricity_data.json"
             historical_file = data_dir / "historical_electricity_data.json"
+            data_stats = stat_files(data_dir, (current_file.name, historical_file.name))
             
-            if current_file.exists():
+            if current_file.name in data_stats:
                 try:
-                    with open(current_file, 'r') as f:
-                        data = json.load(f)
-                    size = current_file.stat().st_size
+                    data = read_json_fields(current_file, ("total_records", "last_update"))
+                    size = data_stats[current_file.name].st_size
                     records = data.get("total_records", 0)
                     last_update = data.get("last_update", "N/A")
                     print(f"  ✅ Текущие данные: {size} байт, {records} записей")
@@ -205,11 +284,10 @@ def show_status():
             else:
                 print("  ❌ Файл текущих данных не найден")
             
-            if historical_file.exists():
+            if historical_file.name in data_stats:
                 try:
-                    with open(historical_file, 'r') as f:
-                        data = json.load(f)
-                    size = historical_file.stat().st_size
+                    data = read_json_fields(historical_file, ("total_pending", "last_sync"))
+                    size = data_stats[historical_file.name].st_size
                     pending = data.get("total_pending", 0)
                     last_sync = data.get("last_sync", "N/A")
                     print(f"  ✅ Исторические данные: {size} байт, {pending} ожидают")
@@ -230,11 +308,13 @@ def show_status():
             "nohup.err"
         ]
         
+        log_stats = stat_files(".", log_files)
+        
         for log_file in log_files:
-            if os.path.exists(log_file):
-                size = os.path.getsize(log_file)
-                mtime = datetime.fromtimestamp(os.path.getmtime(log_file))
-                print(f"  ✅ {log_file}: {size} байт, изменен: {mtime.strftime('%Y-%m-%d %H:%M:%S')}")
+            if log_file in log_stats:
+                size = log_stats[log_file].st_size
+                mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log_stats[log_file].st_mtime))
+                print(f"  ✅ {log_file}: {size} байт, изменен: {mtime}")
             else:
                 print(f"  ❌ {log_file}: не найден")
     
@@ -248,27 +328,38 @@ def show_status():
     
     print("=" * 60)
 
+def tail_lines(path, lines, chunk_size=8192):
+    """Читает последние строки файла блоками с конца, не загружая весь файл"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # Нужна lines+1 граница строки, чтобы первая строка хвоста была полной
+        while position > 0 and data.count(b"\n") <= lines:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    return data.decode('utf-8', errors='replace').splitlines()[-lines:]
+
 def show_logs(lines=50):
     """Показывает последние строки логов"""
     log_file = "monitor_daemon.log"
     
-    if not os.path.exists(log_file):
+    try:
+        last_lines = tail_lines(log_file, lines)
+    except FileNotFoundError:
         print(f"❌ Файл логов {log_file} не найден")
         return
+    except Exception as e:
+        print(f"❌ Ошибка чтения логов: {e}")
+        return
     
     print(f"\n📋 Последние {lines} строк логов ({log_file}):")
     print("-" * 60)
     
-    try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            all_lines = f.readlines()
-            last_lines = all_lines[-lines:] if len(all_lines) > lines else all_lines
-            
-            for line in last_lines:
-                print(line.rstrip())
-                
-    except Exception as e:
-        print(f"❌ Ошибка чтения логов: {e}")
+    for line in last_lines:
+        print(line.rstrip())
 
 def cleanup():
     """Очищает устаревшие файлы"""
@@ -291,6 +382,19 @@ def cleanup():
             if size_mb > 10:  # Больше 10 МБ
                 print(f"⚠️  Лог файл {log_file} большой: {size_mb:.1f} МБ")
                 print("   Рекомендуется очистка или ротация")
+    
+    # Удаляем старые сжатые сегменты истории электричества
+    cutoff = time.time() - HISTORY_SEGMENT_MAX_AGE_DAYS * 24 * 3600
+    removed = 0
+    for segment in Path("electricity_data").glob("electricity_history.*.gz"):
+        try:
+            if segment.stat().st_mtime < cutoff:
+                segment.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        print(f"✅ Удалено старых сегментов истории: {removed}")
 
 def main():
     """Основная функция"""
@@ -7,24 +7,61 @@
 import os
 import sys
 import time
+import random
+import asyncio
 import logging
+import logging.handlers
+import queue
 import signal
 import atexit
-from pathlib import Path
+import threading
 from datetime import datetime
 
-# Настройка логирования
+# Настройка логирования: запись на диск выполняется в фоновом потоке
 log_file = "monitor_daemon.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+log_format = '%(asctime)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s'
+log_formatter = logging.Formatter(log_format)
+log_handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# Сигналы завершения, обрабатываемые в цикле событий
+SHUTDOWN_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+# Код дочернего процесса мониторинга. Если монитор предоставляет
+# threading.Event down_event, ждем его вместо опроса monitoring_active
+MONITOR_CHILD_CODE = (
+    "import time\n"
+    "import logging\n"
+    # Дочерний процесс пишет в тот же журнал демона, что и прежде в одном процессе
+    "logging.basicConfig(\n"
+    "    level=logging.INFO,\n"
+    f"    format={log_format!r},\n"
+    f"    handlers=[logging.FileHandler({log_file!r}), logging.StreamHandler()]\n"
+    ")\n"
+    "from electricity_monitor import ElectricityMonitor\n"
+    "monitor = ElectricityMonitor(\n"
+    "    devices_config_path='devices_config.json',\n"
+    "    tariff_settings_path='tariff_settings.json'\n"
+    ")\n"
+    "monitor.start_monitoring()\n"
+    "down_event = getattr(monitor, 'down_event', None)\n"
+    "if down_event is not None:\n"
+    "    down_event.wait()\n"
+    "else:\n"
+    "    while monitor.monitoring_active:\n"
+    "        time.sleep(10)\n"
+)
+
 class MonitorDaemon:
     """Демон для мониторинга электричества на VPS"""
     
@@ -33,110 +70,143 @@ class MonitorDaemon:
         self.monitor_process = None
         self.restart_count = 0
         self.max_restarts = 10
-        self.restart_delay = 30  # секунды
+        self.base_delay = 2  # секунды
+        self.max_delay = 300  # секунды
+        self.monitor_start_time = None
         
-        # Регистрируем обработчики сигналов
-        signal.signal(signal.SIGTERM, self._signal_handler)
-        signal.signal(signal.SIGINT, self._signal_handler)
-        atexit.register(self.cleanup)
+        self._loop = None
+        self._stop_event = None
+        self._stop_wait = None
         
         logger.info("Демон мониторинга инициализирован")
     
-    def _signal_handler(self, signum, frame):
+    def _signal_handler(self, signum):
         """Обработчик сигналов для корректного завершения"""
-        logger.info(f"Получен сигнал {signum}, завершение работы...")
-        self.stop()
-        sys.exit(0)
+        # Повторный сигнал во время остановки игнорируем
+        if self._stop_event.is_set():
+            return
+        logger.info("Получен сигнал %s, завершение работы...", signum)
+        self._stop_event.set()
+    
+    def request_stop(self):
+        """Потокобезопасно запрашивает остановку запущенного демона"""
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
     
-    def start_monitor(self):
-        """Запускает процесс мониторинга"""
+    async def _wait_stop(self, timeout):
+        """Ждет запроса остановки не дольше timeout секунд"""
+        await asyncio.wait({self._stop_wait}, timeout=timeout)
+    
+    async def start_monitor(self):
+        """Запускает процесс мониторинга в дочернем процессе"""
         try:
             logger.info("Запуск процесса мониторинга...")
             
-            # Импортируем и запускаем мониторинг
-            from electricity_monitor import ElectricityMonitor
-            
-            # Создаем монитор
-            self.monitor = ElectricityMonitor(
-                devices_config_path="devices_config.json",
-                tariff_settings_path="tariff_settings.json"
+            self.monitor_process = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", MONITOR_CHILD_CODE
             )
-            
-            # Запускаем мониторинг
-            self.monitor.start_monitoring()
             self.running = True
-            self.restart_count = 0
+            self.monitor_start_time = time.monotonic()
             
-            logger.info("Мониторинг успешно запущен")
+            logger.info("Мониторинг успешно запущен (PID: %d)", self.monitor_process.pid)
             return True
             
         except Exception as e:
             logger.error(f"Ошибка запуска мониторинга: {e}")
             return False
     
-    def stop(self):
-        """Останавливает демон"""
+    async def stop(self):
+        """Останавливает процесс мониторинга"""
         logger.info("Остановка демона мониторинга...")
         self.running = False
         
-        if hasattr(self, 'monitor') and self.monitor:
+        process = self.monitor_process
+        if process is not None and process.returncode is None:
             try:
-                self.monitor.stop_monitoring()
+                process.terminate()
+                await asyncio.wait_for(process.wait(), timeout=30)
                 logger.info("Мониторинг остановлен")
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.warning("Мониторинг принудительно остановлен")
             except Exception as e:
                 logger.error(f"Ошибка остановки мониторинга: {e}")
     
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+    
     def cleanup(self):
         """Очистка при завершении"""
         logger.info("Выполняется очистка...")
-        self.stop()
+        self.running = False
     
-    def run(self):
-        """Основной цикл демона"""
-        logger.info("Демон мониторинга запущен")
+    async def _run_async(self):
+        """Основной цикл демона в цикле событий asyncio"""
+        loop = self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._stop_wait = asyncio.ensure_future(self._stop_event.wait())
         
-        while True:
-            try:
-                if not self.running:
-                    # Запускаем мониторинг
-                    if self.start_monitor():
+        # Обработчики сигналов можно установить только из главного потока;
+        # во встроенном режиме остановка выполняется через request_stop()
+        handle_signals = threading.current_thread() is threading.main_thread()
+        if handle_signals:
+            for sig in SHUTDOWN_SIGNALS:
+                loop.add_signal_handler(sig, self._signal_handler, sig)
+        else:
+            logger.info("Демон запущен не в главном потоке, сигналы не перехватываются")
+        
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    if await self.start_monitor():
                         logger.info("Мониторинг запущен, ожидание...")
                         
-                        # Ждем завершения или сбоя
-                        while self.running:
-                            time.sleep(10)
-                            
-                            # Проверяем статус мониторинга
-                            if hasattr(self, 'monitor'):
-                                try:
-                                    # Проверяем, что мониторинг активен
-                                    if not self.monitor.monitoring_active:
-                                        logger.warning("Мониторинг неактивен, перезапуск...")
-                                        break
-                                except Exception as e:
-                                    logger.error(f"Ошибка проверки статуса: {e}")
-                                    break
-                    else:
-                        # Не удалось запустить
-                        if self.restart_count < self.max_restarts:
-                            self.restart_count += 1
-                            logger.warning(f"Попытка перезапуска {self.restart_count}/{self.max_restarts}")
-                            time.sleep(self.restart_delay)
-                        else:
-                            logger.error("Превышено максимальное количество перезапусков")
+                        # Ждем завершения дочернего процесса или запроса остановки
+                        child_wait = asyncio.ensure_future(self.monitor_process.wait())
+                        await asyncio.wait({child_wait, self._stop_wait},
+                                           return_when=asyncio.FIRST_COMPLETED)
+                        if self._stop_event.is_set():
                             break
-                else:
-                    time.sleep(1)
+                        self.running = False
+                        logger.warning("Процесс мониторинга завершился с кодом %s, перезапуск...", self.monitor_process.returncode)
+                        
+                        # Долгая стабильная работа сбрасывает счетчик перезапусков
+                        if time.monotonic() - self.monitor_start_time > self.max_delay:
+                            self.restart_count = 0
+                            continue
                     
-            except KeyboardInterrupt:
-                logger.info("Получен сигнал прерывания")
-                break
-            except Exception as e:
-                logger.error(f"Критическая ошибка в демоне: {e}")
-                time.sleep(10)
+                    # Не удалось запустить или процесс быстро упал
+                    if self.restart_count < self.max_restarts:
+                        # Экспоненциальная задержка с полным джиттером
+                        delay = min(self.base_delay * (2 ** self.restart_count), self.max_delay)
+                        self.restart_count += 1
+                        logger.warning("Попытка перезапуска %d/%d", self.restart_count, self.max_restarts)
+                        await self._wait_stop(random.uniform(0, delay))
+                    else:
+                        logger.error("Превышено максимальное количество перезапусков")
+                        break
+                        
+                except Exception as e:
+                    logger.error("Критическая ошибка в демоне: %s", e)
+                    await self._wait_stop(10)
+        finally:
+            if handle_signals:
+                for sig in SHUTDOWN_SIGNALS:
+                    loop.remove_signal_handler(sig)
+            self._stop_wait.cancel()
+            await self.stop()
+    
+    def run(self):
+        """Основной цикл демона"""
+        logger.info("Демон мониторинга запущен")
+        
+        asyncio.run(self._run_async())
         
         logger.info("Демон завершает работу")
-        self.cleanup()
 
 
 def create_pid_file():
@@ -156,10 +226,12 @@ def create_pid_file():
 
 def remove_pid_file(pid_file):
     """Удаляет PID файл"""
-    if pid_file and os.path.exists(pid_file):
+    if pid_file:
         try:
-            os.remove(pid_file)
+            os.unlink(pid_file)
             logger.info("PID файл удален")
+        except FileNotFoundError:
+            pass
         except Exception as e:
             logger.error(f"Ошибка удаления PID файла: {e}")
 
@@ -177,10 +249,10 @@ def main():
         "tariff_settings.json"
     ]
     
-    missing_files = []
-    for file_path in required_files:
-        if not Path(file_path).exists():
-            missing_files.append(file_path)
+    # Одно чтение каталога вместо stat() для каждого файла
+    with os.scandir('.') as entries:
+        present = {entry.name for entry in entries}
+    missing_files = [f for f in required_files if f not in present]
     
     if missing_files:
         logger.error(f"Отсутствуют необходимые файлы: {', '.join(missing_files)}")
@@ -194,8 +266,8 @@ def main():
     
     try:
         # Создаем и запускаем демон
-        daemon = MonitorDaemon()
-        daemon.run()
+        with MonitorDaemon() as daemon:
+            daemon.run()
         
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
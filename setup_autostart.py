@@ -7,7 +7,6 @@
 import os
 import sys
 import subprocess
-from pathlib import Path
 
 def check_root():
     """Проверяет, запущен ли скрипт от root"""
@@ -17,6 +16,31 @@ def check_root():
         return False
     return True
 
+def _run(cmd, **kwargs):
+    """Запускает команду без унаследованных дескрипторов в отдельной сессии"""
+    return subprocess.run(cmd, close_fds=True, start_new_session=True, **kwargs)
+
+def _atomic_write(path, data, mode=0o644):
+    """Атомарно записывает файл через временный файл, fsync и rename"""
+    temp_path = path + ".tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        try:
+            view = memoryview(data.encode())
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, path)
+    except BaseException:
+        # Не оставляем недописанный временный файл
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
 def get_current_directory():
     """Получает текущую рабочую директорию"""
     return os.getcwd()
@@ -54,8 +78,7 @@ WantedBy=multi-user.target
     service_file = f"/etc/systemd/system/{service_name}.service"
     
     try:
-        with open(service_file, 'w') as f:
-            f.write(service_content)
+        _atomic_write(service_file, service_content)
         
         print(f"✅ Создан systemd сервис: {service_file}")
         return True
@@ -104,8 +127,7 @@ def create_logrotate_config():
     config_file = "/etc/logrotate.d/electricity-monitor"
     
     try:
-        with open(config_file, 'w') as f:
-            f.write(config_content)
+        _atomic_write(config_file, config_content)
         
         print(f"✅ Создана конфигурация logrotate: {config_file}")
         return True
@@ -127,15 +149,8 @@ def create_cron_jobs():
 # 0 3 * * * systemctl restart electricity-monitor >/dev/null 2>&1
 """
     
-    # Создаем временный файл
-    temp_cron = "/tmp/electricity-monitor-cron"
-    
     try:
-        with open(temp_cron, 'w') as f:
-            f.write(cron_content)
-        
-        # Добавляем в crontab
-        result = subprocess.run(
+        result = _run(
             ["crontab", "-l"],
             capture_output=True,
             text=True
@@ -145,52 +160,33 @@ def create_cron_jobs():
         
         # Проверяем, есть ли уже наши задачи
         if "electricity-monitor" not in current_cron:
-            # Добавляем новые задачи
-            with open(temp_cron, 'r') as f:
-                new_cron = f.read()
-            
-            # Объединяем существующие и новые задачи
-            combined_cron = current_cron + "\n" + new_cron
-            
-            # Создаем временный файл с объединенным содержимым
-            temp_combined = "/tmp/combined-cron"
-            with open(temp_combined, 'w') as f:
-                f.write(combined_cron)
-            
-            # Обновляем crontab
-            subprocess.run(["crontab", temp_combined], check=True)
-            
-            # Удаляем временные файлы
-            os.remove(temp_cron)
-            os.remove(temp_combined)
+            # Передаем объединенный crontab через stdin без временных файлов
+            process = subprocess.Popen(["crontab", "-"], stdin=subprocess.PIPE, text=True,
+                                       close_fds=True, start_new_session=True)
+            process.communicate(current_cron + "\n" + cron_content)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, ["crontab", "-"])
             
             print("✅ Добавлены cron задачи")
         else:
             print("ℹ️  Cron задачи уже существуют")
-            os.remove(temp_cron)
         
         return True
         
     except Exception as e:
         print(f"❌ Ошибка создания cron задач: {e}")
-        if os.path.exists(temp_cron):
-            os.remove(temp_cron)
         return False
 
 def enable_and_start_service():
     """Включает и запускает systemd сервис"""
     try:
         # Перезагружаем systemd
-        subprocess.run(["systemctl", "daemon-reload"], check=True)
+        _run(["systemctl", "daemon-reload"], check=True)
         print("✅ Systemd перезагружен")
         
-        # Включаем автозапуск
-        subprocess.run(["systemctl", "enable", "electricity-monitor"], check=True)
-        print("✅ Сервис включен для автозапуска")
-        
-        # Запускаем сервис
-        subprocess.run(["systemctl", "start", "electricity-monitor"], check=True)
-        print("✅ Сервис запущен")
+        # Включаем автозапуск и запускаем сервис одним вызовом
+        _run(["systemctl", "enable", "--now", "electricity-monitor"], check=True)
+        print("✅ Сервис включен для автозапуска и запущен")
         
         return True
         
@@ -205,10 +201,10 @@ def show_status():
     """Показывает статус сервиса"""
     try:
         print("\n📊 Статус сервиса:")
-        subprocess.run(["systemctl", "status", "electricity-monitor"], check=False)
+        _run(["systemctl", "status", "electricity-monitor"], check=False)
         
         print("\n📋 Последние логи:")
-        subprocess.run(["journalctl", "-u", "electricity-monitor", "-n", "10", "--no-pager"], check=False)
+        _run(["journalctl", "-u", "electricity-monitor", "-n", "10", "--no-pager"], check=False)
         
     except Exception as e:
         print(f"❌ Ошибка получения статуса: {e}")
@@ -255,11 +251,8 @@ esac
     script_file = "/usr/local/bin/electricity-monitor"
     
     try:
-        with open(script_file, 'w') as f:
-            f.write(script_content)
-        
-        # Делаем исполняемым
-        os.chmod(script_file, 0o755)
+        # Создаем сразу исполняемым
+        _atomic_write(script_file, script_content, mode=0o755)
         
         print(f"✅ Создан скрипт управления: {script_file}")
         print("   Использование: electricity-monitor {start|stop|restart|status|logs|enable|disable}")
@@ -291,10 +284,10 @@ def main():
         "tariff_settings.json"
     ]
     
-    missing_files = []
-    for file_path in required_files:
-        if not Path(file_path).exists():
-            missing_files.append(file_path)
+    # Одно чтение каталога вместо stat() для каждого файла
+    with os.scandir('.') as entries:
+        present = {entry.name for entry in entries}
+    missing_files = [f for f in required_files if f not in present]
     
     if missing_files:
         print(f"❌ Отсутствуют необходимые файлы: {', '.join(missing_files)}")
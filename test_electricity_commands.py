@@ -7,6 +7,9 @@ import os
 import sys
 import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
@@ -17,7 +20,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 load_dotenv()
 
 # Настраиваем логирование
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s')
 logger = logging.getLogger(__name__)
 
 def test_electricity_today():
@@ -60,23 +63,27 @@ def test_electricity_72h():
         
         # Тестируем для каждой локации
         from main import DEVICES
-        locations = set(device["location"] for device in DEVICES)
+        locations = list({device["location"] for device in DEVICES})
         
         if not locations:
             logger.warning("⚠️ Нет настроенных локаций")
             return True
         
-        for location in locations:
-            logger.info(f"   Тестирование локации: {location}")
-            api_data = get_72h_consumption_from_api(location)
+        # Запросы к API по локациям выполняем параллельно
+        with ThreadPoolExecutor(max_workers=min(len(locations), 8)) as executor:
+            results = dict(zip(locations, executor.map(get_72h_consumption_from_api, locations)))
+        
+        for location, api_data in results.items():
+            logger.info("   Тестирование локации: %s", location)
             
             if api_data['total_energy'] > 0:
-                logger.info(f"      ✅ API данные получены: {api_data['total_energy']:.3f} кВт·ч")
-                logger.info(f"      Стоимость: {api_data['total_cost']:.2f} RUB")
-                logger.info(f"      День: {api_data['day_energy']:.3f} кВт·ч")
-                logger.info(f"      Ночь: {api_data['night_energy']:.3f} кВт·ч")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("      ✅ API данные получены: %.3f кВт·ч", api_data['total_energy'])
+                    logger.info("      Стоимость: %.2f RUB", api_data['total_cost'])
+                    logger.info("      День: %.3f кВт·ч", api_data['day_energy'])
+                    logger.info("      Ночь: %.3f кВт·ч", api_data['night_energy'])
             else:
-                logger.info(f"      ⚠️ API данные не получены для {location}")
+                logger.info("      ⚠️ API данные не получены для %s", location)
         
         return True
         
@@ -110,7 +117,7 @@ def test_energy_data_function():
                 location_stats[location]["total_energy"] += session.get("energy_kwh", 0)
             
             for location, stats in location_stats.items():
-                logger.info(f"   📍 {location}: {stats['count']} записей, {stats['total_energy']:.3f} кВт·ч")
+                logger.info("   📍 %s: %d записей, %.3f кВт·ч", location, stats['count'], stats['total_energy'])
         else:
             logger.info("ℹ️ Данные из базы не найдены (это нормально для новых установок)")
         
@@ -147,6 +154,11 @@ def main():
     """Основная функция тестирования"""
     logger.info("🚀 Начало тестирования команд мониторинга электроэнергии")
     
+    # Кэшируем ответы API на время прогона, чтобы тесты не повторяли запросы
+    import main as bot_main
+    original_72h = bot_main.get_72h_consumption_from_api
+    bot_main.get_72h_consumption_from_api = lru_cache(maxsize=16)(original_72h)
+    
     tests = [
         ("Конфигурация устройств", test_device_configuration),
         ("Функция за сегодня", test_electricity_today),
@@ -154,19 +166,24 @@ def main():
         ("Функция базы данных", test_energy_data_function)
     ]
     
-    results = []
-    
-    for test_name, test_func in tests:
-        logger.info(f"\n{'='*50}")
-        logger.info(f"Тест: {test_name}")
-        logger.info(f"{'='*50}")
-        
+    def run_test(test_name, test_func):
+        """Запускает тест в потоке, подписывая его логи именем теста"""
+        threading.current_thread().name = test_name
         try:
-            result = test_func()
-            results.append((test_name, result))
+            return test_func()
         except Exception as e:
             logger.error(f"Критическая ошибка в тесте {test_name}: {e}")
-            results.append((test_name, False))
+            return False
+    
+    # Тесты в основном ждут сеть и базу, поэтому запускаем их параллельно
+    try:
+        with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+            futures = {test_name: executor.submit(run_test, test_name, test_func)
+                       for test_name, test_func in tests}
+            results = [(test_name, future.result()) for test_name, future in futures.items()]
+    finally:
+        # Исходную функцию возвращаем при любом исходе тестов
+        bot_main.get_72h_consumption_from_api = original_72h
     
     # Выводим итоговые результаты
     logger.info(f"\n{'='*50}")
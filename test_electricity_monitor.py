@@ -3,11 +3,31 @@
 Тестовый скрипт для проверки мониторинга электричества
 """
 
-import time
+import os
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Разбор JSON через orjson, если он установлен
+json_loads = orjson.loads if orjson is not None else json.loads
+
+def _try_open(path):
+    """Открывает файл на чтение одним системным вызовом или возвращает None"""
+    try:
+        return os.fdopen(os.open(path, os.O_RDONLY), 'rb')
+    except FileNotFoundError:
+        return None
+
 def test_electricity_data_save():
     """Тестирует сохранение данных электричества"""
     print("Тестирование сохранения данных электричества...")
@@ -28,7 +48,7 @@ def test_electricity_data_save():
     
     # Импортируем функцию из main.py
     try:
-        from main import save_electricity_data
+        from main import save_electricity_data, flush_sink, electricity_log_stats
         
         # Сохраняем данные
         save_electricity_data(
@@ -41,23 +61,16 @@ def test_electricity_data_save():
             voltage=voltage,
             current=current
         )
+        flush_sink()
         
         print("✓ Данные электричества успешно сохранены")
         
-        # Проверяем созданные файлы
-        data_dir = Path("electricity_data")
-        current_file = data_dir / "electricity_data.json"
-        history_file = data_dir / "electricity_history.json"
-        
-        if current_file.exists():
-            with open(current_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            print(f"✓ Файл текущих данных создан: {len(data.get('records', []))} записей")
-        
-        if history_file.exists():
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            print(f"✓ Файл истории создан: {len(history.get('pending_records', []))} записей")
+        # Счетчики записей хранятся в _meta.json, сами журналы не разбираем
+        stats = electricity_log_stats()
+        if stats["current_count"]:
+            print(f"✓ Файл текущих данных создан: {stats['current_count']} записей")
+        if stats["pending_count"]:
+            print(f"✓ Файл истории создан: {stats['pending_count']} записей")
         
         return True
         
@@ -74,32 +87,63 @@ def test_electricity_data_structure():
     
     try:
         data_dir = Path("electricity_data")
-        current_file = data_dir / "electricity_data.json"
-        history_file = data_dir / "electricity_history.json"
+        current_file = data_dir / f"{datetime.now():%Y-%m-%d}.jsonl"
+        history_file = data_dir / "electricity_history.msgpack"
+        last_update_file = data_dir / "last_update"
         
-        if current_file.exists():
-            with open(current_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+        f = _try_open(current_file)
+        if f is not None:
+            from main import device_energy_totals, resolve_record
+            
+            # Полностью разбираем только одну запись для примера
+            first_record = None
+            with f:
+                for line in f:
+                    if line.strip():
+                        first_record = json_loads(line)
+                        break
+            
+            # Для общей статистики достаточно числовых столбцов журнала
+            energy_by_device = device_energy_totals(current_file)
+            total_energy = sum(energy_by_device.values())
+            
+            last_update = None
+            last_update_f = _try_open(last_update_file)
+            if last_update_f is not None:
+                with last_update_f:
+                    last_update = last_update_f.read().decode('utf-8')
             
             print("Структура файла текущих данных:")
-            print(f"  - last_update: {data.get('last_update')}")
-            print(f"  - total_records: {data.get('total_records')}")
-            print(f"  - records: {len(data.get('records', []))} записей")
+            print(f"  - last_update: {last_update}")
+            print(f"  - devices: {len(energy_by_device)} устройств")
+            print(f"  - energy_kwh: {total_energy:.3f} кВт·ч")
+            for device_id, energy in energy_by_device.items():
+                print(f"    {device_id}: {energy:.3f} кВт·ч")
             
-            if data.get('records'):
-                record = data['records'][0]
+            if first_record:
+                
+                # Записи ссылаются на описание устройства по sha256
+                record = resolve_record(first_record)
+                missing_fields = [key for key in ("device_id", "device_name", "location") if key not in record]
+                if missing_fields:
+                    print(f"✗ Запись не развернута, нет полей: {', '.join(missing_fields)}")
+                    return False
+                
                 print("  Пример записи:")
                 for key, value in record.items():
                     print(f"    {key}: {value}")
         
-        if history_file.exists():
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            
-            print("\nСтруктура файла истории:")
-            print(f"  - last_sync: {history.get('last_sync')}")
-            print(f"  - total_pending: {history.get('total_pending')}")
-            print(f"  - pending_records: {len(history.get('pending_records', []))} записей")
+        # Без msgpack журнал синхронизации не разобрать, проверку пропускаем
+        if msgpack is None:
+            print("\n⚠ msgpack не установлен, проверка файла истории пропущена")
+        else:
+            f = _try_open(history_file)
+            if f is not None:
+                with f:
+                    total_pending = sum(1 for _ in msgpack.Unpacker(f, raw=False))
+                
+                print("\nСтруктура файла истории:")
+                print(f"  - pending_records: {total_pending} записей")
         
         return True
         
@@ -112,7 +156,7 @@ def simulate_multiple_readings():
     print("\nИмитация нескольких измерений...")
     
     try:
-        from main import save_electricity_data
+        from main import save_electricity_data, flush_sink
         
         test_device = {
             "device_id": "test_device_002",
@@ -120,7 +164,8 @@ def simulate_multiple_readings():
             "location": "test_location_2"
         }
         
-        # Имитируем несколько измерений
+        # Имитируем несколько измерений с шагом в секунду без реального ожидания
+        start_time = datetime.now()
         for i in range(3):
             power_w = 1500.0 + (i * 100)  # Разная мощность
             energy_kwh = 0.125 + (i * 0.025)  # Разное потребление
@@ -136,12 +181,14 @@ def simulate_multiple_readings():
                 energy_kwh=energy_kwh,
                 is_on=is_on,
                 voltage=voltage,
-                current=current
+                current=current,
+                timestamp=start_time + timedelta(seconds=i)
             )
             
             print(f"  Измерение {i+1}: мощность={power_w}Вт, энергия={energy_kwh:.3f}кВт·ч")
-            time.sleep(1)  # Небольшая пауза
         
+        # Записи пишутся пакетами, дожидаемся сброса на диск
+        flush_sink()
         print("✓ Имитация измерений завершена")
         return True
         
@@ -174,8 +221,8 @@ def main():
     print("ВСЕ ТЕСТЫ ПРОЙДЕНЫ УСПЕШНО!")
     print("=" * 50)
     print("\nФайлы созданы в директории 'electricity_data/':")
-    print("  - electricity_data.json - текущие данные")
-    print("  - electricity_history.json - данные для синхронизации")
+    print("  - ГГГГ-ММ-ДД.jsonl - текущие данные по дням")
+    print("  - electricity_history.msgpack - данные для синхронизации")
     print("\nДанные будут синхронизироваться с Supabase в 6:00 и 18:00")
 
 if __name__ == "__main__":
@@ -7,6 +7,9 @@ import os
 import sys
 import json
 import logging
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
@@ -17,7 +20,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s')
 logger = logging.getLogger(__name__)
 
 def test_tuya_api_fix():
@@ -33,7 +36,8 @@ def test_tuya_api_fix():
         end_time = datetime.now()
         start_time = end_time - timedelta(hours=24)
         
-        result = get_device_energy_stats_cloud(device_id, start_time, end_time)
+        # Bypass the stats cache so the API itself is exercised
+        result = get_device_energy_stats_cloud(device_id, start_time, end_time, refresh=True)
         if result and result.get('success'):
             logger.info(f"✅ Tuya API fix working: {result}")
             return True
@@ -133,15 +137,48 @@ def test_cmd_last_fix():
         logger.error(f"❌ cmd_last fix failed: {e}")
         return False
 
+def test_backfill_profitability():
+    """Test that backfill_profitability batches one save per table"""
+    logger.info("Testing profitability backfill...")
+    try:
+        import main as bot_main
+        
+        # Capture the batched saves instead of writing to the database
+        saver_names = ["_save_daily_profitability", "_save_3day_profitability",
+                       "_save_weekly_profitability", "_save_monthly_profitability"]
+        originals = {name: getattr(bot_main, name) for name in saver_names}
+        saved = {name: [] for name in saver_names}
+        for name in saver_names:
+            setattr(bot_main, name, saved[name].append)
+        try:
+            today = datetime.combine(datetime.now().date(), datetime.min.time())
+            end_dates = [today - timedelta(days=offset) for offset in (1, 0)]
+            counts = bot_main.backfill_profitability(end_dates)
+        finally:
+            for name, original in originals.items():
+                setattr(bot_main, name, original)
+        
+        # Each table gets at most one batched write holding every recalculated date
+        for name, key in zip(saver_names, ("daily", "3day", "weekly", "monthly")):
+            calls = saved[name]
+            if len(calls) > 1 or (calls and len(calls[0]) != counts[key]) or counts[key] > len(end_dates):
+                logger.error(f"❌ Unexpected backfill writes for {name}: {calls}")
+                return False
+        logger.info(f"✅ Profitability backfill working: {counts}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Profitability backfill failed: {e}")
+        return False
+
 def test_database_table_creation():
     """Test if the miner_3day_profitability table can be created"""
     logger.info("Testing database table creation...")
     try:
-        from main import supabase
+        from main import get_supabase_client
         
         # Try to query the table to see if it exists
         try:
-            response = supabase.table("miner_3day_profitability").select("*").limit(1).execute()
+            response = get_supabase_client().table("miner_3day_profitability").select("*").limit(1).execute()
             logger.info("✅ miner_3day_profitability table exists")
             return True
         except Exception as e:
@@ -157,30 +194,90 @@ def test_database_table_creation():
         logger.error(f"❌ Database connection failed: {e}")
         return False
 
+def test_sql_read_only_guard():
+    """Test that generated SQL cannot modify data"""
+    logger.info("Testing read-only SQL guard...")
+    try:
+        from main import _is_read_only_sql
+        
+        allowed = [
+            "SELECT SUM(energy_kwh) FROM miner_energy_sessions",
+            "SELECT * FROM miner_sales;",
+            "WITH s AS (SELECT * FROM miner_sales) SELECT COUNT(*) FROM s",
+            "SELECT created_at FROM miner_sales"
+        ]
+        rejected = [
+            # Data-modifying CTE
+            "WITH d AS (DELETE FROM miner_sales RETURNING *) SELECT * FROM d",
+            "with u as (update miner_sales set amount_sold = 0 returning id) select id from u",
+            # Chained statements
+            "SELECT 1; DROP TABLE miner_sales",
+            "SELECT 1; DROP TABLE miner_sales;",
+            "SELECT 1;;",
+            "DELETE FROM miner_sales",
+            ""
+        ]
+        failures = [sql for sql in allowed if not _is_read_only_sql(sql)]
+        failures += [sql for sql in rejected if _is_read_only_sql(sql)]
+        if failures:
+            logger.error(f"❌ Read-only SQL guard misclassified: {failures}")
+            return False
+        logger.info("✅ Read-only SQL guard rejects writes and chained statements")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Read-only SQL guard failed: {e}")
+        return False
+
 def main():
     """Run all tests"""
     logger.info("Starting comprehensive test of all fixes...")
-    
-    tests = [
+
+    # Import the bot module once up front: the tests then only hit the
+    # sys.modules cache, worker threads don't contend on the import lock,
+    # and a broken import is reported once instead of by every test
+    try:
+        importlib.import_module("main")
+    except Exception as e:
+        logger.error(f"❌ Failed to import main: {e}")
+        return False
+
+    # Independent tests are I/O bound and can run concurrently
+    parallel_tests = [
         ("Tuya API Fix", test_tuya_api_fix),
         ("Save Session Fix", test_save_session_fix),
+        ("Database Table Creation", test_database_table_creation),
+        ("Read-only SQL Guard", test_sql_read_only_guard)
+    ]
+    # The profitability tests share the period cache, so the second one
+    # must run after the first has filled it
+    serial_tests = [
         ("3-Day Profitability Calculation", test_3day_profitability_calculation),
         ("Cmd Last Fix", test_cmd_last_fix),
-        ("Database Table Creation", test_database_table_creation)
+        ("Profitability Backfill", test_backfill_profitability)
     ]
     
-    results = []
-    for test_name, test_func in tests:
-        logger.info(f"\n{'='*50}")
-        logger.info(f"Running: {test_name}")
-        logger.info('='*50)
-        
+    def run_test(test_name, test_func):
+        """Run a single test, labelling its log lines with the test name"""
+        threading.current_thread().name = test_name
         try:
-            result = test_func()
-            results.append((test_name, result))
+            return test_func()
         except Exception as e:
             logger.error(f"Test {test_name} failed with exception: {e}")
-            results.append((test_name, False))
+            return False
+    
+    if "--serial" in sys.argv:
+        results = [(test_name, run_test(test_name, test_func))
+                   for test_name, test_func in parallel_tests]
+    else:
+        with ThreadPoolExecutor(max_workers=len(parallel_tests)) as executor:
+            futures = {test_name: executor.submit(run_test, test_name, test_func)
+                       for test_name, test_func in parallel_tests}
+            results = [(test_name, future.result()) for test_name, future in futures.items()]
+    
+    main_thread_name = threading.current_thread().name
+    for test_name, test_func in serial_tests:
+        results.append((test_name, run_test(test_name, test_func)))
+    threading.current_thread().name = main_thread_name
     
     # Summary
     logger.info(f"\n{'='*60}")